@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+#   Compare the motion algorithms' per-sample cost and accuracy on recorded data
+#
+#   Usage:
+#       python benchmark.py             Synthetic motion with ground truth
+#       python benchmark.py IMU.csv     A motion snapshot recorded from the debug page
+
+import sys
+import time
+
+import numpy as np
+
+import fusion
+import recording
+
+def wrapDegrees(angles):
+    """ Wrap angle differences into -180..180 """
+    return (angles + 180) % 360 - 180
+
+def reference(algorithm, truth):
+    """ True angles in the output convention of each algorithm, so errors compare like for like """
+    if algorithm == 'fast':                         # The remap already puts it back in degrees
+        return truth
+    elif algorithm == 'accurate':                   # X and Y swapped
+        return truth[:, [1, 0, 2]]
+    else:
+        return truth
+
+def run(data):
+    accAngles = np.stack(fusion.gravityAngles(*data['acc'].T), axis=1)
+
+    filters = {
+        'fast':     fusion.ComplementaryFilter(),
+        'accurate': fusion.KalmanFilter(),
+        'ahrs':     fusion.MadgwickFilter(),
+    }
+
+    print(f"{len(data['dt'])} samples at {1 / np.mean(data['dt'][1:]):.0f} Hz\n")
+    print(f"{'Algorithm':<10} {'us/sample':>10} {'Jitter':>8} {'RMS error':>10}")
+    for name, fusionFilter in filters.items():
+        start = time.perf_counter()
+        angles = fusionFilter.process(accAngles, data['gyro'], data['dt'], data['acc'], data['mag'])
+        perSample = (time.perf_counter() - start) / len(angles) * 1000000
+
+        # Jitter: mean absolute change between samples -- lower is steadier
+        jitter = np.mean(np.abs(wrapDegrees(np.diff(angles, axis=0))))
+
+        if 'truth' in data:
+            error = wrapDegrees(angles - reference(name, data['truth']))
+            rmsError = f"{np.sqrt(np.mean(error ** 2)):10.2f}"
+        else:
+            rmsError = f"{'n/a':>10}"   # Recorded data has no ground truth
+
+        print(f"{name:<10} {perSample:10.2f} {jitter:8.3f} {rmsError}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(recording.loadRecording(sys.argv[1]))
+    else:
+        run(recording.synthesiseRecording())
@@ -19,8 +19,11 @@
 
 import time
 import math
-import IMU
-import datetime
+import imu as IMU
+import fusion
+import rolling
+import calibration
+import pipeline
 import os
 import sys
 
@@ -35,11 +38,13 @@ ACC_LPF_FACTOR = 0.4    # Low pass filter constant for accelerometer
 ACC_MEDIANTABLESIZE = 2         # Median filter table size for accelerometer. Higher = smoother but a longer delay
 MAG_MEDIANTABLESIZE = 9         # Median filter table size for magnetometer. Higher = smoother but a longer delay
 
-################# Compass Calibration values ############
-# Use calibrateBerryIMU.py to get calibration values
+################# Calibration values ############
+# Use calibration.py to measure these -- init() loads the saved values over the defaults below
 # Calibrating the compass isnt mandatory, however a calibrated
 # compass will result in a more accurate heading value.
 
+gyroBias = [0.0, 0.0, 0.0]  # Gyro X, Y, Z rate at rest in deg/s, subtracted from every reading
+
 magXmin =  0
 magYmin =  0
 magZmin =  0
@@ -63,131 +68,33 @@ Dont use the above values, these are just an example.
 Q_angle = 0.02
 Q_gyro = 0.0015
 R_angle = 0.005
-y_bias = 0.0
-x_bias = 0.0
-z_bias = 0.0
-XP_00 = 0.0
-XP_01 = 0.0
-XP_10 = 0.0
-XP_11 = 0.0
-YP_00 = 0.0
-YP_01 = 0.0
-YP_10 = 0.0
-YP_11 = 0.0
-ZP_00 = 0.0
-ZP_01 = 0.0
-ZP_10 = 0.0
-ZP_11 = 0.0
-KFangleX = 0.0
-KFangleY = 0.0
-KFangleZ = 0.0
-
-def kalmanFilterY ( accAngle, gyroRate, DT):
-    y=0.0
-    S=0.0
-
-    global KFangleY
-    global Q_angle
-    global Q_gyro
-    global y_bias
-    global YP_00
-    global YP_01
-    global YP_10
-    global YP_11
-
-    KFangleY = KFangleY + DT * (gyroRate - y_bias)
-
-    YP_00 = YP_00 + ( - DT * (YP_10 + YP_01) + Q_angle * DT )
-    YP_01 = YP_01 + ( - DT * YP_11 )
-    YP_10 = YP_10 + ( - DT * YP_11 )
-    YP_11 = YP_11 + ( + Q_gyro * DT )
-
-    y = accAngle - KFangleY
-    S = YP_00 + R_angle
-    K_0 = YP_00 / S
-    K_1 = YP_10 / S
-
-    KFangleY = KFangleY + ( K_0 * y )
-    y_bias = y_bias + ( K_1 * y )
-
-    YP_00 = YP_00 - ( K_0 * YP_00 )
-    YP_01 = YP_01 - ( K_0 * YP_01 )
-    YP_10 = YP_10 - ( K_1 * YP_00 )
-    YP_11 = YP_11 - ( K_1 * YP_01 )
-
-    return KFangleY
-
-def kalmanFilterX ( accAngle, gyroRate, DT):
-    x=0.0
-    S=0.0
-
-    global KFangleX
-    global Q_angle
-    global Q_gyro
-    global x_bias
-    global XP_00
-    global XP_01
-    global XP_10
-    global XP_11
-
-
-    KFangleX = KFangleX + DT * (gyroRate - x_bias)
-
-    XP_00 = XP_00 + ( - DT * (XP_10 + XP_01) + Q_angle * DT )
-    XP_01 = XP_01 + ( - DT * XP_11 )
-    XP_10 = XP_10 + ( - DT * XP_11 )
-    XP_11 = XP_11 + ( + Q_gyro * DT )
-
-    x = accAngle - KFangleX
-    S = XP_00 + R_angle
-    K_0 = XP_00 / S
-    K_1 = XP_10 / S
-
-    KFangleX = KFangleX + ( K_0 * x )
-    x_bias = x_bias + ( K_1 * x )
-
-    XP_00 = XP_00 - ( K_0 * XP_00 )
-    XP_01 = XP_01 - ( K_0 * XP_01 )
-    XP_10 = XP_10 - ( K_1 * XP_00 )
-    XP_11 = XP_11 - ( K_1 * XP_01 )
-
-    return KFangleX
-
-def kalmanFilterZ ( accAngle, gyroRate, DT):
-    Z=0.0
-    S=0.0
-
-    global KFangleZ
-    global Q_angle
-    global Q_gyro
-    global z_bias
-    global ZP_00
-    global ZP_01
-    global ZP_10
-    global ZP_11
-
-
-    KFangleZ = KFangleZ + DT * (gyroRate - z_bias)
-
-    ZP_00 = ZP_00 + ( - DT * (ZP_10 + ZP_01) + Q_angle * DT )
-    ZP_01 = ZP_01 + ( - DT * ZP_11 )
-    ZP_10 = ZP_10 + ( - DT * ZP_11 )
-    ZP_11 = ZP_11 + ( + Q_gyro * DT )
-
-    z = accAngle - KFangleZ
-    S = ZP_00 + R_angle
-    K_0 = ZP_00 / S
-    K_1 = ZP_10 / S
-
-    KFangleZ = KFangleZ + ( K_0 * z )
-    z_bias = z_bias + ( K_1 * z )
 
-    ZP_00 = ZP_00 - ( K_0 * ZP_00 )
-    ZP_01 = ZP_01 - ( K_0 * ZP_01 )
-    ZP_10 = ZP_10 - ( K_1 * ZP_00 )
-    ZP_11 = ZP_11 - ( K_1 * ZP_01 )
-
-    return KFangleZ
+#Madgwick AHRS variables
+MADGWICK_BETA = 0.1     # Higher = trust accelerometer more, lower = trust gyro more
+
+# Sensor profiles: how hard the IMU works, from barely ticking over to tracking fast movement
+#   odr             Hz      Accelerometer and gyro output data rate, and the rate samples are taken at
+#   accRange        g       Accelerometer full scale
+#   gyrRange        dps     Gyro full scale -- sets G_GAIN
+#   highPerformance bool    Accelerometer and gyro high-performance mode, otherwise low-power/normal mode
+#   magODR          Hz      Magnetometer output data rate, None to power it down
+#   magMode         str     Magnetometer operating mode
+PROFILES = {
+    'off':      {'odr': 12.5,   'accRange': 8,  'gyrRange': 2000,   'highPerformance': False,   'magODR': None, 'magMode': 'low'},
+    'low':      {'odr': 26,     'accRange': 8,  'gyrRange': 500,    'highPerformance': False,   'magODR': 10,   'magMode': 'low'},
+    'normal':   {'odr': 104,    'accRange': 8,  'gyrRange': 1000,   'highPerformance': False,   'magODR': 10,   'magMode': 'medium'},
+    'high':     {'odr': 416,    'accRange': 8,  'gyrRange': 2000,   'highPerformance': True,    'magODR': 80,   'magMode': 'high'},
+}
+MAG_RANGE = 8           # Magnetometer full scale in gauss, the same for every profile
+
+activeProfile = None    # Name of the profile the IMU is set up with, None for initIMU()'s defaults
+
+# Fusion filter for each motionAlgorithm
+filters = {
+    'fast':     fusion.ComplementaryFilter(AA),
+    'accurate': fusion.KalmanFilter(Q_angle, Q_gyro, R_angle),
+    'ahrs':     fusion.MadgwickFilter(MADGWICK_BETA),
+}
 
 def init():
     for i in range(0, 5):       # Try a couple times to detect IMU
@@ -199,259 +106,317 @@ def init():
 
     IMU.initIMU()       #Initialise the accelerometer, gyroscope and compass
 
-#Setup the tables for the mdeian filter. Fill them all with '1' so we dont get devide by zero error
-acc_medianTable1X = [1] * ACC_MEDIANTABLESIZE
-acc_medianTable1Y = [1] * ACC_MEDIANTABLESIZE
-acc_medianTable1Z = [1] * ACC_MEDIANTABLESIZE
-acc_medianTable2X = [1] * ACC_MEDIANTABLESIZE
-acc_medianTable2Y = [1] * ACC_MEDIANTABLESIZE
-acc_medianTable2Z = [1] * ACC_MEDIANTABLESIZE
-mag_medianTable1X = [1] * MAG_MEDIANTABLESIZE
-mag_medianTable1Y = [1] * MAG_MEDIANTABLESIZE
-mag_medianTable1Z = [1] * MAG_MEDIANTABLESIZE
-mag_medianTable2X = [1] * MAG_MEDIANTABLESIZE
-mag_medianTable2Y = [1] * MAG_MEDIANTABLESIZE
-mag_medianTable2Z = [1] * MAG_MEDIANTABLESIZE
-
-# Set up time for first loop time calculation
-a = datetime.datetime.now() 
-def getValues(motionAlgorithm = 'accurate'):
-    """
-    motionAlgorithm determines whether to use complimentary filter or kalman filter to determine angles
-        'fast'      = CF filter
-        'accurate'  = Kalman filter
-    """
+    global activeProfile
+    global G_GAIN
+    activeProfile = None
+    G_GAIN = IMU.GYR_GAIN[2000]     # initIMU() sets 2000 dps
 
-    global acc_medianTable1X
-    global acc_medianTable1Y
-    global acc_medianTable1Z
-    global acc_medianTable2X
-    global acc_medianTable2Y
-    global acc_medianTable2Z
-    global mag_medianTable1X
-    global mag_medianTable1Y
-    global mag_medianTable1Z
-    global mag_medianTable2X
-    global mag_medianTable2Y
-    global mag_medianTable2Z
-
-    global a
-
-    gyroXangle = 0.0
-    gyroYangle = 0.0
-    gyroZangle = 0.0
-    angleX = 0.0
-    angleY = 0.0
-    angleZ = 0.0
-    kalmanX = 0.0
-    kalmanY = 0.0
-    
-    oldXMagRawValue = 0
-    oldYMagRawValue = 0
-    oldZMagRawValue = 0
-    oldXAccRawValue = 0
-    oldYAccRawValue = 0
-    oldZAccRawValue = 0
-
-
-    #Read the accelerometer,gyroscope and magnetometer values
-    ACCx = IMU.readACCx()
-    ACCy = IMU.readACCy()
-    ACCz = IMU.readACCz()
-    GYRx = IMU.readGYRx()
-    GYRy = IMU.readGYRy()
-    GYRz = IMU.readGYRz()
-    MAGx = IMU.readMAGx()
-    MAGy = IMU.readMAGy()
-    MAGz = IMU.readMAGz()
-
-
-    #Apply compass calibration
-    MAGx -= (magXmin + magXmax) /2
-    MAGy -= (magYmin + magYmax) /2
-    MAGz -= (magZmin + magZmax) /2
+    saved = calibration.load()
+    if saved is not None:           # Start with the known gyro bias so the filters don't have to learn it
+        applyCalibration(saved)
+    else:
+        print("No saved IMU calibration, run calibration.py")
 
+def applyCalibration(values):
+    """ Use a calibration from calibration.py """
+    global gyroBias
+    global magXmin, magYmin, magZmin
+    global magXmax, magYmax, magZmax
 
-    ##Calculate loop Period(LP). How long between Gyro Reads
-    b = datetime.datetime.now() - a
-    a = datetime.datetime.now()
-    LP = b.microseconds/(1000000*1.0)
-    # outputString = "Loop Time %5.2f " % ( LP )
-
-    ###############################################
-    #### Apply low pass filter ####
-    ###############################################
-    MAGx =  MAGx  * MAG_LPF_FACTOR + oldXMagRawValue*(1 - MAG_LPF_FACTOR);
-    MAGy =  MAGy  * MAG_LPF_FACTOR + oldYMagRawValue*(1 - MAG_LPF_FACTOR);
-    MAGz =  MAGz  * MAG_LPF_FACTOR + oldZMagRawValue*(1 - MAG_LPF_FACTOR);
-    ACCx =  ACCx  * ACC_LPF_FACTOR + oldXAccRawValue*(1 - ACC_LPF_FACTOR);
-    ACCy =  ACCy  * ACC_LPF_FACTOR + oldYAccRawValue*(1 - ACC_LPF_FACTOR);
-    ACCz =  ACCz  * ACC_LPF_FACTOR + oldZAccRawValue*(1 - ACC_LPF_FACTOR);
-
-    oldXMagRawValue = MAGx
-    oldYMagRawValue = MAGy
-    oldZMagRawValue = MAGz
-    oldXAccRawValue = ACCx
-    oldYAccRawValue = ACCy
-    oldZAccRawValue = ACCz
-
-    #########################################
-    #### Median filter for accelerometer ####
-    #########################################
-    # cycle the table
-    for x in range (ACC_MEDIANTABLESIZE-1,0,-1 ):
-        acc_medianTable1X[x] = acc_medianTable1X[x-1]
-        acc_medianTable1Y[x] = acc_medianTable1Y[x-1]
-        acc_medianTable1Z[x] = acc_medianTable1Z[x-1]
-
-    # Insert the lates values
-    acc_medianTable1X[0] = ACCx
-    acc_medianTable1Y[0] = ACCy
-    acc_medianTable1Z[0] = ACCz
-
-    # Copy the tables
-    acc_medianTable2X = acc_medianTable1X[:]
-    acc_medianTable2Y = acc_medianTable1Y[:]
-    acc_medianTable2Z = acc_medianTable1Z[:]
-
-    # Sort table 2
-    acc_medianTable2X.sort()
-    acc_medianTable2Y.sort()
-    acc_medianTable2Z.sort()
-
-    # The middle value is the value we are interested in
-    ACCx = acc_medianTable2X[int(ACC_MEDIANTABLESIZE/2)];
-    ACCy = acc_medianTable2Y[int(ACC_MEDIANTABLESIZE/2)];
-    ACCz = acc_medianTable2Z[int(ACC_MEDIANTABLESIZE/2)];
-
-
-
-    #########################################
-    #### Median filter for magnetometer ####
-    #########################################
-    # cycle the table
-    for x in range (MAG_MEDIANTABLESIZE-1,0,-1 ):
-        mag_medianTable1X[x] = mag_medianTable1X[x-1]
-        mag_medianTable1Y[x] = mag_medianTable1Y[x-1]
-        mag_medianTable1Z[x] = mag_medianTable1Z[x-1]
-
-    # Insert the latest values
-    mag_medianTable1X[0] = MAGx
-    mag_medianTable1Y[0] = MAGy
-    mag_medianTable1Z[0] = MAGz
-
-    # Copy the tables
-    mag_medianTable2X = mag_medianTable1X[:]
-    mag_medianTable2Y = mag_medianTable1Y[:]
-    mag_medianTable2Z = mag_medianTable1Z[:]
-
-    # Sort table 2
-    mag_medianTable2X.sort()
-    mag_medianTable2Y.sort()
-    mag_medianTable2Z.sort()
-
-    # The middle value is the value we are interested in
-    MAGx = mag_medianTable2X[int(MAG_MEDIANTABLESIZE/2)];
-    MAGy = mag_medianTable2Y[int(MAG_MEDIANTABLESIZE/2)];
-    MAGz = mag_medianTable2Z[int(MAG_MEDIANTABLESIZE/2)];
-
-
-    #Convert Gyro raw to degrees per second
-    rate_gyr_x =  GYRx * G_GAIN
-    rate_gyr_y =  GYRy * G_GAIN
-    rate_gyr_z =  GYRz * G_GAIN
+    gyroBias = list(values['gyroBias'])
+    magXmin, magYmin, magZmin = values['magMin']
+    magXmax, magYmax, magZmax = values['magMax']
 
+def setProfile(name):
+    """
+    Reconfigure the IMU with one of PROFILES, keeping G_GAIN and the FIFO rate in step with it
+    Returns the profile
+    """
+    global activeProfile
+    global G_GAIN
 
-    #Calculate the angles from the gyro.
-    gyroXangle+=rate_gyr_x*LP
-    gyroYangle+=rate_gyr_y*LP
-    gyroZangle+=rate_gyr_z*LP
+    profile = PROFILES[name]
+    if name == activeProfile:
+        return profile
 
+    if fifoODR:                 # Samples already in the FIFO were taken with the old gyro range -- drop them
+        IMU.disableFIFO()
 
+    IMU.configureAccGyr(profile['odr'], profile['accRange'], profile['gyrRange'], profile['highPerformance'])
+    IMU.configureMag(profile['magODR'], MAG_RANGE, profile['magMode'])
+    G_GAIN = IMU.GYR_GAIN[profile['gyrRange']]
 
-    #Convert Accelerometer values to degrees
-    AccXangle =  (math.atan2(ACCy,ACCz)+M_PI)*RAD_TO_DEG
-    AccYangle =  (math.atan2(ACCz,ACCx)+M_PI)*RAD_TO_DEG
-    AccZangle =  (math.atan2(ACCx,ACCy)+M_PI)*RAD_TO_DEG
+    if fifoODR:                 # The FIFO can't store samples faster than they're measured
+        startFIFO(profile['odr'], fifoWatermark)
 
-    # Set values to 0,0 when device is upright
-    AccYangle -= 180.0
-    AccZangle -= 270.0
+    activeProfile = name
+    return profile
 
-    if motionAlgorithm == 'fast':
-        #Complementary filter used to combine the accelerometer and gyro values.
-        angleX = AA*(angleX+rate_gyr_x*LP) +(1 - AA) * AccXangle
-        angleY = AA*(angleY+rate_gyr_y*LP) +(1 - AA) * AccYangle
-        angleZ = AA*(angleZ+rate_gyr_z*LP) +(1 - AA) * AccZangle
+# Set up time for loop time calculation
+lastSampleTime = None                   # time.perf_counter_ns() of the previous sample
+loopStats = rolling.TimingStats(1000)   # Loop period statistics over the last 1000 samples
 
-        # Map ranges from +/- 50 to +/- 90
-        oldRange = 100
-        newRange = 180
+def markSampleTime():
+    """
+    Timestamp a new sample with the monotonic clock
+    Returns (timestamp in ns, seconds since the previous sample)
+    """
+    global lastSampleTime
 
-        angleX = (((angleX - (-50)) * newRange) / oldRange) + (-90)
-        angleY = (((angleY - (-50)) * newRange) / oldRange) + (-90)
-        angleZ = (((angleZ - (-50)) * newRange) / oldRange) + (-90)
+    now = time.perf_counter_ns()
+    if lastSampleTime is None:  # First sample, nothing to measure against
+        LP = 0.0
+    else:
+        LP = (now - lastSampleTime) / 1000000000
+        loopStats.update(LP)
+    lastSampleTime = now
 
-    elif motionAlgorithm == 'accurate':
-        #Kalman filter used to combine the accelerometer and gyro values.
-        angleX = kalmanFilterY(AccYangle, rate_gyr_y,LP)
-        angleY = kalmanFilterX(AccXangle, rate_gyr_x,LP)
-        angleZ = kalmanFilterZ(AccZangle, rate_gyr_z,LP)
+    return now, LP
 
-    #Calculate heading
-    heading = 180 * math.atan2(MAGy,MAGx)/M_PI
+def getValues(motionAlgorithm = 'accurate'):
+    """
+    motionAlgorithm determines whether to use complimentary filter or kalman filter to determine angles
+        'fast'      = CF filter
+        'accurate'  = Kalman filter
+        'ahrs'      = Madgwick quaternion AHRS
+    A fusion.FusionFilter instance can also be passed to use (and update) that filter instead
+    The magnetometer is only read if its values or the heading are asked for with resolveChannels()
 
-    #Only have our heading between 0 and 360
-    if heading < 0:
-        heading += 360
+    Returns an IMUSample, which can be used like a dict
+    """
+    return imuPipeline.process([readSample(motionAlgorithm)])[0]
 
+def readSample(motionAlgorithm = 'accurate'):
+    """ Read the accelerometer and gyro into a raw IMUSample, ready for imuPipeline """
+    #Read the accelerometer and gyroscope values
+    ACCx, ACCy, ACCz, GYRx, GYRy, GYRz = IMU.readACCGYR()  # One burst read for accelerometer and gyro
 
+    ##Calculate loop Period(LP). How long between Gyro Reads
+    timestamp, LP = markSampleTime()
 
+    return rawSample(ACCx, ACCy, ACCz, GYRx, GYRy, GYRz, LP, motionAlgorithm, timestamp)
 
+def samples(motionAlgorithm = 'accurate'):
+    """
+    Pipeline source: a function returning the next batch of raw IMUSamples -- a FIFO batch in FIFO mode, otherwise one polled sample
+    motionAlgorithm may be a function returning it, to follow changes between batches
+    """
+    def source():
+        algorithm = motionAlgorithm() if callable(motionAlgorithm) else motionAlgorithm
+        if fifoODR:
+            return readBatch(algorithm)
+        return [readSample(algorithm)]
+    return source
+
+############### FIFO mode #################
+# Instead of polling one sample at a time, let the LSM6DSL buffer samples at a
+# fixed rate and drain them in bulk -- the filters see evenly spaced samples and
+# we only wake up once per batch
+
+fifoODR = None          # FIFO sample rate in Hz, None when FIFO mode is off
+fifoWatermark = 16      # Number of samples per batch
+fifoOverruns = 0        # Number of times the FIFO filled up before we drained it
+
+def startFIFO(odr=104, watermark=16):
+    """ Switch the IMU to FIFO mode """
+    global fifoODR
+    global fifoWatermark
+
+    IMU.initFIFO(odr, watermark)
+    fifoODR = odr
+    fifoWatermark = watermark
+
+def stopFIFO():
+    """ Switch the IMU back to polled mode """
+    global fifoODR
+
+    IMU.disableFIFO()
+    fifoODR = None
+
+def getBatch(odr=None):
+    """
+    Drain whatever complete samples the FIFO holds, without waiting for the watermark --
+    the scheduler paces the reads at the batch rate, on its own clock rather than the IMU's,
+    so a read can come a little early and must not block the other tasks
+    odr is the FIFO rate the batch was configured with -- default fifoODR, read once, since
+    stopFIFO() may run on another thread
+    Returns a list of (timestamp, ACCx, ACCy, ACCz, GYRx, GYRy, GYRz), oldest first -- empty if nothing is ready yet
+    timestamp is a time.perf_counter_ns() value, back-dated from the drain time using the FIFO rate
+    """
+    global fifoOverruns
 
-    ####################################################################
-    ###################Tilt compensated heading#########################
-    ####################################################################
-    #Normalize accelerometer raw values.
-    accXnorm = ACCx/math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
-    accYnorm = ACCy/math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
+    if odr is None:
+        odr = fifoODR
+    if not odr:                                 # FIFO mode was switched off
+        return []
 
+    unreadWords, watermarkReached, overrun, pattern = IMU.readFIFOStatus()
+    if unreadWords < IMU.FIFO_SAMPLE_WORDS:     # Not a whole sample yet
+        return []
 
-    #Calculate pitch and roll
-    pitch = math.asin(accXnorm)
-    try:
-        roll = -math.asin(accYnorm/math.cos(pitch))
-    except ValueError as e:
-        roll = 0
-        print("Roll Calculation Error")
-        # If this fucks up disconnect and reconnect the ground wire on the IMU
-        # TODO: maybe add a catch that reboots the collar? seems overkill, can we kill and revive the line or something?
-        # I'm thinking a transistor on a gpio pin + 5v line going into berryimu? or is this dumb
+    drainTime = time.perf_counter_ns()
+    samples, overrun = IMU.readFIFO()
+    if overrun:                         # We fell behind and the oldest samples were overwritten
+        fifoOverruns += 1
+        print("IMU FIFO overrun, samples lost")
 
+    period = 1000000000 / odr
+    last = len(samples) - 1
+    return [(drainTime - int((last - i) * period),) + sample for i, sample in enumerate(samples)]
 
-    #Calculate the new tilt compensated values
-    #The compass and accelerometer are orientated differently on the the BerryIMUv1, v2 and v3.
-    #This needs to be taken into consideration when performing the calculations
+def fifoBatches():
+    """ Generator yielding batches from getBatch() for as long as FIFO mode is on """
+    while fifoODR:
+        yield getBatch()
 
-    #X compensation
-    magXcomp = MAGx*math.cos(pitch)+MAGz*math.sin(pitch)
+def readBatch(motionAlgorithm = 'accurate'):
+    """ Drain one FIFO batch into raw IMUSamples, ready for imuPipeline """
+    odr = fifoODR                   # Read once -- stopFIFO() may run on another thread
+    if not odr:
+        return []
+    LP = 1 / odr
 
-    #Y compensation
-    magYcomp = MAGx*math.sin(roll)*math.sin(pitch)+MAGy*math.cos(roll)-MAGz*math.sin(roll)*math.cos(pitch)
+    batch = [rawSample(ACCx, ACCy, ACCz, GYRx, GYRy, GYRz, LP, motionAlgorithm, timestamp)
+             for timestamp, ACCx, ACCy, ACCz, GYRx, GYRy, GYRz in getBatch(odr)]
 
+    if batch:
+        markSampleTime()    # Loop statistics track the time between batches in FIFO mode
 
-    #Calculate tilt compensated heading
-    tiltCompensatedHeading = 180 * math.atan2(magYcomp,magXcomp)/M_PI
+    return batch
+
+def getBatchValues(motionAlgorithm = 'accurate'):
+    """
+    Drain one FIFO batch and run every sample through the filters
+    The magnetometer isn't in the FIFO, so each sample reads it at drain time if resolveChannels() asks for it
+    Returns a list of IMUSamples like getValues(), oldest first
+    """
+    return imuPipeline.process(readBatch(motionAlgorithm))
+############### END FIFO mode #################
 
-    if tiltCompensatedHeading < 0:
-        tiltCompensatedHeading += 360
+def startDataReady():
+    """ Pulse INT1 as each sample is ready, at the active profile's output data rate """
+    IMU.enableDataReadyInterrupt()
 
+def stopDataReady():
+    """ Stop the data-ready interrupt """
+    IMU.disableDataReadyInterrupt()
 
-    ##################### END Tilt Compensation ########################
+def filterMag(MAGx, MAGy, MAGz):
+    """ Calibrate and filter one raw magnetometer reading """
+    sample = magPipeline.process([{'MagX': MAGx, 'MagY': MAGy, 'MagZ': MAGz}])[0]
+    return sample['MagX'], sample['MagY'], sample['MagZ']
 
+class IMUSample(dict):
+    """
+    One set of IMU values, as returned by getValues()
+    A dict whose magnetometer values and everything derived from them (headings, pitch/roll)
+    are only read and calculated the first time one of those keys is looked up with [], then kept --
+    modes that never look at heading never touch the magnetometer
+    Lazy keys aren't in the dict (iteration, get(), in) until they've been looked up
+    Once the pipeline has sealed the sample the magnetometer is never read for it: a reading taken
+    later, on whatever thread looked, would go with the wrong sample -- its values are NaN instead
+    """
+    __slots__ = ('rawMag', 'sealed')
+
+    # Keys that are calculated on first access, and the method that calculates each
+    LAZY_KEYS = {
+        'MagX':                     '_deriveMag',
+        'MagY':                     '_deriveMag',
+        'MagZ':                     '_deriveMag',
+        'accXnorm':                 '_deriveTilt',
+        'accYnorm':                 '_deriveTilt',
+        'pitch':                    '_deriveTilt',
+        'roll':                     '_deriveTilt',
+        'heading':                  '_deriveHeading',
+        'tiltCompensatedHeading':   '_deriveHeading',
+    }
 
-    # Package and return everything as a tidy dict
-    return {
+    def __init__(self, values, rawMag=None):
+        """
+        values      dict    Values that were calculated up front
+        rawMag      tuple   Raw magnetometer reading taken with the sample, or None to read it on first use
+        """
+        super(IMUSample, self).__init__(values)
+        self.rawMag = rawMag
+        self.sealed = False     # Set by the pipeline, after resolving the lazy keys asked for
+
+    def __missing__(self, key):
+        getattr(self, self.LAZY_KEYS[key])()    # Raises KeyError for unknown keys, like a dict
+        return dict.__getitem__(self, key)
+
+    def __repr__(self):
+        return f"IMUSample({dict.__repr__(self)})"
+
+    def _deriveMag(self):
+        if self.rawMag is None:
+            if self.sealed:                 # Not read with the sample, and too late to now
+                self['MagX'] = self['MagY'] = self['MagZ'] = math.nan
+                return
+            self.rawMag = IMU.readMAG()     # Read the magnetometer now that someone needs it
+        self['MagX'], self['MagY'], self['MagZ'] = filterMag(*self.rawMag)
+
+    def _deriveTilt(self):
+        ACCx, ACCy, ACCz = self['AccX'], self['AccY'], self['AccZ']
+
+        #Normalize accelerometer raw values.
+        accNorm = math.sqrt(ACCx * ACCx + ACCy * ACCy + ACCz * ACCz)
+        accXnorm = ACCx/accNorm
+        accYnorm = ACCy/accNorm
+
+        #Calculate pitch and roll
+        pitch = math.asin(accXnorm)
+        try:
+            roll = -math.asin(accYnorm/math.cos(pitch))
+        except ValueError as e:
+            roll = 0
+            print("Roll Calculation Error")
+            # If this fucks up disconnect and reconnect the ground wire on the IMU
+            # TODO: maybe add a catch that reboots the collar? seems overkill, can we kill and revive the line or something?
+            # I'm thinking a transistor on a gpio pin + 5v line going into berryimu? or is this dumb
+
+        self['accXnorm'] = accXnorm
+        self['accYnorm'] = accYnorm
+        self['pitch'] = pitch
+        self['roll'] = roll
+
+    def _deriveHeading(self):
+        MAGx, MAGy, MAGz = self['MagX'], self['MagY'], self['MagZ']
+        pitch, roll = self['pitch'], self['roll']
+
+        #Calculate heading
+        heading = 180 * math.atan2(MAGy,MAGx)/M_PI
+
+        #Only have our heading between 0 and 360
+        if heading < 0:
+            heading += 360
+
+        ####################################################################
+        ###################Tilt compensated heading#########################
+        ####################################################################
+        #The compass and accelerometer are orientated differently on the the BerryIMUv1, v2 and v3.
+        #This needs to be taken into consideration when performing the calculations
+
+        #X compensation
+        magXcomp = MAGx*math.cos(pitch)+MAGz*math.sin(pitch)
+
+        #Y compensation
+        magYcomp = MAGx*math.sin(roll)*math.sin(pitch)+MAGy*math.cos(roll)-MAGz*math.sin(roll)*math.cos(pitch)
+
+        #Calculate tilt compensated heading
+        tiltCompensatedHeading = 180 * math.atan2(magYcomp,magXcomp)/M_PI
+
+        if tiltCompensatedHeading < 0:
+            tiltCompensatedHeading += 360
+
+        ##################### END Tilt Compensation ########################
+
+        self['heading'] = heading
+        self['tiltCompensatedHeading'] = tiltCompensatedHeading
+
+def rawSample(ACCx, ACCy, ACCz, GYRx, GYRy, GYRz, LP, motionAlgorithm = 'accurate', timestamp = None, rawMag = None):
+    """ IMUSample of raw readings, before imuPipeline """
+    return IMUSample({
+        'timestamp': timestamp,
         'loopTime': LP,
 
         'motionAlgorithm': motionAlgorithm,
@@ -460,21 +425,95 @@ def getValues(motionAlgorithm = 'accurate'):
         'AccY': ACCy,
         'AccZ': ACCz,
 
-        'AccXangle': AccXangle,
-        'AccYangle': AccYangle,
-        'AccZangle': AccZangle,
+        'gyroXraw': GYRx,
+        'gyroYraw': GYRy,
+        'gyroZraw': GYRz,
+    }, rawMag)
 
-        'gyroXangle': gyroXangle,
-        'gyroYangle': gyroYangle,
-        'gyroZangle': gyroZangle,
+def deriveAngles(sample):
+    """ Angles from the accelerometer, and gyro movement since the previous sample """
+    ACCx, ACCy, ACCz = sample['AccX'], sample['AccY'], sample['AccZ']
+    LP = sample['loopTime']
 
-        'angleX': angleX,
-        'angleY': angleY,
-        'angleZ': angleZ,
+    #Calculate the angles from the gyro.
+    sample['gyroXangle'] = sample['gyroXrate'] * LP
+    sample['gyroYangle'] = sample['gyroYrate'] * LP
+    sample['gyroZangle'] = sample['gyroZrate'] * LP
 
-        'heading': heading,
-        'tiltCompensatedHeading': tiltCompensatedHeading,
-    }
+    #Convert Accelerometer values to degrees
+    AccXangle =  (math.atan2(ACCy,ACCz)+M_PI)*RAD_TO_DEG
+    AccYangle =  (math.atan2(ACCz,ACCx)+M_PI)*RAD_TO_DEG
+    AccZangle =  (math.atan2(ACCx,ACCy)+M_PI)*RAD_TO_DEG
+
+    # Set values to 0,0 when device is upright
+    AccYangle -= 180.0
+    AccZangle -= 270.0
+
+    sample['AccXangle'] = AccXangle
+    sample['AccYangle'] = AccYangle
+    sample['AccZangle'] = AccZangle
 
-    # #slow program down a bit, makes the output more readable
-    # time.sleep(0.03)
+def selectFilter(sample):
+    """ Fusion filter for a sample's motionAlgorithm """
+    motionAlgorithm = sample['motionAlgorithm']
+    if isinstance(motionAlgorithm, fusion.FusionFilter):
+        return motionAlgorithm
+    return filters[motionAlgorithm]
+
+def magOffsets():
+    """ Hard-iron offsets from the compass calibration """
+    return [(magXmin + magXmax) / 2, (magYmin + magYmax) / 2, (magZmin + magZmax) / 2]
+
+resolvedChannels = ()   # Lazy IMUSample keys the pipeline calculates with each sample -- see resolveChannels()
+
+def resolveChannels(channels):
+    """
+    Have the pipeline calculate those of channels that are lazy IMUSample keys with each sample,
+    so the magnetometer is read alongside the accelerometer and gyro, by the thread reading the IMU
+    Lazy keys not asked for are left out -- the magnetometer ones read as NaN
+    """
+    global resolvedChannels
+    resolvedChannels = tuple(channel for channel in channels if channel in IMUSample.LAZY_KEYS)
+
+def resolveLazy(sample):
+    """ Calculate the lazy keys asked for, then seal the sample against later magnetometer reads """
+    for channel in resolvedChannels:
+        sample[channel]
+    sample.sealed = True
+
+ACC_CHANNELS = ('AccX', 'AccY', 'AccZ')
+MAG_CHANNELS = ('MagX', 'MagY', 'MagZ')
+
+# The low pass filters have always restarted from 0 every sample, which amounts to scaling by the LPF factor --
+# kept as that (with Calibrate) so angles and recorded values don't change
+
+# Raw accelerometer and gyro readings -> IMU values and angles
+# The medians start filled with '1' so we dont get devide by zero error
+imuPipeline = pipeline.Pipeline([
+    pipeline.Calibrate(ACC_CHANNELS, gain=ACC_LPF_FACTOR, name='accLPF'),
+    pipeline.Median(ACC_CHANNELS, ACC_MEDIANTABLESIZE, name='accMedian'),
+    pipeline.Calibrate(                                                             # Gyro raw to degrees per second, less the calibrated bias
+        ('gyroXraw', 'gyroYraw', 'gyroZraw'), ('gyroXrate', 'gyroYrate', 'gyroZrate'),
+        gain=lambda: G_GAIN, offset=lambda: gyroBias, name='gyroCalibrate'),
+    pipeline.Derive(deriveAngles),
+    pipeline.Fuse(selectFilter),                                                    # Combine the accelerometer and gyro values with the selected fusion filter
+    pipeline.Derive(resolveLazy),                                                   # Read the magnetometer now if it's wanted, on the IMU's thread
+])
+
+# Raw magnetometer readings -> calibrated and filtered, run lazily by IMUSample
+magPipeline = pipeline.Pipeline([
+    pipeline.Calibrate(MAG_CHANNELS, offset=magOffsets, name='magCalibrate'),
+    pipeline.Calibrate(MAG_CHANNELS, gain=MAG_LPF_FACTOR, name='magLPF'),
+    pipeline.Median(MAG_CHANNELS, MAG_MEDIANTABLESIZE, name='magMedian'),
+])
+
+def processValues(ACCx, ACCy, ACCz, GYRx, GYRy, GYRz, MAGx, MAGy, MAGz, LP, motionAlgorithm = 'accurate', timestamp = None):
+    """
+    Filter one set of raw IMU readings and calculate angles
+    MAGx, MAGy, MAGz may be None to read the magnetometer only if resolveChannels() asks for it
+    LP is the time in seconds since the previous set of readings
+    timestamp is the time.perf_counter_ns() at which the readings were captured
+    Returns an IMUSample
+    """
+    rawMag = None if MAGx is None else (MAGx, MAGy, MAGz)
+    return imuPipeline.process([rawSample(ACCx, ACCy, ACCz, GYRx, GYRy, GYRz, LP, motionAlgorithm, timestamp, rawMag)])[0]
@@ -1,18 +1,28 @@
 import os
 import subprocess
-import random
 import csv
-from threading import Thread, Event, Timer
+import sys
+import atexit
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
 import time
-import datetime
+import math
 import statistics
 
 from flask import Flask, request, abort, redirect, render_template  # Flask
 from flask_socketio import SocketIO, emit                           # Flask-SocketIO
 
 import battery
-import imu
+import berryimu
+import bus
 import mic
+import pacer
+import rolling
+import rules
+import safety
+import scheduler
+import timers
 import buzzer
 import radio as r
 import wifi
@@ -35,9 +45,35 @@ thread = Thread()
 thread_stop_event = Event()
 
 # Init global variables
-punishmentRequests = {}     # Create empty container for punishment requests
-requestPunishment = False   # [Obsolete] If not False, signal to punish and reason we are punishing TODO: delete
-requestBeep = None          # If not None, what beep pattern to play
+radioLatency = rolling.TimingStats(100)     # Seconds from a punishment request to the radio transmitting
+loopLag = rolling.TimingStats(100)          # Seconds late the event loop wakes a coroutine, in the asyncio runtime
+modeTimeout = None          # Timer handle that switches the mode off, if the mode was set with a timeout
+safetyCore = None           # safety.SafetyCore, when the device runs in its own process
+
+IMU_CHANNELS = [            # Channels of each IMU sample
+    'timestamp',
+    'loopTime',
+    'AccX',
+    'AccY',
+    'AccZ',
+    'AccXangle',
+    'AccYangle',
+    'AccZangle',
+    'gyroXangle',
+    'gyroYangle',
+    'gyroZangle',
+    'gyroXrate',
+    'gyroYrate',
+    'gyroZrate',
+    'MagX',
+    'MagY',
+    'MagZ',
+    'angleX',
+    'angleY',
+    'angleZ',
+    'heading',
+    'tiltCompensatedHeading',
+]
 
 class EdgeDetector:
     """ Detects false/true transitions on an external signal"""
@@ -81,43 +117,46 @@ class PunishmentTimer:
             self.seconds = seconds - 3
         else: self.seconds = 3                              # No timers shorter than 3 seconds
 
-        # Set up threaded timer
-        self.timer = Timer(self.seconds, self.doWarning)  # After (seconds - 3) seconds, play a warning sound -- 3 seconds later, punishment will occur
-        self.timer.start()
+        # Set up timer on the shared timer thread
+        self.cancelled = False
+        self.timer = timers.schedule(self.seconds, self.doWarning)  # After (seconds - 3) seconds, play a warning sound -- 3 seconds later, punishment will occur
 
     def doWarning(self):
         """ play warning sound, then wait 3 seconds and shock """
-        # Need visibility of audio
-        global requestBeep
-
-        requestBeep = 'warning'
-        self.timer = Timer(3, self.doPunishment)  # After 3 seconds, do punishment
-        self.timer.start()
+        if self.cancelled:  # Cancelled just as the warning came due
+            return
+        bus.publish('beep', sound='warning')
+        self.timer = timers.schedule(3, self.doPunishment)  # After 3 seconds, do punishment
 
     def doPunishment(self):
-        # Need visibility of audio and punishment
-        global requestPunishment
-        global requestBeep
-        
-        requestBeep = 'noncompliant'
-        requestPunishment = self.punishmentSource
+        if self.cancelled:
+            return
+        bus.publish('beep', sound='noncompliant')
+        bus.publish('punishmentPulse', source=self.punishmentSource, cycles=1)  # One punishment cycle
 
         # TODO: add bool to make punishment perpetual unless cancel() is called
 
     def cancel(self):
+        self.cancelled = True
         self.timer.cancel()
 
 class Sensor:
     """
     Defines and contains a sensor and its values
     """
-    def __init__(self, name, updateFunction, sensorData, historyLength=20):
+    def __init__(self, name, updateFunction, sensorData, historyLength=20, lazyChannels=None):
         """
         name            str     Human-readable name for the sensor to be displayed in the debug backend
-        updateFunction  func    Function to call to update the sensor data: data are expected as a dict with keys matching sensorData
+        updateFunction  func    Function to call to update the sensor data: data are expected as a dict with keys matching sensorData,
+                                or a list of them, oldest first, when the sensor delivers samples in batches
         sensorData      list    List of keys for recalling sensor data
         historyLength   int     Amount of historical data captures to store 
-        history         list    last historyLength captures for sensorData
+        history         RingBuffer  last historyLength captures for sensorData, one column per channel --
+                                    use history.window() and history.mean()/var()/min()/max() for recent values
+        lazyChannels    list    Keys of sensorData that are expensive to get -- only copied while motion capture is on,
+                                otherwise look them up on latest when needed
+        latest          dict    The most recent data returned by updateFunction
+        batch           list    Every sample from the last read, oldest first
         """
         self.name = name
         self.updateFunction = updateFunction
@@ -126,25 +165,52 @@ class Sensor:
         for channel in sensorData: 
             self.sensorData[channel] = None  # Add sensor data keys to dict
 
+        if lazyChannels is None:
+            lazyChannels = []
+        self.lazyChannels = lazyChannels
+        self.eagerChannels = [channel for channel in sensorData if channel not in lazyChannels]
+        self.latest = None
+        self.batch = []
+
         self.historyLength = historyLength
-        self.history = []
+        self.history = rolling.RingBuffer(historyLength, sensorData)
 
     def read(self):
-        newData = self.updateFunction()             # Get new data from the sensor
-        for k in self.sensorData.keys():
-            self.sensorData[k] = newData[k]         # Update sensor data in records
-        
-        socketio.emit(f"sensor_{self.name}", self.sensorData, namespace='/control') # Emit sensor data to server for debug
+        """ Take a reading. Returns whether there was new data """
+        if self.updateFunction is None:             # Sensor isn't hooked up yet
+            return False
 
-        self.history.append(self.sensorData)        # Add current sensor data to value history
-        if len(self.history) > self.historyLength:  # If the number of values saved is over historyLength
-            del self.history[0]                     # Delete the oldest value
+        newData = self.updateFunction()             # Get new data from the sensor -- in FIFO mode, every sample of the batch
+        if newData is None:                         # Nothing new yet -- e.g. the FIFO had no samples
+            return False
+        self.batch = newData if isinstance(newData, list) else [newData]
+        self.latest = self.batch[-1]
+
+        moCap = app.config['moCap']
+        if moCap:                                   # Capture every channel for the motion snapshot
+            channels = self.sensorData.keys()
+        else:                                       # Otherwise skip the expensive ones
+            channels = self.eagerChannels
+        rows = []
+        for sample in self.batch:
+            for k in channels:
+                self.sensorData[k] = sample[k]      # Update sensor data in records
+            self.history.push(self.sensorData, channels) # Add each sample to value history -- channels we skipped are NaN
+            if moCap:
+                rows.append(dict(self.sensorData))
+        
+        socketio.emit(f"sensor_{self.name}", self.sensorData, namespace='/control') # Emit the newest sensor data to server for debug
 
         # Motion snapshot
-        if app.config['moCap']:                                             # If motion logging enabled
+        if moCap:                                                           # If motion logging enabled
+            newFile = not os.path.exists(f'{self.name}.csv')
             with open(f'{self.name}.csv', 'a', newline='') as file:         # Log motion
                 writer = csv.DictWriter(file, list(self.sensorData.keys()))
-                writer.writerow(self.sensorData)
+                if newFile:
+                    writer.writeheader()                                    # Start a new log with the channel names
+                writer.writerows(rows)
+
+        return True
 
 # Init config
 # TODO: Most globals will slowly be ported over to here as I get around to it
@@ -162,7 +228,27 @@ app.config.update(
     startupChime =      True,                   # Whether to play a beep at launch to let the user know the device is ready to connect
 
     emitMotionData =    True,                   # Whether to send motion values to debug page
-    motionAlgorithm =   'fast',                 # Algorithm used to calculate device rotation -- can be 'fast' or 'accurate'
+    motionAlgorithm =   'fast',                 # Algorithm used to calculate device rotation -- can be 'fast', 'accurate' or 'ahrs'
+    imuFIFO =           False,                  # Whether to batch IMU samples in the LSM6DSL's FIFO instead of polling one at a time
+    imuFIFOWatermark =  16,                     # Number of FIFO samples to collect before draining them as a batch
+    imuProfiles = {                             # IMU sensor profile (see berryimu.PROFILES) for each mode -- sets the sample rate
+        'off':      'off',
+        'random':   'low',
+        'sleepDep': 'low',
+        'pet':      'normal',
+        'posture':  'normal',
+        'freeze':   'normal',
+        'fitness':  'high',
+    },
+    imuInterruptPin =   None,                   # Board pin wired to the LSM6DSL INT1 (data ready) -- None to pace the polling on a timer instead
+    fitnessExercise =   'situps',               # Exercise fitness mode counts reps of -- see reps.EXERCISES
+    complianceRate =    20,                     # Compliance tests per second, each over the IMU samples since the last --
+                                                #   decisions lag by up to 1/complianceRate s (see rules.py). None to test every sample
+    batteryRate =       4,                      # Battery checks per second
+    micRate =           20,                     # Microphone reads per second -- each read analyses the newest mic.CHUNK_SIZE samples
+    micDevice =         None,                   # sounddevice input device for the microphone, None for the default
+    micWAV =            None,                   # WAV file to play through the microphone sensor instead, for testing without a sound card
+    runtime =           'threads',              # 'threads', or 'asyncio' when started with --asyncio
 )
 
 # ooooooooooooo oooo                                           .o8           
@@ -177,60 +263,116 @@ app.config.update(
 class radioThread(Thread):
     def __init__(self):
         self.safetyLimit = 10               # Number of punishment cycles until emergency auto-off
+        self.keepalivePeriod = 120          # Seconds between keepalive flashes
 
         self.radio = r.Radio()                   # Initialize radio
+        self.events = bus.subscribe('punishment', 'punishmentPulse', 'keepalive')  # Subscribe before anything's published, so nothing is missed
+
+        self.channels = {}                  # Punishment channels, {source: active}
+        self.pulses = []                    # Sources of the one-off punishment cycles still to send
+        self.punishmentCycles = 0           # Keep track of how many punishment transmissions we've sent
+        self.requestTime = None             # When punishment was requested, until it's been transmitted
+        self.reportedCompliance = None      # Compliance last sent to the web client
 
         super(radioThread, self).__init__()
 
-    def waitLoop(self):
-        global punishmentRequests                   # Get visibility of punishment requests container
+    def timeout(self):
+        """ Seconds to wait for events: none if we're mid-punishment, otherwise long enough to notice the stop event now and then """
+        punishing = self.pulses or (any(self.channels.values()) and self.punishmentCycles < self.safetyLimit)
+        return 0 if punishing else 1
+
+    def update(self, events):
+        """
+        Act on the events since the last update
+        Returns what to transmit as (waveID, seconds), or None
+        """
+        keepalive = False
+        for event in events:
+            if event.topic == 'punishment':
+                self.channels[event.source] = event.active
+                if event.active and self.requestTime is None:
+                    self.requestTime = event.time
+            elif event.topic == 'punishmentPulse':
+                self.pulses += [event.source] * event.cycles
+                if self.requestTime is None:
+                    self.requestTime = event.time
+            elif event.topic == 'keepalive':
+                keepalive = True
+
+        punishmentSource = [source for source, active in self.channels.items() if active]  # Find the source of the punishment request
+
+        # Punish if requested
+        if punishmentSource or self.pulses:                 # If any punishment request channel is set to True
+            if self.punishmentCycles >= self.safetyLimit:   # Past the safety limit -- one-off cycles are dropped too
+                self.pulses = []
+                self.requestTime = None
+                return None
+
+            if app.config['safetyMode']:            # If safety mode is enabled
+                punishmentMode = 3                  # Set punishment mode to vibrate
+            else:                                   # Otherwise,
+                punishmentMode = 4                  # Set punishment mode to shock
+
+            sequence = self.radio.makeSequence(punishmentMode, app.config['punishmentIntensity'])   # Create punishment data sequence
+            waveID = self.radio.makeWaveform(sequence)  # Make waveform from data sequence
+            if self.requestTime is not None:            # First transmission since the request -- how long did it take?
+                radioLatency.update(time.perf_counter() - self.requestTime)
+                self.requestTime = None
+
+            self.punishmentCycles += 1                  # Increment punishment cycles
+            socketio.emit('safetyPunishmentCycles', {   # Emit punishment cycles to web client
+                'punishmentCycles': self.punishmentCycles,
+            }, namespace='/control')
 
-        punishmentCycles = 0                        # Keep track of how many punishment transmissions we've sent
+            socketio.emit('compliance', {                                                       # Emit punishment info to web client
+                'compliance': False,
+                'punishmentSource': punishmentSource or self.pulses[:1],
+            }, namespace='/control')
+            self.reportedCompliance = False
+            if self.pulses:
+                self.pulses.pop(0)
+            return waveID, 1                            # Transmit waveform
+
+        # If there are no punishment requests
+        self.punishmentCycles = 0               # Reset punishment cycles counter
+
+        if self.reportedCompliance is not True:
+            socketio.emit('compliance', {       # Emit compliance to web client
+                'compliance': True,
+                'punishmentSource': None,
+            }, namespace='/control')
+            self.reportedCompliance = True
+
+        # Stop the shock unit from going into sleep mode by periodically flashing the LED
+        # We want to ping every two minutes
+        # Unless we're already transmitting a punishment
+        if keepalive:                                                   # Published by the keepalive timer
+            KAsequence = self.radio.makeSequence(txMode=1, txPower=10)  # Create flash sequence
+            KAwaveID = self.radio.makeWaveform(KAsequence)              # Create flash wave
+            return KAwaveID, 0.5                                        # Transmit flash
+        return None
+
+    def waitLoop(self):
         while not thread_stop_event.isSet():
-            # Punish if requested
-            if True in punishmentRequests.values():         # If any punishment request channel is set to True
-                if punishmentCycles < self.safetyLimit:     # If we're within safety limits
-                    if app.config['safetyMode']:            # If safety mode is enabled
-                        punishmentMode = 3                  # Set punishment mode to vibrate
-                    else:                                   # Otherwise,
-                        punishmentMode = 4                  # Set punishment mode to shock
-
-                    sequence = self.radio.makeSequence(punishmentMode, app.config['punishmentIntensity'])   # Create punishment data sequence
-                    waveID = self.radio.makeWaveform(sequence)  # Make waveform from data sequence
-                    self.radio.transmit(waveID)                 # Transmit waveform
-
-                punishmentCycles += 1                           # Increment punishment cycles
-                socketio.emit('safetyPunishmentCycles', {       # Emit punishment cycles to web client
-                    'punishmentCycles': punishmentCycles,
-                }, namespace='/control')
-
-                punishmentSource = [key for key,value in punishmentRequests.items() if value==True] # Find the source of the punishment request
-                socketio.emit('compliance', {                                                       # Emit punishment info to web client
-                    'compliance': False,
-                    'punishmentSource': punishmentSource,
-                }, namespace='/control')
-            else:                                   # If there are no punishment requests
-                punishmentCycles = 0                # Reset punishment cycles counter
-
-                socketio.emit('compliance', {       # Emit compliance to web client
-                    'compliance': True,
-                    'punishmentSource': None,
-                }, namespace='/control')
-                
-                # Stop the shock unit from going into sleep mode by periodically flashing the LED
-                # We want to ping every two minutes on the first second
-                # Unless we're already transmitting a punishment
-                t = time.localtime()
-                if t[4] % 2 == 0 and t[5] < 1:                  # Minutes are even and seconds are less than 1
-                    KAsequence = self.makeSequence(txMode=1)    # Create flash sequence
-                    KAwaveID = self.makeWaveform(KAsequence)    # Create flash wave
-                    self.radio.transmit(KAwaveID, 0.5)          # Transmit flash
+            transmission = self.update(self.events.wait(self.timeout()))
+            if transmission is not None:
+                self.radio.transmit(*transmission)
 
     def run(self):
+        self.keepalive = timers.every(self.keepalivePeriod, bus.publish, 'keepalive')
         self.waitLoop()                                 # Begin loop
 
-# Thread: Power management and battery
-class pwrThread(Thread):
+    async def runAsync(self, executor):
+        """ run() as a coroutine -- transmissions block, so they go to executor """
+        loop = asyncio.get_running_loop()
+        self.keepalive = timers.every(self.keepalivePeriod, bus.publish, 'keepalive')
+        while not thread_stop_event.isSet():
+            transmission = self.update(await self.events.waitAsync(self.timeout()))
+            if transmission is not None:
+                await loop.run_in_executor(executor, self.radio.transmit, *transmission)
+
+# Power management and battery -- checked periodically by the compliance thread's scheduler
+class pwrMonitor:
     def __init__(self):
         self.delay = 120
         self.pwrPin = 3   # GPIO pin for power switch
@@ -245,89 +387,76 @@ class pwrThread(Thread):
         self.PERCENT_MEAN_TABLE_SIZE = 100                              # Size of the mean table for the battery percentage
         self.battPercentHistory = [50] * self.PERCENT_MEAN_TABLE_SIZE   # List of previous percent values
 
-        super(pwrThread, self).__init__()
+        bus.publish('punishment', source='dockLock', active=False)  # Register dock lock channel
 
-    def battLoop(self):
+    def checkBattery(self):
         """
         Check the system battery level and broadcast to a socketio instance
         """
-        # Need visiblity of global vars for communication
-        global punishmentRequests
-        global requestBeep
-
-        while not thread_stop_event.isSet():
-            battStat = battery.get_battery()
-
-            # loadVoltage = battStat['loadVoltage']
-            # power = battStat['power']
-            current = battStat['current']
-            percent = battStat['percent']
-
-            # Cycle battery history
-            for i in range(self.PERCENT_MEAN_TABLE_SIZE-1, 0, -1):
-                self.battPercentHistory[i] = self.battPercentHistory[i - 1]
-
-            self.battPercentHistory[0] = percent                        # Insert new battery history value
-            avgBattPercent = statistics.mean(self.battPercentHistory)   # Get the mean of the battery percent history
-
-            # Figure out whether we're charging to determine whether plugged status changed
-            if current > 0: # Device is charging
-                plugStatusChanged = self.charging.update(True)
-                self.hasShownLowBatteryWarning = False  # Reset low battery warning
-            else:           # Device is not charging
-                plugStatusChanged = self.charging.update(False)
-
-            # If the state just changed, do dock lock check
-            if app.config['dockLock']:                      # If Dock Lock enabled
-                if self.charging.value:                     # And unit is charging
-                    punishmentRequests['dockLock'] = False  # No punishment
-                    if plugStatusChanged:                   # And if unit just got plugged in
-                        requestBeep = 'compliant'           # Play compliance beep
-                else:                                       # Otherwise, if the unit is unplugged when it shouldn't be
-                    punishmentRequests['dockLock'] = True   # Request punishment
-                    if plugStatusChanged:                   # And if the unit just got unplugged
-                        requestBeep = 'noncompliant'        # Play noncompliance beep
-            else:
-                punishmentRequests['dockLock'] = False      # If Dock Lock is off, cancel punishment
-                
-            # If fully charged, disable Dock Lock
-            if avgBattPercent >= 99:
-                app.config.update(dockLock = False)
-
-            # If charge is under the low battery level, emit a warning to the user
-            if avgBattPercent < self.LOW_BATT_LEVEL and self.charging.value == False:
-                if not self.hasShownLowBatteryWarning:      # If we haven't shown the warning before
-                    socketio.emit('modal',
-                    {
-                        'title': "Low Battery",
-                        'body': "Behavior Bracket's battery is running low. Charge the device soon, or it will shut down."
-                    }, namespace='/control')                # Emit the warning
-                    self.hasShownLowBatteryWarning = True   # Keep track of the fact that we've shown it
-
-            # If charge is under the critical low battery level, shut down the device
-            if avgBattPercent < self.CRITICAL_BATT_LEVEL:
-                requestBeep = 'notify'
+        battStat = battery.get_battery()
+
+        # loadVoltage = battStat['loadVoltage']
+        # power = battStat['power']
+        current = battStat['current']
+        percent = battStat['percent']
+
+        # Cycle battery history
+        for i in range(self.PERCENT_MEAN_TABLE_SIZE-1, 0, -1):
+            self.battPercentHistory[i] = self.battPercentHistory[i - 1]
+
+        self.battPercentHistory[0] = percent                        # Insert new battery history value
+        avgBattPercent = statistics.mean(self.battPercentHistory)   # Get the mean of the battery percent history
+
+        # Figure out whether we're charging to determine whether plugged status changed
+        if current > 0: # Device is charging
+            plugStatusChanged = self.charging.update(True)
+            self.hasShownLowBatteryWarning = False  # Reset low battery warning
+        else:           # Device is not charging
+            plugStatusChanged = self.charging.update(False)
+
+        # If the state just changed, do dock lock check
+        if app.config['dockLock']:                      # If Dock Lock enabled
+            if self.charging.value:                     # And unit is charging
+                bus.publish('punishment', source='dockLock', active=False)     # No punishment
+                if plugStatusChanged:                   # And if unit just got plugged in
+                    bus.publish('beep', sound='compliant')                      # Play compliance beep
+            else:                                       # Otherwise, if the unit is unplugged when it shouldn't be
+                bus.publish('punishment', source='dockLock', active=True)      # Request punishment
+                if plugStatusChanged:                   # And if the unit just got unplugged
+                    bus.publish('beep', sound='noncompliant')                   # Play noncompliance beep
+        else:
+            bus.publish('punishment', source='dockLock', active=False)         # If Dock Lock is off, cancel punishment
+            
+        # If fully charged, disable Dock Lock
+        if avgBattPercent >= 99:
+            app.config.update(dockLock = False)
+
+        # If charge is under the low battery level, emit a warning to the user
+        if avgBattPercent < self.LOW_BATT_LEVEL and self.charging.value == False:
+            if not self.hasShownLowBatteryWarning:      # If we haven't shown the warning before
                 socketio.emit('modal',
                 {
-                    'title': "Critical Battery",
-                    'body': "Behavior Bracket's battery has been depleted. The device is now shutting down."
-                }, namespace='/control')
-                os.system('sudo poweroff')
-
-            # Broadcast to WebUI
-            socketio.emit('battery', {
-                'percent': avgBattPercent,
-                'charging': self.charging.value,
-                'dockLock': app.config['dockLock'],
+                    'title': "Low Battery",
+                    'body': "Behavior Bracket's battery is running low. Charge the device soon, or it will shut down."
+                }, namespace='/control')                # Emit the warning
+                self.hasShownLowBatteryWarning = True   # Keep track of the fact that we've shown it
+
+        # If charge is under the critical low battery level, shut down the device
+        if avgBattPercent < self.CRITICAL_BATT_LEVEL:
+            bus.publish('beep', sound='notify')
+            socketio.emit('modal',
+            {
+                'title': "Critical Battery",
+                'body': "Behavior Bracket's battery has been depleted. The device is now shutting down."
             }, namespace='/control')
+            os.system('sudo poweroff')
 
-            time.sleep(0.25)
-
-    def run(self):
-        global punishmentRequests               # Get visibility of punishment request container
-        punishmentRequests['dockLock'] = False  # Register dock lock channel
-
-        self.battLoop()
+        # Broadcast to WebUI
+        socketio.emit('battery', {
+            'percent': avgBattPercent,
+            'charging': self.charging.value,
+            'dockLock': app.config['dockLock'],
+        }, namespace='/control')
 
 # Thread: Audio Output thread
 class beepThread(Thread):
@@ -335,282 +464,198 @@ class beepThread(Thread):
         buzzer.outputPinA = 33  # Define buzzer output pins
         buzzer.outputPinB = 40
         buzzer.setup()          # Set up buzzer pins
+        self.beeps = bus.subscribe('beep', queueLength=8)  # Beeps play one after another -- a long backlog is stale
         
         super(beepThread, self).__init__()
 
     def waitLoop(self):
-        # Need visibility of beep request var
-        global requestBeep
-
         while not thread_stop_event.isSet():
-            if requestBeep != None:
-                buzzer.playSound(buzzer.sounds[requestBeep])    # Play requested sound over buzzer
-
-                requestBeep = None
-
-            time.sleep(self.delay)
+            for event in self.beeps.wait(1):                    # Time out now and then to notice the stop event
+                buzzer.playSound(buzzer.sounds[event.sound])    # Play requested sound over buzzer
 
     def run(self):
         self.waitLoop()
 
-# Thread: Compliance update thread
+    async def runAsync(self, executor):
+        """ run() as a coroutine -- sounds play in executor """
+        loop = asyncio.get_running_loop()
+        while not thread_stop_event.isSet():
+            for event in await self.beeps.waitAsync(1):
+                await loop.run_in_executor(executor, buzzer.playSound, buzzer.sounds[event.sound])
+
+# Thread: Compliance update thread -- polls every sensor from one scheduler
 class complianceThread(Thread):
     def __init__(self):
-        imu.init() # Initialize IMU
+        berryimu.init() # Initialize IMU
+        self.mode = EdgeDetector(app.config['mode'])            # Mode with edge detection, to switch IMU profiles
+        profile = berryimu.setProfile(self.imuProfile())
+
+        imuTrigger = None
+        if app.config['imuFIFO']:   # Start batching samples on the IMU if FIFO mode is enabled
+            berryimu.startFIFO(profile['odr'], app.config['imuFIFOWatermark'])
+        elif app.config['imuInterruptPin'] is not None:                 # Poll each time the IMU says a sample is ready
+            berryimu.startDataReady()
+            imuTrigger = pacer.interruptSource(app.config['imuInterruptPin'], profile['odr'])
+
         self.imu = Sensor(   # Set up IMU as Sensor
             name = 'IMU',
-            updateFunction = imu.getValues(app.config['motionAlgorithm']),
-            sensorData = [
-                'accX',
-                'accY',
-                'accZ',
-                'accXAngle',
-                'accYAngle',
-                'accZAngle',
-                'gyroXAngle',
-                'gyroYAngle',
-                'gyroZAngle',
-                'angleX',
-                'angleY',
-                'angleZ',
+            updateFunction = berryimu.imuPipeline.withSource(          # Read, filter and fuse IMU samples
+                berryimu.samples(lambda: app.config['motionAlgorithm'])
+            ),
+            sensorData = IMU_CHANNELS,
+            lazyChannels = [        # No mode uses the compass, so don't read it unless we're recording
+                'MagX',
+                'MagY',
+                'MagZ',
                 'heading',
                 'tiltCompensatedHeading',
             ],
+            historyLength = 64,     # Enough for every sample between compliance evaluations, at the fastest profile
         )
 
+        micSource = mic.source(app.config['micDevice'], app.config['micWAV'])
         self.mic = Sensor(   # Set up mic as sensor
             name = "Microphone",
-            updateFunction = None,  # TODO: Set update function -- something like mic.getSound() or something
-            sensorData = [
-                'audio',
-                'level',
-            ],
+            updateFunction = mic.Microphone(micSource) if micSource is not None else None,  # Level and band energies of the latest audio chunk
+            sensorData = mic.CHANNELS,
             historyLength = 10,
         )
 
         self.sensors = [self.imu, self.mic] # Bundle sensors in a list for convenient access
 
-        self.stickyPunishment = False       # Bool to punish user "until something happens"
-
-        # TODO: These would be better as some kind of Exercise() class
-        self.wearerInRestPosition = EdgeDetector(True)      # Exercise mode: Keep track of whether the wearer is at rest
-        self.repTimer = {                                   # Exercise mode: Timer for how long the wearer takes to do a rep
-            'time': 0,
-            'lastCheck': None
-        }
-        self.reps = 0                                       # Exercise mode: Reps counter for current exercise
-        
-        self.punishmentTimer = None             # Keep track of countdown to punishment, warning before punishment, etc.
+        self.power = pwrMonitor()           # Battery and Dock Lock
 
         self.compliance = EdgeDetector(True)    # Bool to keep track of whether or not wearer is complying with the selected ruleset
 
-        super(complianceThread, self).__init__()
-
-    def angleTest(self, angle, lowBound, highBound):
-        """
-        Generalized function for angle-related compliance checks
-        """
-        forgiveness = 5     # +/- activation amounts on angles for debouncing and UX improvement
-
-        # Adjust activation angles to account for forgiveness
-        if self.compliance.value:           # If wearer is compliant
-            lowBound -= forgiveness         # Widen the low and high bounds 
-            highBound += forgiveness        # so that it's easier to stay within them
-        else:                               # if wearer is noncompliant
-            lowBound += forgiveness         # Tighten the low and high bounds
-            highBound -= forgiveness        # so that it's harder to slip out once back in
-
-        if highBound > angle > lowBound:    # If wearer is within a valid angle
-            return True
-        else: return False
-
-    def motionDelta(self):
-        """ Find change in recent movement """
-        # Get the mean of the motion history values
-        m = 0 
-        for i in self.motionHistory:
-            m += i['gyroXangle'] + i['gyroYangle'] + i['gyroZangle']
-        m = m / len(self.motionHistory)
-
-        # Find delta
-        Mdelta = (self.motionHistory[-1]['gyroXangle'] + self.motionHistory[-1]['gyroYangle'] + self.motionHistory[-1]['gyroZangle']) - m
-
-        # Send to the debug page
-        socketio.emit('Mdelta', {
-            'Mdelta': Mdelta,
-        }, namespace='/control')
-
-        return Mdelta
-
-    def randomTest(self):
-        """
-        Random mode: randomly shocks the wearer
-        """
-        randomThreshold = 250   # Lower value = higher chance of shock
-
-        if random.randint(1, randomThreshold) == 1:
-            return False
-        else:
-            return True
+        self.motion = rolling.MotionTracker(window=1.0)    # Freeze and Sleep Deprivation modes: gyro rates over the last second
+        self.window = rules.SampleWindow(self.imu, self.motion)                 # What the compliance rules look at
+        self.rules = rules.Registry(self, channels=self.imu.sensorData.keys())  # Compliance test for each mode
+        self.rules.select(self.mode.value)
+
+        # Everything polled runs from this thread, each at its own rate
+        self.scheduler = scheduler.Scheduler(thread_stop_event)
+        self.scheduler.add('imu', self.imuTask, self.imuRate(profile), trigger=imuTrigger, blocking=True)    # Blocking tasks read the I2C bus
+        if app.config['complianceRate'] is not None:
+            self.scheduler.add('compliance', self.complianceTask, app.config['complianceRate'])
+        if self.mic.updateFunction is not None:
+            self.scheduler.add('mic', self.mic.read, app.config['micRate'])
+        self.scheduler.add('battery', self.power.checkBattery, app.config['batteryRate'], blocking=True)
+        self.scheduler.add('loopStats', self.emitLoopStats, 1)
 
-    def petTest(self):
-        """ 
-        Pet Training Mode: wearer's neck must face down (Y rotation between -130 to -50) 
-        """
-        return self.angleTest(self.angleY, -130, -50)
-
-    def freezeTest(self):
-        """
-        Freeze/Statue mode: user is not allowed to move
-        """
-        Mdelta = self.motionDelta()
+        super(complianceThread, self).__init__()
 
-        motionThreshold = 3    # Activation threshold
+    def imuProfile(self):
+        """ Name of the IMU profile for the current mode """
+        return app.config['imuProfiles'].get(app.config['mode'], 'normal')
 
-        # Check values against threshold
-        if Mdelta > motionThreshold or Mdelta < - motionThreshold:
-            return False
-        else:
-            return True
+    def imuRate(self, profile):
+        """ Times per second to read the IMU with profile -- once per sample, or once per batch in FIFO mode """
+        if berryimu.fifoODR:
+            return profile['odr'] / berryimu.fifoWatermark
+        return profile['odr']
 
-    def sleepDepTest(self):
-        """
-        Sleep deprivation mode: every 10 minutes, user is shocked until they move around -- probably shouldn't actually use this one but it's a cool idea right?
-        """
-        # Get the time -- if the minute field ends with a 0, we're in business
-        t = time.localtime()
-        if t[4] % 10 == 0:  # Minutes end with 0
-            if t[5] < 1:    # Seconds less than 1
-                self.stickyPunishment = True
+    def updateMode(self):
+        """ If the mode just changed, switch compliance rules and reconfigure the IMU to sample at the new profile's rate """
+        if not self.mode.update(app.config['mode']):
+            return
 
-        Mdelta = self.motionDelta()
+        self.rules.select(self.mode.value)
+        profile = berryimu.setProfile(self.imuProfile())
+        self.scheduler.setRate('imu', self.imuRate(profile))
 
-        # Check values against threshold
-        motionThreshold = 80
-        if Mdelta > motionThreshold or Mdelta < - motionThreshold:  # user is moving
-            self.stickyPunishment = False
+    # Actions for the compliance rules
+    @property
+    def config(self):
+        return app.config
 
-        if self.stickyPunishment:
-            return False
-        else:
-            return True
+    def emit(self, event, data):
+        """ Send data to the web client """
+        socketio.emit(event, data, namespace='/control')
 
-    def postureTest(self):
-        """
-        Posture mode: wearer must remain completely upright
-        """
-        postureThreshold = 7    # Activation threshold
-        Ycalibration = -15      # Account for the angle of the device on the Y axis from its weight hanging from the collar
+    def beep(self, sound):
+        """ Play a sound on the buzzer """
+        bus.publish('beep', sound=sound)
 
-        if not self.angleTest(self.angleZ, -postureThreshold, postureThreshold) \
-        or not self.angleTest(self.angleY, -postureThreshold + Ycalibration, postureThreshold + Ycalibration):
-            return False    # Return false if either test returns false
-        else:
-            return True     # Otherwise, return true
+    def punishAfter(self, seconds, source):
+        """ Start a countdown to punishment, with a warning beep before it """
+        return PunishmentTimer(seconds, punishmentSource=source)
 
-    def fitnessTest(self):
+    def testCompliance(self):
         """
-        Testing grounds for exercise detection: eventually I want to 
-        spin this out into a whole range of features but for now 
-        it's hidden on the main UI
+        Test the latest sample with the current mode's rule, and request punishment or beeps accordingly
         """
-        global requestPunishment    # Get visibility of should transmit bool
-        global requestBeep          # Get visibility of beep var
-
-        # Check wearer's position
-        if self.angleY < 20:                                            # Check Y rotation for situp detection
-            positionJustChanged = self.wearerInRestPosition.update(False)
-        else: positionJustChanged = self.wearerInRestPosition.update(True)
-
-        if self.wearerInRestPosition.value: # If the wearer ir in rest position
-            if positionJustChanged:         # and they just got into rest position
-                self.resetRepTimer()        # reset the rep timer
-                self.resetPunishmentTimer() # reset the punishment timer
-
-        else:                               # Wearer is doing a rep
-            if positionJustChanged:         # If their position just changed
-                requestBeep = 'compliant'   # Request compliance beep
-                self.reps += 1              # Increment rep counter
-                self.resetRepTimer()        # Reset the rep timer
-                self.resetPunishmentTimer() # Reset the punishment timer
-
-        # Increment rep timer
-        # TODO: Use this (in combination with gyroYangle for pushups?) to tell the wearer if they should do the exercise slower or faster
-        now = datetime.datetime.now()
-        if self.repTimer['lastCheck'] != None:
-            self.repTimer['time'] += now - self.repTimer['lastCheck'] # repTimer += delta(now, then)
-        else: 
-            self.resetRepTimer()
-
-        self.repTimer['lastCheck'] = now
-
-        # Emit repTimer, reps to webUI
-        socketio.emit('fitness', {
-            'repTime':              self.repTimer['time'].second,
-            'reps':                 self.reps,
-            'wearerInRestPosition': self.wearerInRestPosition.value,
-        }, namespace='/control')
-
-    def resetRepTimer(self):
-        """ Reset repTimer to 0 """
-        today = datetime.datetime.today()   # Create empty datetime object for us to do time math on
-        self.repTimer['time'] = datetime.datetime(today.year, today.month, today.day, 0, 0)
-
-    def resetPunishmentTimer(self, delay=5):
-        """ reset punishmentTimer to value set in delay """
-        if self.punishmentTimer != None: self.punishmentTimer.cancel()              # Cancel current punishment timer if exists
-        self.punishmentTimer = PunishmentTimer(delay, punishmentSource='fitness')   # Start punishment timer
-
-    def testCompliance(self, motion):
-        """
-        Decide what test must be done based on the mode, and execute it
-        """
-        global punishmentRequests   # Get visibility of punishment requests
-        global requestBeep          # Get visibility of beep queue
-
-        if app.config['mode'] == 'off':         complianceJustChanged = self.compliance.update(True)
-        elif app.config['mode'] == 'freeze':    complianceJustChanged = self.compliance.update(self.freezeTest())
-        elif app.config['mode'] == 'pet':       complianceJustChanged = self.compliance.update(self.petTest())
-        elif app.config['mode'] == 'sleepDep':  complianceJustChanged = self.compliance.update(self.sleepDepTest())
-        elif app.config['mode'] == 'random':    complianceJustChanged = self.compliance.update(self.randomTest())
-        elif app.config['mode'] == 'posture':   complianceJustChanged = self.compliance.update(self.postureTest())
-
-        ### BEGIN Testing area for fitness mode
-        elif app.config['mode'] == 'fitness':
-            self.compliance.value = True
-            self.fitnessTest()
-        if app.config['mode'] != 'fitness': # TODO: Remove this when punishment timer is integrated with the rest of the motion thread
-            if self.punishmentTimer != None: self.punishmentTimer.cancel()
-            self.punishmentTimer = None
-        ### END   Testing area for fitness mode
+        complianceJustChanged = self.compliance.update(self.rules.active(self.window))    # Run the current mode's rule
 
         # If compliance is true, do not request punishment
         if self.compliance.value:                       # If wearer is compliant
-            punishmentRequests['interaction'] = False   # Set punishment request to False
+            bus.publish('punishment', source='interaction', active=False)  # Set punishment request to False -- only sent on changes
 
             if complianceJustChanged:                   # And if they just started being compliant
-                requestBeep = 'compliant'               # Request compliance beep
+                bus.publish('beep', sound='compliant')  # Request compliance beep
                 
         else:                                           # If wearer is noncompliant
-            punishmentRequests['interaction'] = True    # Set punishment request to True
+            bus.publish('punishment', source='interaction', active=True)   # Set punishment request to True
             if complianceJustChanged:                   # And If they just started being noncompliant
-                requestBeep = 'noncompliant'            # Request noncompliance beep
-
+                bus.publish('beep', sound='noncompliant')   # Request noncompliance beep
+
+
+    def imuTask(self):
+        """ Scheduler task: read the IMU """
+        lazyChannels = self.rules.active.channels               # Compass channels are read with the sample, if anything needs them
+        if app.config['moCap']:
+            lazyChannels += tuple(self.imu.lazyChannels)
+        berryimu.resolveChannels(lazyChannels)
+        if not self.imu.read(): # Read motion data
+            return
+        self.window.update()    # Track recent movement and collect the samples for the next compliance test
+        if app.config['complianceRate'] is None:
+            self.complianceTask()
+
+    def complianceTask(self):
+        """ Scheduler task: test compliance on the samples since the last test """
+        self.updateMode()       # Match the rules and the IMU's rate and power to the mode
+        if not self.window.new: # Nothing new to test -- the IMU is slower than the compliance rate
+            return
+        self.testCompliance()   # Test compliance based on current mode and sensor data
+        self.window.evaluated()
+
+    def emitLoopStats(self):
+        """ Scheduler task: send sampling timing statistics to the debug page """
+        stats = berryimu.loopStats.summary()
+        schedule = self.scheduler.summary()
+        stats.update(schedule['tasks']['imu'])  # Achieved IMU rate since the last update
+        stats['idle'] = schedule['idle']        # Fraction of the time the scheduler slept
+        stats['cpu'] = schedule['cpu']
+        stats['tasks'] = schedule['tasks']      # Rate, run time and overruns of every task
+        stats['stages'] = berryimu.imuPipeline.timings(reset=True)  # Seconds per sample in each IMU processing stage
+        stats['rules'] = self.rules.timings(reset=True)             # Seconds per evaluation of each compliance rule
+        stats['timers'] = timers.timers.summary()                   # Pending timers and how late they fire
+        stats['radioLatency'] = {                                   # Seconds from a punishment request to the radio transmitting --
+            'mean': radioLatency.mean,                              # bounded by the longest transmission (1 s) it can queue behind
+            'max':  radioLatency.max,
+            'p99':  radioLatency.percentile(99),
+        }
+        stats['bus'] = bus.bus.summary()                            # Events published, and waiting and dropped per subscriber
+        stats['runtime'] = app.config['runtime']                    # 'threads' or 'asyncio', to compare their cpu and lateness
+        if app.config['runtime'] == 'asyncio':
+            stats['loopLag'] = {
+                'mean': loopLag.mean,
+                'max':  loopLag.max,
+                'p99':  loopLag.percentile(99),
+            }
 
-    def updateSensors(self):
-        """
-        Fetch motion data from the sensors
-        """
-        for sensor in self.sensors:
-            sensor.read()
+        socketio.emit('loopStats', stats, namespace='/control')
 
     def run(self):
-        global punishmentRequests                   # Get visibility of punishment requests
-        punishmentRequests['interaction'] = False   # Register sensor channel in punishment requests
+        bus.publish('punishment', source='interaction', active=False)  # Register sensor channel in punishment requests
 
-        while not thread_stop_event.isSet():
-            self.updateSensors()    # Read sensor data
-            self.testCompliance()   # Test compliance based on current mode and sensor data
+        self.scheduler.run()    # Run the sensor tasks until the thread stop event is set
+
+    async def runAsync(self, executor):
+        """ run() as a coroutine -- the IMU interrupt, if there is one, is waited on in executor, and the bus reads run there """
+        bus.publish('punishment', source='interaction', active=False)  # Register sensor channel in punishment requests
+
+        await self.scheduler.runAsync(executor)
 
 
 # oooooo   oooooo     oooo            .o8       ooooo     ooo ooooo 
@@ -656,32 +701,32 @@ def control():
         )
 
 # INTERACTIONS
+def updateConfig(*args, **kwargs):
+    """ Change settings, like app.config.update() -- in the safety core too, if it's running """
+    changes = dict(*args, **kwargs)
+    app.config.update(changes)
+    if safetyCore is not None:
+        safetyCore.send('config', changes)
+
 # Wi-Fi Connection Setup
 @socketio.on('wifi-setup', namespace='/control')
 def wifi_setup(msg):
-    global requestBeep
-
     wifi.updateNetworkCredentials(msg['ssid'], msg['passkey'])  # Update wpa_supplicant with new credentials
     wifi.setWiFiMode('client')                                  # Set the device to WiFi client mode
     wifi.restartWiFiAdapter()                                   # Restart the WiFi adapter
     app.config['INTERNET_CONNECTED'] = wifi.isConnected()       # Check internet connection status
     if app.config['INTERNET_CONNECTED']:                        # If internet is connected
-        requestBeep = 'slide'                                   # Play success sound
+        bus.publish('beep', sound='slide')                      # Play success sound
     else:                                                       # Else
-        requestBeep = 'notify'                                  # Play error sound
+        bus.publish('beep', sound='notify')                     # Play error sound
 
 # Motion Data Snapshot
 @socketio.on('moCap', namespace='/control')
 def mocap_toggle(msg):
     if msg['moCap']:
-        app.config.update(moCap = True)     # Turn on motion capture
+        updateConfig(moCap = True)          # Turn on motion capture
     else:
-        app.config.update(moCap = False)    # Turn off motion capture
-
-        # Set up the .csv file headers
-        with open('motion.csv', 'a', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames = list(motion.keys()))
-            writer.writeheader()
+        updateConfig(moCap = False)         # Turn off motion capture
 
 # On client connect
 @socketio.on('connect', namespace='/control')
@@ -691,19 +736,27 @@ def test_connect():
 # Mode selection
 @socketio.on('mode', namespace='/control')
 def mode_select(msg):
-    app.config.update(
+    global modeTimeout
+
+    updateConfig(
         mode = msg['mode'],         # Update mode setting with new value
     )
 
+    if modeTimeout is not None:     # A new mode replaces any countdown on the old one
+        modeTimeout.cancel()
+        modeTimeout = None
+    if msg.get('timeout'):          # Optional minutes until the mode turns itself off
+        modeTimeout = timers.schedule(msg['timeout'] * 60, updateConfig, {'mode': 'off'})
+
 # Intenstiy setting
 @socketio.on('intensity', namespace='/control')
 def intensity_select(msg):
-    app.config.update(punishmentIntensity = msg['intensity'])   # Update punishment intensity setting with new value
+    updateConfig(punishmentIntensity = msg['intensity'])        # Update punishment intensity setting with new value
 
 # Dock Lock
 @socketio.on('dockLock', namespace='/control')
 def dock_lock(msg):
-    app.config.update(dockLock = msg['enabled'])    # Update dock lock setting with new value
+    updateConfig(dockLock = msg['enabled'])         # Update dock lock setting with new value
 
 # Request for info update
 @socketio.on('infoUpdate', namespace='/control')
@@ -711,11 +764,15 @@ def infoUpdate(msg):
     # Need visibility of global vars to display in UI
     global mode
 
+    if safetyCore is not None:      # The core's settings are the ones in force -- it turns Dock Lock off by itself
+        state = safetyCore.state.read()
+    else:
+        state = app.config
     socketio.emit('infoUpdate', 
         {
-            'mode':         app.config['mode'],
-            'intensity':    app.config['punishmentIntensity'],
-            'dockLock':     app.config['dockLock'],
+            'mode':         state['mode'],
+            'intensity':    state['punishmentIntensity'],
+            'dockLock':     state['dockLock'],
         }, namespace='/control')
 
 # Shut down request
@@ -784,20 +841,14 @@ def softwareUpdate(msg):
         os.system('sudo reboot')
 
 # Manual control
-punishmentRequests['manual'] = False    # Register manual punishment channel
 @socketio.on('manualControl', namespace='/control')
 def manualControl(msg):
-    # Need visibility of punishment and beep requests
-    global punishmentRequests
-    global requestBeep
-
     if msg['command'] == 'punish':
-        requestBeep = 'noncompliant'
-        punishmentRequests['manual'] = True     # Quickly toggle punishment on and off
-        punishmentRequests['manual'] = False    # TODO: Test this
-        
+        bus.publish('beep', sound='noncompliant')
+        bus.publish('punishmentPulse', source='manual', cycles=1)  # One punishment cycle
+
     elif msg['command'] =='warn':
-        requestBeep = 'warning'
+        bus.publish('beep', sound='warning')
 
 # ooo        ooooo            o8o              
 # `88.       .888'            `"'              
@@ -806,27 +857,144 @@ def manualControl(msg):
 #  8  `888'   888   .oP"888   888   888   888  
 #  8    Y     888  d8(  888   888   888   888  
 # o8o        o888o `Y888""8o o888o o888o o888o 
+async def measureLoopLag(period=0.1):
+    """ How late the event loop wakes a sleeping coroutine -- the asyncio counterpart of the scheduler's maxLate """
+    while not thread_stop_event.isSet():
+        start = time.perf_counter()
+        await asyncio.sleep(period)
+        loopLag.update(time.perf_counter() - start - period)
+
+async def runDevice(beeper, radio, compliance):
+    """
+    The device on one asyncio event loop: sensors and compliance, buzzer and radio as coroutines,
+    with blocking hardware calls -- transmissions, sounds, the IMU interrupt and I2C reads -- in a small executor
+    """
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='hardware')    # One each for the radio, buzzer and sensor scheduler
+    await asyncio.gather(
+        beeper.runAsync(executor),
+        radio.runAsync(executor),
+        compliance.runAsync(executor),
+        measureLoopLag(),
+    )
+
+def shareState(state, radio, compliance):
+    """ Safety core task: publish settings, safety counters and the latest IMU sample to the web process """
+    state.write(
+        compliance.imu.sensorData,
+        mode = app.config['mode'],
+        punishmentIntensity = app.config['punishmentIntensity'],
+        safetyMode = app.config['safetyMode'],
+        dockLock = app.config['dockLock'],
+        compliance = compliance.compliance.value,
+        punishmentCycles = radio.punishmentCycles,
+    )
+
+def applyCommands(commands):
+    """ Safety core: carry out the web process's commands """
+    while True:
+        command, args = commands.get()
+        if command == 'config':             # Settings changed on the web page
+            app.config.update(*args)
+        elif command == 'publish':          # Sounds and punishments asked for by the web page
+            topic, fields = args
+            bus.publish(topic, **fields)
+
+def runSafetyCore(state, commands, outbox):
+    """
+    The safety core process: the device subsystems, with Socket.IO events going through outbox
+    and the latest state into state, for the web process to pass on
+    """
+    global socketio, safetyCore
+    socketio = safety.Outbox(outbox, skip=['sensor_IMU'])  # The web process reads the IMU sample from state instead
+    safetyCore = None                                       # We are the core
+
+    beeper, radio, compliance = beepThread(), radioThread(), complianceThread()
+    compliance.scheduler.add('state', lambda: shareState(state, radio, compliance), 20)
+
+    if app.config['runtime'] == 'asyncio':
+        Thread(target=applyCommands, args=(commands,), daemon=True).start()
+        asyncio.run(runDevice(beeper, radio, compliance))
+    else:
+        for thread in (beeper, radio, compliance):
+            thread.start()
+        applyCommands(commands)
+
+def forwardToSafetyCore(events):
+    """ Web process: send sounds and punishments published here on to the safety core """
+    while True:
+        for event in events.wait():
+            safetyCore.send('publish', event.topic, event.fields)
+
+def relaySafetyCore(period=0.05):
+    """ Web process: pass the safety core's events on to the web client, along with the IMU sample every period seconds """
+    nextSample = time.monotonic()
+    lastTimestamp = None
+    seenRunning = False         # Whether the core has been seen writing its state -- it can't have stopped before that
+    while True:
+        message = safetyCore.receive(timeout=max(nextSample - time.monotonic(), 0))
+        if message is not None:
+            event, data, namespace = message
+            socketio.emit(event, data, namespace=namespace)
+            continue
+
+        nextSample += period
+        state = safetyCore.state.read()
+        timestamp = state['timestamp']              # NaN until the core's first sample -- and NaN != NaN, so check for it
+        if not math.isnan(timestamp) and timestamp != lastTimestamp:   # A new sample -- channels the core hasn't filled in are NaN, sent as null like before
+            lastTimestamp = timestamp
+            socketio.emit('sensor_IMU', {
+                channel: None if state[channel] != state[channel] else state[channel] for channel in IMU_CHANNELS
+            }, namespace='/control')
+
+        alive = safetyCore.alive
+        if seenRunning and not alive:               # Tell the user once if the core stops
+            socketio.emit('modal',
+            {
+                'title': "Safety Core Stopped",
+                'body': "Behavior Bracket's sensor and radio process has stopped. Restart the device."
+            }, namespace='/control')
+        seenRunning = alive and safetyCore.state.started
+
 if __name__ == "__main__":
-    print('Starting Power Management Thread')   # Start power management thread
-    thread = pwrThread()
-    thread.start()
+    # python bracket.py [--asyncio] [--safety-core]
+    #   --asyncio       Run the device on an asyncio event loop instead of threads
+    #   --safety-core   Run the device in a process of its own, apart from the webserver
+    if '--asyncio' in sys.argv[1:]:
+        app.config.update(runtime = 'asyncio')
+
+    if '--safety-core' in sys.argv[1:]:
+        print('Starting Safety Core')           # Sensors, compliance, buzzer and radio in their own process
+        safetyCore = safety.SafetyCore(runSafetyCore, IMU_CHANNELS)
+        safetyCore.start()
+        atexit.register(safetyCore.state.close)     # The core keeps running, and keeps its mapping, if the webserver goes down
+
+        thread = Thread(target=forwardToSafetyCore, args=(bus.subscribe('beep', 'punishmentPulse'),), daemon=True)
+        thread.start()
+        thread = Thread(target=relaySafetyCore, daemon=True)
+        thread.start()
+
+    elif app.config['runtime'] == 'asyncio':
+        print('Starting Device Event Loop')     # The webserver is WSGI, so the loop gets a thread of its own
+        thread = Thread(target=asyncio.run, args=(runDevice(beepThread(), radioThread(), complianceThread()),))
+        thread.start()
 
-    print('Starting Beep Thread')           # Start beep thread
-    thread = beepThread()
-    thread.start()
+    else:
+        print('Starting Beep Thread')           # Start beep thread
+        thread = beepThread()
+        thread.start()
 
-    print('Starting Radio Thread')          # Start radio thread
-    thread = radioThread()
-    thread.start()
+        print('Starting Radio Thread')          # Start radio thread
+        thread = radioThread()
+        thread.start()
 
-    print('Starting Compliance Thread')     # Start main thread
-    thread = complianceThread()
-    thread.start()
+        print('Starting Compliance Thread')     # Start sensor scheduler, including power management
+        thread = complianceThread()
+        thread.start()
 
     # Check wifi connection
     if app.config['INTERNET_CONNECTED']:    # If we're connected to the internet
-        requestBeep = 'soliton'             # Play startup chime
+        bus.publish('beep', sound='soliton')    # Play startup chime
     else:                                   # Otherwise,
-        requestBeep = 'error'               # Play error beep
+        bus.publish('beep', sound='error')      # Play error beep
     
-    app.run(debug=False, host='0.0.0.0')    # Start webserver 
\ No newline at end of file
+    app.run(debug=False, host='0.0.0.0')    # Start webserver
@@ -0,0 +1,193 @@
+# In-process event bus
+#
+# Threads talk by publishing events to topics rather than writing shared globals, so two
+# requests landing at once are both delivered instead of one overwriting the other.
+# Each subscriber has its own bounded queue and its own condition, so a consumer sleeps
+# until something it subscribed to arrives and is only woken for its own topics.
+# State topics are retained: repeats of the current state aren't queued again, and new or
+# overflowed subscribers are sent the current state so they can't miss a change.
+# Consumers on an asyncio event loop use waitAsync() -- publishers can be on any thread
+
+import asyncio
+import collections
+import threading
+import time
+
+TOPICS = {              # topic: (field names, retained-by field or None)
+    'beep':             (('sound',), None),                 # Play a sound on the buzzer
+    'punishment':       (('source', 'active'), 'source'),   # A punishment channel turned on or off
+    'punishmentPulse':  (('source', 'cycles'), None),       # Punish now for a number of cycles, whatever the channels say
+    'keepalive':        ((), None),                         # The shock unit needs pinging so it doesn't sleep
+}
+
+class Event:
+    """
+    Something that happened: a topic, its fields as attributes, and when it was published
+    """
+    def __init__(self, topic, fields):
+        self.topic = topic
+        self.time = time.perf_counter()     # When it was published
+        self.__dict__.update(fields)
+
+    @property
+    def fields(self):
+        """ Dict of the topic's fields, as published """
+        return {name: getattr(self, name) for name in TOPICS[self.topic][0]}
+
+    def __repr__(self):
+        fields = ', '.join(f"{key}={value!r}" for key, value in self.fields.items())
+        return f"Event({self.topic}: {fields})"
+
+class Subscription:
+    """
+    One consumer's queue of events
+    """
+    def __init__(self, bus, topics, queueLength):
+        """
+        bus         Bus     Bus the subscription is on
+        topics      tuple   Topics to receive
+        queueLength int     Events to hold before dropping the oldest
+        """
+        self.bus = bus
+        self.topics = topics
+        self.queue = collections.deque()
+        self.queueLength = queueLength
+        self.condition = threading.Condition()
+        self.dropped = 0        # Events dropped because the queue was full
+        self.resync = False     # Whether a dropped event was state, so the current state needs resending
+        self.ready = None       # asyncio.Event set when events arrive, once waitAsync() has been used
+        self.loop = None        # Event loop of the waitAsync() caller
+
+    def put(self, event):
+        with self.condition:
+            if len(self.queue) >= self.queueLength:     # Full -- the oldest event goes, and the drop is counted
+                oldest = self.queue.popleft()
+                self.dropped += 1
+                if TOPICS[oldest.topic][1] is not None:
+                    self.resync = True
+            self.queue.append(event)
+            self.condition.notify()
+            if self.loop is not None:               # Wake the coroutine from whatever thread we're on
+                self.loop.call_soon_threadsafe(self.ready.set)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (None for ever) for events
+        Returns every event waiting, oldest first -- an empty list if none came in time
+        """
+        with self.condition:
+            if not self.queue and not self.resync:
+                self.condition.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            resync, self.resync = self.resync, False
+
+        if resync:          # Make up for any state that was dropped with the state as it stands
+            events += self.bus.retained(self.topics)
+        return events
+
+    async def waitAsync(self, timeout=None):
+        """ wait() without blocking the event loop """
+        if self.loop is None:
+            self.ready = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+
+        with self.condition:                        # Clear under the lock, so a put() after it sets it again
+            empty = not self.queue and not self.resync
+            if empty:
+                self.ready.clear()
+        if empty:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.wait(0)
+
+    def close(self):
+        """ Stop receiving events """
+        self.bus.unsubscribe(self)
+
+class Bus:
+    """
+    Delivers published events to every subscriber of their topic
+    """
+    def __init__(self, queueLength=64):
+        """
+        queueLength int     Default events each subscriber can have waiting
+        """
+        self.queueLength = queueLength
+        self.subscribers = {topic: [] for topic in TOPICS}
+        self.state = {}                 # (topic, key): latest Event of each retained topic
+        self.lock = threading.RLock()
+        self.published = collections.Counter()     # Events published per topic
+
+    def subscribe(self, *topics, queueLength=None):
+        """ Start receiving events on topics. Returns the Subscription """
+        for topic in topics:
+            if topic not in TOPICS:
+                raise ValueError(f"Unknown topic '{topic}'")
+
+        subscription = Subscription(self, topics, queueLength or self.queueLength)
+        with self.lock:
+            for topic in topics:
+                self.subscribers[topic].append(subscription)
+            for event in self.retained(topics):     # Catch up on the current state
+                subscription.put(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers[topic].remove(subscription)
+
+    def publish(self, topic, **fields):
+        """
+        Send an event to the topic's subscribers -- repeats of a retained topic's current state are skipped
+        Returns the Event, or None if it was a repeat
+        """
+        if topic not in TOPICS:
+            raise ValueError(f"Unknown topic '{topic}'")
+        names, retainBy = TOPICS[topic]
+        if set(fields) != set(names):
+            raise ValueError(f"Topic '{topic}' takes fields {names}, not {tuple(fields)}")
+
+        event = Event(topic, fields)
+        with self.lock:
+            if retainBy is not None:
+                key = (topic, fields[retainBy])
+                current = self.state.get(key)
+                if current is not None and all(getattr(current, name) == fields[name] for name in names):
+                    return None
+                self.state[key] = event
+            self.published[topic] += 1
+            for subscription in self.subscribers[topic]:
+                subscription.put(event)
+        return event
+
+    def retained(self, topics):
+        """ The current state of the retained topics in topics, as events """
+        with self.lock:
+            return [event for (topic, key), event in self.state.items() if topic in topics]
+
+    def summary(self):
+        """ Dict of events published per topic, and events waiting and dropped per subscriber """
+        with self.lock:
+            subscriptions = {id(subscription): subscription for subscribers in self.subscribers.values() for subscription in subscribers}
+            return {
+                'published':    dict(self.published),
+                'subscribers':  [{
+                    'topics':   list(subscription.topics),
+                    'waiting':  len(subscription.queue),
+                    'dropped':  subscription.dropped,
+                } for subscription in subscriptions.values()],
+            }
+
+bus = Bus()             # Shared by the whole app
+
+def publish(topic, **fields):
+    """ Publish on the shared bus. Returns the Event, or None if it was a repeat of the current state """
+    return bus.publish(topic, **fields)
+
+def subscribe(*topics, queueLength=None):
+    """ Subscribe on the shared bus. Returns the Subscription """
+    return bus.subscribe(*topics, queueLength=queueLength)
@@ -171,6 +171,7 @@ def playTone(delay, duration):
         time.sleep(delay)
 
 def playSound(song):
+    setup()                                             # Pins are released after every sound
     for i in range(len(song)):
         if (song[i][0] == "R"):                         # If we're on a rest
             time.sleep(song[i][1])                      # Rest for the time specified
@@ -178,4 +179,4 @@ def playSound(song):
             playTone(tones[song[i][0]], song[i][1])     # Otherwise, play our note
         time.sleep(0.05)                                # Pause for 50ms to avoid smearing or skipping notes
     
-    GPIO.cleanup()                                      # Clean up the GPIO pins
\ No newline at end of file
+    GPIO.cleanup((outputPinA, outputPinB))              # Clean up our GPIO pins -- only ours, other pins (e.g. the IMU interrupt) are in use
\ No newline at end of file
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+#   Sensor calibration: gyro bias and magnetometer hard-iron offsets
+#
+#   Measured once and saved to CALIBRATION_FILE, which berryimu loads at startup so the
+#   filters start out with the gyro bias removed instead of having to learn it every boot
+#
+#   Usage:
+#       python calibration.py           Measure the gyro bias (keep the device still), then the magnetometer (turn it every which way)
+#       python calibration.py gyro      Gyro bias only, keeping the saved magnetometer offsets
+
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import imu as IMU
+
+CALIBRATION_FILE = 'calibration.json'
+
+GYRO_SECONDS = 3        # Length of the still capture for gyro bias
+MAG_SECONDS = 30        # Length of the rotation capture for magnetometer offsets
+CAPTURE_RATE = 50       # Samples per second during captures
+STILL_THRESHOLD = 1.0   # Gyro rate standard deviation (deg/s) above which the device wasn't still
+
+def empty():
+    """ Calibration that changes nothing """
+    return {
+        'gyroBias': [0.0, 0.0, 0.0],    # deg/s, subtracted from the gyro rates
+        'magMin':   [0, 0, 0],          # Raw magnetometer extremes -- their midpoint is the hard-iron offset
+        'magMax':   [0, 0, 0],
+    }
+
+def load(path=CALIBRATION_FILE):
+    """ Load a saved calibration, or None if there isn't a usable one """
+    try:
+        with open(path) as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    calibration = empty()
+    for key in calibration:
+        if key in saved and len(saved[key]) == 3:
+            calibration[key] = saved[key]
+    return calibration
+
+def save(calibration, path=CALIBRATION_FILE):
+    """ Save a calibration, replacing the file in one step so a power cut can't leave half of one """
+    calibration = dict(calibration, saved=time.time())
+    with open(path + '.tmp', 'w') as file:
+        json.dump(calibration, file, indent=4)
+    os.replace(path + '.tmp', path)
+
+def capture(read, seconds, rate=CAPTURE_RATE):
+    """ Call read() rate times a second for seconds, returning the results as an N x 3 array """
+    samples = []
+    nextSample = time.perf_counter()
+    for i in range(int(seconds * rate)):
+        samples.append(read())
+        nextSample += 1 / rate
+        time.sleep(max(nextSample - time.perf_counter(), 0))
+    return np.array(samples, dtype=float)
+
+def measureGyroBias(gain, seconds=GYRO_SECONDS):
+    """
+    Average the gyro rates while the device is held still
+        gain    float   Gyro sensitivity in deg/s/LSB for the current full scale (berryimu.G_GAIN)
+    Returns the X, Y, Z bias in deg/s, or None if the device moved during the capture
+    """
+    rates = capture(lambda: IMU.readACCGYR()[3:], seconds) * gain
+    if rates.std(axis=0).max() > STILL_THRESHOLD:
+        return None
+    return rates.mean(axis=0).tolist()
+
+def measureMagExtremes(seconds=MAG_SECONDS):
+    """
+    Record the magnetometer extremes while the device is turned through every orientation
+    Returns (X, Y, Z minimums, X, Y, Z maximums)
+    """
+    readings = capture(IMU.readMAG, seconds)
+    return readings.min(axis=0).astype(int).tolist(), readings.max(axis=0).astype(int).tolist()
+
+if __name__ == "__main__":
+    import berryimu
+
+    berryimu.init()
+    berryimu.setProfile('high')     # Magnetometer on at full rate
+    calibration = load() or empty()
+
+    print(f"Keep the device still for {GYRO_SECONDS} seconds...")
+    bias = measureGyroBias(berryimu.G_GAIN)
+    if bias is None:
+        sys.exit("The device moved -- try again")
+    calibration['gyroBias'] = bias
+    print(f"Gyro bias: {bias[0]:.3f}, {bias[1]:.3f}, {bias[2]:.3f} deg/s")
+
+    if 'gyro' not in sys.argv[1:]:
+        print(f"Turn the device through every orientation for {MAG_SECONDS} seconds...")
+        calibration['magMin'], calibration['magMax'] = measureMagExtremes()
+        print(f"Magnetometer min: {calibration['magMin']}, max: {calibration['magMax']}")
+
+    save(calibration)
+    print(f"Saved to {CALIBRATION_FILE}")
@@ -0,0 +1,148 @@
+# Simulated SMBus for running the IMU code off-device
+#
+# Mimics the parts of smbus.SMBus used by imu.py, backed by a plain register map
+# per device address, so the read and decode paths can be exercised without a BerryIMU
+
+import collections
+import struct
+
+# Device addresses and WHO_AM_I responses of the BerryIMUv3 chips
+LSM6DSL_ADDRESS = 0x6A
+LIS3MDL_ADDRESS = 0x1C
+WHO_AM_I = 0x0F
+
+# LSM6DSL FIFO registers
+FIFO_STATUS1    = 0x3A
+FIFO_STATUS2    = 0x3B
+FIFO_STATUS3    = 0x3C
+FIFO_STATUS4    = 0x3D
+FIFO_DATA_OUT_L = 0x3E
+FIFO_DATA_OUT_H = 0x3F
+FIFO_CTRL1      = 0x06
+FIFO_CTRL2      = 0x07
+FIFO_CTRL5      = 0x0A
+FIFO_SIZE_WORDS = 2048
+FIFO_SAMPLE_WORDS = 6
+
+class FakeSMBus:
+    """
+    Register map backed stand-in for smbus.SMBus
+    """
+    def __init__(self, bus=None):
+        """
+        bus         int     Bus number -- ignored, accepted for compatibility with smbus.SMBus
+        registers   dict    Register contents for each device address, 256 bytes each
+        failReads   int     Number of upcoming reads that should raise IOError, to simulate a spotty connection
+        fifo        deque   Simulated LSM6DSL FIFO contents as (pattern, word) pairs, oldest first
+        """
+        self.registers = {
+            LSM6DSL_ADDRESS: bytearray(256),
+            LIS3MDL_ADDRESS: bytearray(256),
+        }
+        self.registers[LSM6DSL_ADDRESS][WHO_AM_I] = 0x6A    # Identify as a BerryIMUv3
+        self.registers[LIS3MDL_ADDRESS][WHO_AM_I] = 0x3D
+
+        self.failReads = 0
+        self.transactions = 0   # Count of bus transactions, for comparing read strategies
+
+        self.fifo = collections.deque()
+        self.fifoOverrun = False
+        self.fifoHighByte = None    # High byte of the word currently being read out of FIFO_DATA_OUT
+
+    def _device(self, addr):
+        if addr not in self.registers:
+            raise IOError(f"No device at address {hex(addr)}")
+        return self.registers[addr]
+
+    def _checkFailure(self):
+        if self.failReads > 0:
+            self.failReads -= 1
+            raise IOError("Simulated I2C read failure")
+
+    def _fifoEnabled(self):
+        return self.registers[LSM6DSL_ADDRESS][FIFO_CTRL5] & 0b111 != 0
+
+    def _readRegister(self, addr, register):
+        """ Read one byte, computing the FIFO status and data registers from the simulated FIFO """
+        if addr == LSM6DSL_ADDRESS and FIFO_STATUS1 <= register <= FIFO_DATA_OUT_H:
+            unread = len(self.fifo)
+            watermark = self.registers[addr][FIFO_CTRL1] | (self.registers[addr][FIFO_CTRL2] & 0b111) << 8
+            pattern = self.fifo[0][0] if self.fifo else 0
+
+            if register == FIFO_STATUS1:
+                return unread & 0xFF
+            elif register == FIFO_STATUS2:
+                return (unread >> 8) & 0b111 \
+                    | (0b10000000 if watermark and unread >= watermark else 0) \
+                    | (0b01000000 if self.fifoOverrun else 0) \
+                    | (0b00010000 if not unread else 0)
+            elif register == FIFO_STATUS3:
+                return pattern & 0xFF
+            elif register == FIFO_STATUS4:
+                return (pattern >> 8) & 0b11
+            elif register == FIFO_DATA_OUT_L:
+                if not self.fifo:
+                    return 0
+                self.fifoOverrun = False            # Overrun flag clears once data is read
+                word = self.fifo.popleft()[1]
+                self.fifoHighByte = (word >> 8) & 0xFF
+                return word & 0xFF
+            else:
+                highByte = self.fifoHighByte or 0
+                self.fifoHighByte = None
+                return highByte
+
+        return self._device(addr)[register]
+
+    def read_byte_data(self, addr, register):
+        self.transactions += 1
+        self._checkFailure()
+        return self._readRegister(addr, register & 0x7F)
+
+    def write_byte_data(self, addr, register, value):
+        self.transactions += 1
+        self._device(addr)[register & 0x7F] = value & 0xFF
+        if addr == LSM6DSL_ADDRESS and register == FIFO_CTRL5 and not self._fifoEnabled():
+            self.fifo.clear()               # Bypass mode empties the FIFO
+            self.fifoOverrun = False
+
+    def read_i2c_block_data(self, addr, register, length):
+        self.transactions += 1
+        self._checkFailure()
+        register &= 0x7F    # Strip the LIS3MDL auto-increment bit
+        data = []
+        for i in range(length):
+            data.append(self._readRegister(addr, register))
+            if addr == LSM6DSL_ADDRESS and register == FIFO_DATA_OUT_H:
+                register = FIFO_DATA_OUT_L  # FIFO output address rolls back so bursts read consecutive words
+            else:
+                register += 1
+        return data
+
+    def write_i2c_block_data(self, addr, register, data):
+        self.transactions += 1
+        start = register & 0x7F
+        self._device(addr)[start:start + len(data)] = bytes(data)
+
+    def setAccGyr(self, acc, gyr):
+        """ Load raw accelerometer and gyro axis values into the LSM6DSL output registers """
+        self.registers[LSM6DSL_ADDRESS][0x22:0x2E] = struct.pack('<6h', *gyr, *acc)
+
+    def setMag(self, mag):
+        """ Load raw magnetometer axis values into the LIS3MDL output registers """
+        self.registers[LIS3MDL_ADDRESS][0x28:0x2E] = struct.pack('<3h', *mag)
+
+    def pushFIFO(self, acc, gyr):
+        """
+        Simulate the LSM6DSL storing one sample in its FIFO
+        When the FIFO is full the oldest words are overwritten (continuous mode) and the overrun flag is set
+        """
+        if not self._fifoEnabled():
+            return
+
+        words = struct.unpack('<6H', struct.pack('<6h', *gyr, *acc))
+        for pattern, word in enumerate(words):
+            if len(self.fifo) >= FIFO_SIZE_WORDS:
+                self.fifo.popleft()
+                self.fifoOverrun = True
+            self.fifo.append((pattern, word))
@@ -0,0 +1,327 @@
+# Sensor fusion filters for combining accelerometer angles and gyro rates into device rotation
+#
+# Each filter is an object holding its own state, so several can run side by side
+# (e.g. live + replay), and all three axes are updated together as NumPy arrays
+
+import math
+
+import numpy as np
+
+DEG_TO_RAD = math.pi / 180
+
+def gravityAngles(x, y, z):
+    """
+    Convert a gravity (or raw accelerometer) vector into the X, Y, Z angles used for compliance,
+    with 0, 0 when the device is upright -- works on scalars or NumPy arrays of samples
+    """
+    angleX = np.degrees(np.arctan2(y, z) + np.pi)
+    angleY = np.degrees(np.arctan2(z, x) + np.pi) - 180.0
+    angleZ = np.degrees(np.arctan2(x, y) + np.pi) - 270.0
+    return angleX, angleY, angleZ
+
+class FusionFilter:
+    """
+    Base class for fusion filters
+    Subclasses implement update() for one sample of all three axes
+
+    Parameters listed in PARAMETERS may also be given as P x 1 arrays, in which case the
+    filter runs P parameter sets side by side and its state and output are P x 3
+    """
+    __slots__ = ('angle',)
+
+    PARAMETERS = ()     # Names of the tunable parameters
+
+    def __init__(self):
+        """
+        angle   ndarray     Current X, Y, Z angle estimate in degrees
+        """
+        self.reset()
+
+    def stateShape(self):
+        """ Shape of the per-axis state: (3,), or (P, 3) when running a grid of parameters """
+        return np.broadcast_shapes((3,), *(np.shape(getattr(self, name)) for name in self.PARAMETERS))
+
+    def reset(self):
+        """ Forget all filter state """
+        self.angle = np.zeros(self.stateShape())
+
+    def update(self, accAngle, gyroRate, dt, acc=None, mag=None):
+        """
+        Fuse one sample
+            accAngle    array   X, Y, Z angles from the accelerometer in degrees
+            gyroRate    array   X, Y, Z rates from the gyro in degrees per second
+            dt          float   Seconds since the last sample
+            acc         array   X, Y, Z accelerometer vector, for filters that work on vectors rather than angles
+            mag         array   X, Y, Z magnetometer vector, for filters that use heading
+        Returns the X, Y, Z output angles as an ndarray
+        """
+        raise NotImplementedError
+
+    def process(self, accAngles, gyroRates, dts, accs=None, mags=None):
+        """
+        Run a whole recording through the filter in one pass
+            accAngles   array   N x 3 accelerometer angles
+            gyroRates   array   N x 3 gyro rates
+            dts         array   N sample periods in seconds, or a single period for evenly spaced samples
+            accs        array   N x 3 accelerometer vectors (optional)
+            mags        array   N x 3 magnetometer vectors (optional)
+        Returns an N x 3 array of output angles
+        The filter state carries on from wherever it was -- call reset() first for a clean run
+        Filters whose state carries from one sample to the next have to step through them in order,
+        so this runs update() on each -- filters without such state override it to do the batch at once
+        """
+        accAngles = np.asarray(accAngles, dtype=float)
+        gyroRates = np.asarray(gyroRates, dtype=float)
+        dts = np.broadcast_to(np.asarray(dts, dtype=float), (len(accAngles),))
+
+        angles = np.empty((len(accAngles),) + self.stateShape())
+        for i in range(len(accAngles)):
+            angles[i] = self.update(
+                accAngles[i], gyroRates[i], dts[i],
+                None if accs is None else accs[i],
+                None if mags is None else mags[i],
+            )
+        return angles
+
+class ComplementaryFilter(FusionFilter):
+    """
+    'fast' motion algorithm: complementary filter
+    Blends the gyro rate with the accelerometer angle
+    The blend starts from 0 each sample rather than from the previous estimate, as it always has --
+    the +/- 50 to +/- 90 output remap (and the compliance thresholds) are tuned against that.
+    With no state carried between samples, process() blends a whole batch in one go
+    """
+    __slots__ = ('AA',)
+
+    PARAMETERS = ('AA',)
+
+    # Map output ranges from +/- 50 to +/- 90
+    OLD_RANGE = 100
+    NEW_RANGE = 180
+
+    def __init__(self, AA=0.40):
+        """
+        AA      float   Weight given to the integrated gyro angle (the rest goes to the accelerometer)
+        """
+        self.AA = AA
+        super().__init__()
+
+    def update(self, accAngle, gyroRate, dt, acc=None, mag=None):
+        angle = self.angle
+        np.multiply(gyroRate, dt * self.AA, out=angle)  # Blend gyro movement this sample
+        angle += (1 - self.AA) * accAngle               # with the accelerometer angle
+
+        return self.remap(angle)
+
+    def process(self, accAngles, gyroRates, dts, accs=None, mags=None):
+        accAngles = np.asarray(accAngles, dtype=float)
+        gyroRates = np.asarray(gyroRates, dtype=float)
+        dts = np.broadcast_to(np.asarray(dts, dtype=float), (len(accAngles),))[:, np.newaxis]  # N x 1
+        if self.angle.ndim > 1:     # P x 1 parameters: samples x parameter sets x axes
+            accAngles, gyroRates, dts = accAngles[:, np.newaxis], gyroRates[:, np.newaxis], dts[:, np.newaxis]
+
+        angles = gyroRates * (dts * self.AA)            # Every sample's blend at once
+        angles += (1 - self.AA) * accAngles
+        if len(angles):
+            self.angle[...] = angles[-1]                # Leave the state as update() would
+        return self.remap(angles)
+
+    def remap(self, angle):
+        """ Blended angles to output angles """
+        return ((angle + 50) * self.NEW_RANGE) / self.OLD_RANGE - 90
+
+class KalmanFilter(FusionFilter):
+    """
+    'accurate' motion algorithm: one 1-D Kalman filter per axis, all updated at once
+    Estimates each axis' angle and gyro bias
+    """
+    __slots__ = ('Q_angle', 'Q_gyro', 'R_angle', 'bias', 'P00', 'P01', 'P10', 'P11')
+
+    PARAMETERS = ('Q_angle', 'Q_gyro', 'R_angle')
+
+    def __init__(self, Q_angle=0.02, Q_gyro=0.0015, R_angle=0.005):
+        """
+        Q_angle     float   Process noise of the angle
+        Q_gyro      float   Process noise of the gyro bias
+        R_angle     float   Measurement noise of the accelerometer angle
+        """
+        self.Q_angle = Q_angle
+        self.Q_gyro = Q_gyro
+        self.R_angle = R_angle
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        shape = self.stateShape()
+        self.bias = np.zeros(shape)     # Gyro bias estimate per axis
+        self.P00 = np.zeros(shape)      # Error covariance matrix per axis
+        self.P01 = np.zeros(shape)
+        self.P10 = np.zeros(shape)
+        self.P11 = np.zeros(shape)
+
+    def update(self, accAngle, gyroRate, dt, acc=None, mag=None):
+        angle, bias = self.angle, self.bias
+        P00, P01, P10, P11 = self.P00, self.P01, self.P10, self.P11
+
+        # Predict
+        angle += dt * (gyroRate - bias)
+
+        P00 += - dt * (P10 + P01) + self.Q_angle * dt
+        P01 -= dt * P11
+        P10 -= dt * P11
+        P11 += self.Q_gyro * dt
+
+        # Correct with the accelerometer angle
+        y = accAngle - angle
+        S = P00 + self.R_angle
+        K_0 = P00 / S
+        K_1 = P10 / S
+
+        angle += K_0 * y
+        bias += K_1 * y
+
+        P00 -= K_0 * P00
+        P01 -= K_0 * P01
+        P10 -= K_1 * P00
+        P11 -= K_1 * P01
+
+        # X and Y are reported swapped to match how the device hangs from the collar
+        return angle[..., [1, 0, 2]]
+
+class MadgwickFilter(FusionFilter):
+    """
+    'ahrs' motion algorithm: Madgwick quaternion AHRS
+    Tracks full 3-D orientation as a quaternion, correcting gyro integration with the
+    accelerometer (and optionally the magnetometer) by gradient descent, so it doesn't
+    break down when one axis approaches vertical the way per-axis angle filters do
+    Output angles are taken from the estimated gravity direction with the same formulas
+    as the accelerometer angles, so they line up with the other algorithms' angleX/Y/Z
+    Per-sample maths is plain float arithmetic -- cheaper than tiny NumPy arrays on the Pi Zero
+    """
+    __slots__ = ('beta', 'useMag', 'q0', 'q1', 'q2', 'q3', 'initialised')
+
+    def __init__(self, beta=0.1, useMag=False):
+        """
+        beta        float   Filter gain -- higher trusts the accelerometer/magnetometer more, lower trusts the gyro
+        useMag      bool    Whether to fuse the magnetometer (only worth it with a calibrated compass)
+        """
+        self.beta = beta
+        self.useMag = useMag
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self.q0, self.q1, self.q2, self.q3 = 1.0, 0.0, 0.0, 0.0     # Orientation quaternion
+        self.initialised = False                                    # Whether we've seeded the orientation from the accelerometer
+
+    def _initialise(self, ax, ay, az):
+        """ Start from the accelerometer's tilt so the filter doesn't have to converge from level """
+        roll = math.atan2(ay, az)
+        pitch = math.atan2(-ax, math.sqrt(ay * ay + az * az))
+        cr, sr = math.cos(roll / 2), math.sin(roll / 2)
+        cp, sp = math.cos(pitch / 2), math.sin(pitch / 2)
+        self.q0, self.q1, self.q2, self.q3 = cr * cp, sr * cp, cr * sp, -sr * sp
+        self.initialised = True
+
+    def update(self, accAngle, gyroRate, dt, acc=None, mag=None):
+        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
+        gx, gy, gz = (float(v) * DEG_TO_RAD for v in gyroRate)
+        ax, ay, az = (float(v) for v in acc)
+
+        # Rate of change of quaternion from gyroscope
+        qDot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qDot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qDot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qDot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        accNorm = math.sqrt(ax * ax + ay * ay + az * az)
+        if accNorm > 0:                 # Skip the correction if the accelerometer reads nothing
+            if not self.initialised:
+                self._initialise(ax, ay, az)
+                return self._angles()
+
+            ax /= accNorm
+            ay /= accNorm
+            az /= accNorm
+
+            if self.useMag and mag is not None and any(mag):
+                s0, s1, s2, s3 = self._gradientMARG(q0, q1, q2, q3, ax, ay, az, *(float(v) for v in mag))
+            else:
+                s0, s1, s2, s3 = self._gradientIMU(q0, q1, q2, q3, ax, ay, az)
+
+            sNorm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+            if sNorm > 0:
+                qDot0 -= self.beta * s0 / sNorm
+                qDot1 -= self.beta * s1 / sNorm
+                qDot2 -= self.beta * s2 / sNorm
+                qDot3 -= self.beta * s3 / sNorm
+
+        # Integrate and normalise
+        q0 += qDot0 * dt
+        q1 += qDot1 * dt
+        q2 += qDot2 * dt
+        q3 += qDot3 * dt
+        qNorm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q0, self.q1, self.q2, self.q3 = q0 / qNorm, q1 / qNorm, q2 / qNorm, q3 / qNorm
+
+        return self._angles()
+
+    def _angles(self):
+        """ Output angles from the estimated gravity direction in the sensor frame """
+        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
+        gravityX = 2 * (q1 * q3 - q0 * q2)
+        gravityY = 2 * (q0 * q1 + q2 * q3)
+        gravityZ = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+
+        self.angle[:] = gravityAngles(gravityX, gravityY, gravityZ)
+        return self.angle.copy()
+
+    @staticmethod
+    def _gradientIMU(q0, q1, q2, q3, ax, ay, az):
+        """ Gradient of the accelerometer objective function """
+        _2q0, _2q1, _2q2, _2q3 = 2 * q0, 2 * q1, 2 * q2, 2 * q3
+        _4q0, _4q1, _4q2 = 4 * q0, 4 * q1, 4 * q2
+        _8q1, _8q2 = 8 * q1, 8 * q2
+        q0q0, q1q1, q2q2, q3q3 = q0 * q0, q1 * q1, q2 * q2, q3 * q3
+
+        s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+        s1 = _4q1 * q3q3 - _2q3 * ax + 4 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+        s2 = 4 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+        s3 = 4 * q1q1 * q3 - _2q1 * ax + 4 * q2q2 * q3 - _2q2 * ay
+        return s0, s1, s2, s3
+
+    @staticmethod
+    def _gradientMARG(q0, q1, q2, q3, ax, ay, az, mx, my, mz):
+        """ Gradient of the combined accelerometer and magnetometer objective function """
+        magNorm = math.sqrt(mx * mx + my * my + mz * mz)
+        mx /= magNorm
+        my /= magNorm
+        mz /= magNorm
+
+        _2q0mx, _2q0my, _2q0mz, _2q1mx = 2 * q0 * mx, 2 * q0 * my, 2 * q0 * mz, 2 * q1 * mx
+        _2q0, _2q1, _2q2, _2q3 = 2 * q0, 2 * q1, 2 * q2, 2 * q3
+        _2q0q2, _2q2q3 = 2 * q0 * q2, 2 * q2 * q3
+        q0q0, q0q1, q0q2, q0q3 = q0 * q0, q0 * q1, q0 * q2, q0 * q3
+        q1q1, q1q2, q1q3 = q1 * q1, q1 * q2, q1 * q3
+        q2q2, q2q3, q3q3 = q2 * q2, q2 * q3, q3 * q3
+
+        # Reference direction of Earth's magnetic field
+        hx = mx * q0q0 - _2q0my * q3 + _2q0mz * q2 + mx * q1q1 + _2q1 * my * q2 + _2q1 * mz * q3 - mx * q2q2 - mx * q3q3
+        hy = _2q0mx * q3 + my * q0q0 - _2q0mz * q1 + _2q1mx * q2 - my * q1q1 + my * q2q2 + _2q2 * mz * q3 - my * q3q3
+        _2bx = math.sqrt(hx * hx + hy * hy)
+        _2bz = -_2q0mx * q2 + _2q0my * q1 + mz * q0q0 + _2q1mx * q3 - mz * q1q1 + _2q2 * my * q3 - mz * q2q2 + mz * q3q3
+        _4bx, _4bz = 2 * _2bx, 2 * _2bz
+
+        # Objective function errors
+        fAx = 2 * q1q3 - _2q0q2 - ax
+        fAy = 2 * q0q1 + _2q2q3 - ay
+        fAz = 1 - 2 * q1q1 - 2 * q2q2 - az
+        fMx = _2bx * (0.5 - q2q2 - q3q3) + _2bz * (q1q3 - q0q2) - mx
+        fMy = _2bx * (q1q2 - q0q3) + _2bz * (q0q1 + q2q3) - my
+        fMz = _2bx * (q0q2 + q1q3) + _2bz * (0.5 - q1q1 - q2q2) - mz
+
+        s0 = -_2q2 * fAx + _2q1 * fAy - _2bz * q2 * fMx + (-_2bx * q3 + _2bz * q1) * fMy + _2bx * q2 * fMz
+        s1 = _2q3 * fAx + _2q0 * fAy - 4 * q1 * fAz + _2bz * q3 * fMx + (_2bx * q2 + _2bz * q0) * fMy + (_2bx * q3 - _4bz * q1) * fMz
+        s2 = -_2q0 * fAx + _2q3 * fAy - 4 * q2 * fAz + (-_4bx * q2 - _2bz * q0) * fMx + (_2bx * q1 + _2bz * q3) * fMy + (_2bx * q0 - _4bz * q2) * fMz
+        s3 = _2q1 * fAx + _2q2 * fAy + (-_4bx * q3 + _2bz * q1) * fMx + (-_2bx * q0 + _2bz * q2) * fMy + _2bx * q1 * fMz
+        return s0, s1, s2, s3
@@ -1 +1,372 @@
-# TODO: write
\ No newline at end of file
+#!/usr/bin/python
+#
+#   This file is for low-level communication with the IMU
+
+import struct
+import time
+
+try:
+    import smbus
+    bus = smbus.SMBus(0)
+except ImportError:     # No I2C on this machine (running off-device) -- fall back to the simulated bus
+    import fakesmbus
+    print("smbus not available, using simulated I2C bus")
+    bus = fakesmbus.FakeSMBus()
+
+# Set values for communicating with the LIS3MDL
+LIS3MDL_ADDRESS     = 0x1C
+
+LIS3MDL_WHO_AM_I    = 0x0F
+
+LIS3MDL_CTRL_REG1   = 0x20
+
+LIS3MDL_CTRL_REG2   = 0x21
+LIS3MDL_CTRL_REG3   = 0x22
+LIS3MDL_CTRL_REG4   = 0x23
+LIS3MDL_CTRL_REG5   = 0x24
+
+LIS3MDL_STATUS_REG  = 0x27
+
+LIS3MDL_OUT_X_L     = 0x28
+LIS3MDL_OUT_X_H     = 0x29
+LIS3MDL_OUT_Y_L     = 0x2A
+LIS3MDL_OUT_Y_H     = 0x2B
+LIS3MDL_OUT_Z_L     = 0x2C
+LIS3MDL_OUT_Z_H     = 0x2D
+
+LIS3MDL_TEMP_OUT_L  = 0x2E
+LIS3MDL_TEMP_OUT_H  = 0x2F
+
+LIS3MDL_INT_CFG     = 0x30
+LIS3MDL_INT_SRC     = 0x31
+LIS3MDL_INT_THS_L   = 0x32
+LIS3MDL_INT_THS_H   = 0x33
+
+LIS3MDL_AUTO_INCREMENT = 0x80   # Set the MSB of the register address to auto-increment during multi byte reads
+
+# Set values for communicating with the LSM6DSL
+LSM6DSL_ADDRESS          =  0x6A
+
+LSM6DSL_WHO_AM_I         =  0x0F
+LSM6DSL_RAM_ACCESS       =  0x01
+LSM6DSL_CTRL1_XL         =  0x10
+LSM6DSL_CTRL8_XL         =  0x17
+LSM6DSL_CTRL2_G          =  0x11
+LSM6DSL_CTRL10_C         =  0x19
+LSM6DSL_TAP_CFG1         =  0x58
+LSM6DSL_INT1_CTR         =  0x0D
+LSM6DSL_DRDY_PULSE_CFG_G =  0x0B
+LSM6DSL_CTRL3_C          =  0x12
+LSM6DSL_CTRL4_C          =  0x13
+LSM6DSL_CTRL6_C          =  0x15
+LSM6DSL_CTRL7_G          =  0x16
+
+LSM6DSL_STEP_COUNTER_L       =  0x4B
+LSM6DSL_STEP_COUNTER_H       =  0x4C
+
+LSM6DSL_OUTX_L_XL        =  0x28
+LSM6DSL_OUTX_H_XL        =  0x29
+LSM6DSL_OUTY_L_XL        =  0x2A
+LSM6DSL_OUTY_H_XL        =  0x2B
+LSM6DSL_OUTZ_L_XL        =  0x2C
+LSM6DSL_OUTZ_H_XL        =  0x2D
+
+LSM6DSL_OUT_L_TEMP       =  0x20
+LSM6DSL_OUT_H_TEMP       =  0x21
+
+LSM6DSL_OUTX_L_G         =  0x22
+LSM6DSL_OUTX_H_G         =  0x23
+LSM6DSL_OUTY_L_G         =  0x24
+LSM6DSL_OUTY_H_G         =  0x25
+LSM6DSL_OUTZ_L_G         =  0x26
+LSM6DSL_OUTZ_H_G         =  0x27
+
+LSM6DSL_TAP_CFG          =  0x58
+LSM6DSL_WAKE_UP_SRC      =  0x1B
+LSM6DSL_WAKE_UP_DUR      =  0x5C
+LSM6DSL_FREE_FALL        =  0x5D
+LSM6DSL_MD1_CFG          =  0x5E
+LSM6DSL_MD2_CFG          =  0x5F
+LSM6DSL_TAP_THS_6D       =  0x59
+LSM6DSL_INT_DUR2         =  0x5A
+LSM6DSL_WAKE_UP_THS      =  0x5B
+LSM6DSL_FUNC_SRC1        =  0x53
+
+LSM6DSL_FIFO_CTRL1       =  0x06
+LSM6DSL_FIFO_CTRL2       =  0x07
+LSM6DSL_FIFO_CTRL3       =  0x08
+LSM6DSL_FIFO_CTRL4       =  0x09
+LSM6DSL_FIFO_CTRL5       =  0x0A
+LSM6DSL_FIFO_STATUS1     =  0x3A
+LSM6DSL_FIFO_STATUS2     =  0x3B
+LSM6DSL_FIFO_STATUS3     =  0x3C
+LSM6DSL_FIFO_STATUS4     =  0x3D
+LSM6DSL_FIFO_DATA_OUT_L  =  0x3E
+LSM6DSL_FIFO_DATA_OUT_H  =  0x3F
+
+# Output data rate settings (Hz: ODR bits) -- the same codes are used for CTRL1_XL, CTRL2_G and FIFO_CTRL5
+ODR = {
+    12.5:   0b0001,
+    26:     0b0010,
+    52:     0b0011,
+    104:    0b0100,
+    208:    0b0101,
+    416:    0b0110,
+    833:    0b0111,
+    1660:   0b1000,
+    3330:   0b1001,
+    6660:   0b1010,
+}
+FIFO_ODR = ODR
+
+# LSM6DSL full scale settings
+ACC_FS = {      # +/- g: FS_XL bits
+    2:      0b00,
+    4:      0b10,
+    8:      0b11,
+    16:     0b01,
+}
+GYR_FS = {      # +/- dps: FS_G bits
+    245:    0b00,
+    500:    0b01,
+    1000:   0b10,
+    2000:   0b11,
+}
+GYR_GAIN = {    # +/- dps: deg/s/LSB
+    245:    0.00875,
+    500:    0.0175,
+    1000:   0.035,
+    2000:   0.070,
+}
+XL_HM_MODE_DISABLED = 0b00010000    # CTRL6_C: accelerometer low-power/normal mode instead of high-performance
+G_HM_MODE_DISABLED  = 0b10000000    # CTRL7_G: gyro low-power/normal mode instead of high-performance
+
+# LIS3MDL settings
+MAG_ODR = {     # Hz: DO bits
+    0.625:  0b000,
+    1.25:   0b001,
+    2.5:    0b010,
+    5:      0b011,
+    10:     0b100,
+    20:     0b101,
+    40:     0b110,
+    80:     0b111,
+}
+MAG_FS = {      # +/- gauss: FS bits
+    4:      0b00,
+    8:      0b01,
+    12:     0b10,
+    16:     0b11,
+}
+MAG_MODE = {    # Operating mode: OM/OMZ bits -- higher modes are less noisy but draw more current
+    'low':      0b00,
+    'medium':   0b01,
+    'high':     0b10,
+    'ultra':    0b11,
+}
+MAG_POWER_DOWN = 0b11   # CTRL_REG3 MD bits
+
+# FIFO settings
+FIFO_MODE_BYPASS        = 0b000
+FIFO_MODE_CONTINUOUS    = 0b110
+FIFO_SIZE_WORDS         = 2048  # 4 kbyte FIFO, 16 bit words
+FIFO_SAMPLE_WORDS       = 6     # Gyro XYZ then accelerometer XYZ per sample (pattern 0..5)
+FIFO_READ_CHUNK         = 32    # SMBus block reads are limited to 32 bytes
+
+# Data-ready interrupt
+INT1_DRDY_G             = 0b00000010    # INT1_CTRL: gyro data ready on INT1
+DRDY_PULSED             = 0b10000000    # DRDY_PULSE_CFG_G: 75 us pulse per sample instead of latching until read
+
+# Burst read layout
+# Gyro and accelerometer output registers are contiguous on the LSM6DSL (OUTX_L_G .. OUTZ_H_XL),
+# so a single 12 byte read gets both; the magnetometer is a separate 6 byte read
+ACCGYR_BLOCK_LENGTH = 12
+MAG_BLOCK_LENGTH    = 6
+
+def detectIMU():
+    #Detect which version of BerryIMU is connected using the 'who am i' register
+    #BerryIMUv3 uses the LSM6DSL and LIS3MDL
+
+    try:
+        #Check for BerryIMUv3 (LSM6DSL and LIS3MDL)
+        #If no LSM6DSL or LIS3MDL is connected, there will be an I2C bus error and the program will exit.
+        #This section of code stops this from happening.
+        LSM6DSL_WHO_AM_I_response = (bus.read_byte_data(LSM6DSL_ADDRESS, LSM6DSL_WHO_AM_I))
+        LIS3MDL_WHO_AM_I_response = (bus.read_byte_data(LIS3MDL_ADDRESS, LIS3MDL_WHO_AM_I))
+
+    except IOError as f:
+        return False    # IMU detection failed
+    else:
+        if (LSM6DSL_WHO_AM_I_response == 0x6A) and (LIS3MDL_WHO_AM_I_response == 0x3D):
+            print("Found BerryIMUv3 (LSM6DSL and LIS3MDL)")
+            return True # IMU detection success
+
+def writeByte(device_address,register,value):
+    bus.write_byte_data(device_address, register, value)
+
+# Set up memory for last values in case physical i2c connection is spotty
+accgyr_last = [0] * ACCGYR_BLOCK_LENGTH
+mag_last = [0] * MAG_BLOCK_LENGTH
+
+def decodeACCGYR(block):
+    """
+    Decode a raw LSM6DSL output block into signed axis values
+    Returns (ACCx, ACCy, ACCz, GYRx, GYRy, GYRz)
+    """
+    GYRx, GYRy, GYRz, ACCx, ACCy, ACCz = struct.unpack('<6h', bytes(block))   # Little-endian 16 bit two's complement, gyro registers come first
+    return ACCx, ACCy, ACCz, GYRx, GYRy, GYRz
+
+def decodeMAG(block):
+    """
+    Decode a raw LIS3MDL output block into signed axis values
+    Returns (MAGx, MAGy, MAGz)
+    """
+    return struct.unpack('<3h', bytes(block))
+
+def readACCGYR():
+    """
+    Read all accelerometer and gyro axes in one I2C transaction
+    Returns (ACCx, ACCy, ACCz, GYRx, GYRy, GYRz)
+    """
+    global accgyr_last
+
+    try:
+        accgyr_last = bus.read_i2c_block_data(LSM6DSL_ADDRESS, LSM6DSL_OUTX_L_G, ACCGYR_BLOCK_LENGTH)
+    except IOError as e:
+        pass    # Reuse the last good block
+
+    return decodeACCGYR(accgyr_last)
+
+def readMAG():
+    """
+    Read all magnetometer axes in one I2C transaction
+    Returns (MAGx, MAGy, MAGz)
+    """
+    global mag_last
+
+    try:
+        mag_last = bus.read_i2c_block_data(LIS3MDL_ADDRESS, LIS3MDL_OUT_X_L | LIS3MDL_AUTO_INCREMENT, MAG_BLOCK_LENGTH)
+    except IOError as e:
+        pass    # Reuse the last good block
+
+    return decodeMAG(mag_last)
+
+def initFIFO(odr=104, watermark=16):
+    """
+    Set up the LSM6DSL FIFO to collect accelerometer and gyro samples in the background
+        odr         Hz      Rate samples are stored in the FIFO -- must be a key of FIFO_ODR
+        watermark   int     Number of samples that count as a batch ready to drain
+    """
+    watermarkWords = watermark * FIFO_SAMPLE_WORDS
+
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL5, FIFO_MODE_BYPASS)                      # Bypass mode first to clear out any old data
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL1, watermarkWords & 0xFF)                 # Watermark threshold, low byte
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL2, (watermarkWords >> 8) & 0b111)         # Watermark threshold, high bits
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL3, 0b00001001)                            # Gyro and accelerometer in FIFO, no decimation
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL5, FIFO_ODR[odr] << 3 | FIFO_MODE_CONTINUOUS) # FIFO ODR, continuous mode (oldest data overwritten when full)
+
+def disableFIFO():
+    """ Return the FIFO to bypass mode """
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_FIFO_CTRL5, FIFO_MODE_BYPASS)
+
+def readFIFOStatus():
+    """
+    Read the FIFO status registers
+    Returns (unread words, watermark reached, overrun, pattern of the next word)
+    """
+    status = bus.read_i2c_block_data(LSM6DSL_ADDRESS, LSM6DSL_FIFO_STATUS1, 4)
+    unreadWords = status[0] | (status[1] & 0b111) << 8
+    watermarkReached = bool(status[1] & 0b10000000)
+    overrun = bool(status[1] & 0b01000000)
+    empty = bool(status[1] & 0b00010000)
+    if unreadWords == 0 and not empty:      # DIFF_FIFO is 11 bits, so a completely full FIFO reads as 0
+        unreadWords = FIFO_SIZE_WORDS
+    pattern = status[2] | (status[3] & 0b11) << 8
+    return unreadWords, watermarkReached, overrun, pattern
+
+def readFIFO():
+    """
+    Drain every complete sample currently in the FIFO
+    Returns (samples, overrun) where samples is a list of (ACCx, ACCy, ACCz, GYRx, GYRy, GYRz), oldest first
+    """
+    unreadWords, watermarkReached, overrun, pattern = readFIFOStatus()
+
+    # After an overrun the oldest words were overwritten, so the next word may be
+    # partway through a sample -- discard words until we're aligned to a gyro X word again
+    if pattern != 0:
+        skipWords = min(FIFO_SAMPLE_WORDS - pattern, unreadWords)
+        bus.read_i2c_block_data(LSM6DSL_ADDRESS, LSM6DSL_FIFO_DATA_OUT_L, skipWords * 2)
+        unreadWords -= skipWords
+
+    # Read whole samples in chunks of at most FIFO_READ_CHUNK bytes
+    # The address pointer rolls back from FIFO_DATA_OUT_H to FIFO_DATA_OUT_L, so each chunk is consecutive FIFO words
+    remaining = (unreadWords // FIFO_SAMPLE_WORDS) * FIFO_SAMPLE_WORDS * 2
+    data = bytearray()
+    while remaining > 0:
+        length = min(remaining, FIFO_READ_CHUNK)
+        data += bytes(bus.read_i2c_block_data(LSM6DSL_ADDRESS, LSM6DSL_FIFO_DATA_OUT_L, length))
+        remaining -= length
+
+    sampleBytes = FIFO_SAMPLE_WORDS * 2
+    samples = [decodeACCGYR(data[i:i + sampleBytes]) for i in range(0, len(data), sampleBytes)]
+    return samples, overrun
+
+def configureAccGyr(odr=3330, accRange=8, gyrRange=2000, highPerformance=True):
+    """
+    Set the accelerometer and gyro output data rate, full scale and power mode
+        odr             Hz      Output data rate for both -- must be a key of ODR
+        accRange        g       Accelerometer full scale -- must be a key of ACC_FS
+        gyrRange        dps     Gyro full scale -- must be a key of GYR_FS
+        highPerformance bool    High-performance mode -- otherwise low-power (up to 52 Hz) or normal mode (104-208 Hz)
+    """
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL6_C, 0 if highPerformance else XL_HM_MODE_DISABLED)
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL7_G, 0 if highPerformance else G_HM_MODE_DISABLED)
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL1_XL, ODR[odr] << 4 | ACC_FS[accRange] << 2 | 0b11)  # BW = 400hz
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL2_G, ODR[odr] << 4 | GYR_FS[gyrRange] << 2)
+
+def configureMag(odr=80, magRange=8, mode='high'):
+    """
+    Set the magnetometer output data rate, full scale and operating mode
+        odr         Hz      Output data rate -- must be a key of MAG_ODR, or None to power it down
+        magRange    gauss   Full scale -- must be a key of MAG_FS
+        mode        str     Operating mode for all three axes -- must be a key of MAG_MODE
+    """
+    if odr is None:
+        writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG3, MAG_POWER_DOWN)
+        return
+
+    writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG1, 0b10000000 | MAG_MODE[mode] << 5 | MAG_ODR[odr] << 2)  # Temp sensor enabled, X and Y mode, ODR
+    writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG2, MAG_FS[magRange] << 5)
+    writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG4, MAG_MODE[mode] << 2)                                 # Z mode
+    writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG3, 0b00000000)                                          # Continuous-conversion mode
+
+def enableDataReadyInterrupt():
+    """ Pulse INT1 each time a new gyro sample is ready """
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_DRDY_PULSE_CFG_G, DRDY_PULSED)
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_INT1_CTR, INT1_DRDY_G)
+
+def disableDataReadyInterrupt():
+    writeByte(LSM6DSL_ADDRESS,LSM6DSL_INT1_CTR, 0)
+
+def initIMU():
+    # 10 tries to connect
+    # TODO: Handle failure to connect
+    for i in range(10):
+        try:
+            #initialise the accelerometer
+            writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL1_XL,0b10011111)           #ODR 3.33 kHz, +/- 8g , BW = 400hz
+            writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL8_XL,0b11001000)           #Low pass filter enabled, BW9, composite filter
+            writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL3_C,0b01000100)            #Enable Block Data update, increment during multi byte read
+
+            #initialise the gyroscope
+            writeByte(LSM6DSL_ADDRESS,LSM6DSL_CTRL2_G,0b10011100)            #ODR 3.3 kHz, 2000 dps
+
+            #initialise the magnetometer
+            writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG1, 0b11011100)         # Temp sesnor enabled, High performance, ODR 80 Hz, FAST ODR disabled and Selft test disabled.
+            writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG2, 0b00100000)         # +/- 8 gauss
+            writeByte(LIS3MDL_ADDRESS,LIS3MDL_CTRL_REG3, 0b00000000)         # Continuous-conversion mode
+        except IOError as e:
+            time.sleep(0.1)  # Try and give her a sec to right herself
+            continue
+        else:
+            break
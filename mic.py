@@ -1 +1,227 @@
-# TODO: write
\ No newline at end of file
+# Microphone: sound level and coarse spectrum
+#
+# Audio is captured in fixed-size chunks into preallocated buffers, and each chunk is
+# analysed as a whole with NumPy -- RMS and peak level plus the energy in a few frequency
+# bands -- so the sensor costs one small FFT per read and no per-sample Python work.
+# A WAV file can stand in for the sound card when running off-device
+
+import threading
+import time
+import wave
+
+import numpy as np
+
+try:
+    import sounddevice
+except ImportError:     # No sound card support installed
+    sounddevice = None
+
+SAMPLE_RATE = 16000     # Capture rate in Hz
+CHUNK_SIZE = 800        # Samples per chunk: 50 ms, one per read at 20 reads/s
+BANDS = {               # Coarse spectral bands, name: (low Hz, high Hz)
+    'lowBand':      (20, 300),      # Rumble, footsteps, handling noise
+    'voiceBand':    (300, 3000),    # Speech
+    'highBand':     (3000, 8000),   # Hiss, clatter
+}
+SILENCE_DB = -120       # Level reported for digital silence instead of -inf
+
+CHANNELS = ['audio', 'level', 'peak'] + list(BANDS)    # Keys of each reading, for the Sensor
+
+class ChunkSource:
+    """
+    Base class for audio sources
+    Subclasses fill chunks of CHUNK_SIZE float samples in -1..1 and call finish() after each one --
+    possibly from another thread, so readers get a copy of the chunk rather than the buffer itself
+    """
+    def __init__(self, chunkSize=CHUNK_SIZE, sampleRate=SAMPLE_RATE):
+        """
+        chunkSize   int     Samples per chunk
+        sampleRate  int     Samples per second
+        """
+        self.chunkSize = chunkSize
+        self.sampleRate = sampleRate
+        self.buffers = np.zeros((2, chunkSize), dtype=np.float32)  # Two chunks: one being filled while the other is read
+        self.filling = 0        # Index of the buffer being filled
+        self.chunks = 0         # Number of chunks completed
+        self.chunk = np.zeros(chunkSize, dtype=np.float32)     # The reader's copy of the latest chunk
+        self.lock = threading.Lock()                            # Keeps filling and chunks in step, and the buffer still while it's copied
+
+    def finish(self):
+        """ The filling buffer is complete -- publish it and start filling the other one """
+        with self.lock:
+            self.filling ^= 1
+            self.chunks += 1
+
+    def latest(self):
+        """
+        The most recently completed chunk, and its number
+        The chunk is copied into an array of the reader's own, which stays put until the next call
+        """
+        with self.lock:
+            np.copyto(self.chunk, self.buffers[self.filling ^ 1])
+            return self.chunk, self.chunks
+
+    def close(self):
+        pass
+
+class SoundDeviceSource(ChunkSource):
+    """ Live capture from a sound card with sounddevice """
+    def __init__(self, device=None, chunkSize=CHUNK_SIZE, sampleRate=SAMPLE_RATE):
+        """
+        device  int/str     sounddevice input device, None for the default
+        """
+        super(SoundDeviceSource, self).__init__(chunkSize, sampleRate)
+        self.stream = sounddevice.InputStream(
+            device=device,
+            channels=1,
+            samplerate=sampleRate,
+            blocksize=chunkSize,        # One callback per chunk
+            dtype='float32',
+            callback=self.capture,      # Runs on PortAudio's own thread
+        )
+        self.stream.start()
+
+    def capture(self, indata, frames, time, status):
+        np.copyto(self.buffers[self.filling], indata[:, 0])
+        self.finish()
+
+    def close(self):
+        self.stream.close()
+
+class WAVSource(ChunkSource):
+    """
+    Audio from a WAV file, for running without a sound card
+    Plays back in real time by default, looping at the end -- or call advance() to step through it by hand
+    """
+    def __init__(self, path, realtime=True, loop=True, chunkSize=CHUNK_SIZE):
+        """
+        path        str     WAV file of 8, 16 or 32 bit PCM -- only the first channel is used
+        realtime    bool    Serve chunks as the file's playing time passes, instead of on advance()
+        loop        bool    Start again at the end of the file, instead of going silent
+        """
+        with wave.open(path, 'rb') as file:
+            width = file.getsampwidth()
+            channels = file.getnchannels()
+            sampleRate = file.getframerate()
+            frames = file.readframes(file.getnframes())
+
+        if width == 1:      # 8 bit WAV is unsigned
+            audio = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+        elif width in (2, 4):
+            audio = np.frombuffer(frames, dtype=f'<i{width}').astype(np.float32) / 2 ** (8 * width - 1)
+        else:
+            raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+
+        super(WAVSource, self).__init__(chunkSize, sampleRate)
+        self.audio = audio[::channels]          # First channel only
+        self.realtime = realtime
+        self.loop = loop
+        self.position = 0                       # Index in audio of the next chunk
+        self.start = time.perf_counter()
+
+    def advance(self):
+        """ Copy the next chunk of the file into the filling buffer """
+        buffer = self.buffers[self.filling]
+        if self.loop:
+            self.position %= len(self.audio)
+        chunk = self.audio[self.position:self.position + self.chunkSize]
+        buffer[:len(chunk)] = chunk
+        if self.loop:                           # Wrap around, for files shorter than a chunk too
+            filled = len(chunk)
+            while filled < self.chunkSize:
+                chunk = self.audio[:self.chunkSize - filled]
+                buffer[filled:filled + len(chunk)] = chunk
+                filled += len(chunk)
+        else:
+            buffer[len(chunk):] = 0             # Silence after the end
+        self.position += self.chunkSize
+        self.finish()
+
+    def latest(self):
+        if self.realtime:   # Catch up to the chunk that would have just finished playing
+            due = int((time.perf_counter() - self.start) * self.sampleRate) // self.chunkSize
+            if due > self.chunks:
+                self.position += (due - self.chunks - 1) * self.chunkSize   # Skip chunks nobody read
+                self.chunks = due - 1
+                self.advance()
+        return super(WAVSource, self).latest()
+
+def source(device=None, wavPath=None):
+    """
+    Audio source: wavPath if given, else the sound card
+    Returns None, so the sensor stays unhooked, when there's no way to capture audio
+    """
+    if wavPath is not None:
+        return WAVSource(wavPath)
+    if sounddevice is None:
+        print("sounddevice not available, microphone disabled")
+        return None
+    return SoundDeviceSource(device)
+
+class Microphone:
+    """
+    Level and band energies of the latest chunk -- usable as a Sensor updateFunction
+    """
+    def __init__(self, source, bands=BANDS):
+        """
+        source  ChunkSource     Where the audio comes from
+        bands   dict            Frequency bands to report the energy of, name: (low Hz, high Hz)
+        """
+        self.source = source
+        self.window = np.hanning(source.chunkSize).astype(np.float32)  # Taper the chunk edges for the FFT
+        self.windowed = np.empty(source.chunkSize, dtype=np.float32)
+
+        # Each band is a contiguous run of FFT bins, so band energies are sums over slices of one power spectrum
+        binHz = source.sampleRate / source.chunkSize
+        bins = source.chunkSize // 2 + 1
+        self.bands = {
+            name: slice(min(int(np.ceil(low / binHz)), bins), min(int(np.ceil(high / binHz)), bins))
+            for name, (low, high) in bands.items()
+        }
+        self.scale = 2 / (source.chunkSize * np.dot(self.window, self.window))     # One-sided power spectrum to mean square
+
+        self.chunk = None       # Number of the last chunk analysed
+        self.reading = dict.fromkeys(CHANNELS[:3] + list(bands), 0.0)
+
+    def __call__(self):
+        """ Analyse the latest chunk, or return the last reading again if no new chunk has arrived """
+        audio, chunk = self.source.latest()
+        if chunk != self.chunk:
+            self.chunk = chunk
+            self.analyse(audio)
+        return self.reading
+
+    def analyse(self, audio):
+        """ Update the reading from one chunk of samples """
+        reading = self.reading
+        rms = float(np.sqrt(np.dot(audio, audio) / len(audio)))
+        peak = float(max(audio.max(), -audio.min()))
+
+        reading['audio'] = rms                  # RMS amplitude, 0..1 of full scale
+        reading['level'] = decibels(rms)        # RMS level in dBFS
+        reading['peak'] = decibels(peak)        # Peak level in dBFS
+
+        np.multiply(audio, self.window, out=self.windowed)
+        spectrum = np.fft.rfft(self.windowed)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        for name, bins in self.bands.items():
+            reading[name] = decibels(np.sqrt(power[bins].sum() * self.scale))   # Band RMS in dBFS
+
+    def close(self):
+        self.source.close()
+
+def decibels(amplitude):
+    """ Amplitude relative to full scale in dBFS """
+    if amplitude <= 0:
+        return SILENCE_DB
+    return max(20 * float(np.log10(amplitude)), SILENCE_DB)
+
+if __name__ == "__main__":
+    import sys
+
+    # python mic.py [file.wav]  -- print the levels from the sound card or a WAV file
+    microphone = Microphone(source(wavPath=sys.argv[1] if len(sys.argv) > 1 else None))
+    while True:
+        time.sleep(CHUNK_SIZE / SAMPLE_RATE)
+        reading = microphone()
+        print('  '.join(f"{key} {value:7.1f}" for key, value in reading.items()))
@@ -0,0 +1,104 @@
+# Interrupt lines for pacing the sampling
+#
+# Lets the scheduler wake the IMU task once per sample on the IMU's data-ready interrupt
+# when one is wired to a GPIO pin, instead of on a fixed-rate schedule.
+# The time spent waiting is handed back to Flask-SocketIO and the other threads
+
+import random
+import threading
+import time
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:     # Not running on a Pi
+    GPIO = None
+
+EDGE_TIMEOUT_PERIODS = 4    # Number of sample periods to wait for an interrupt before giving up on it
+
+class EdgeSource:
+    """
+    Rising edges on an interrupt line
+    Edges are latched, so one that arrives while the loop is busy is picked up by the next wait()
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.edges = 0                  # Number of edges seen
+
+    def edge(self, *args):
+        """ Register an edge -- used as the interrupt callback """
+        self.edges += 1
+        self.event.set()
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for an edge, and return whether one arrived """
+        if self.event.wait(timeout):
+            self.event.clear()
+            return True
+        return False
+
+    def setRate(self, rate):
+        """ Follow a change of sample rate -- real interrupts already follow the IMU's output data rate """
+        pass
+
+    def close(self):
+        pass
+
+class GPIOEdgeSource(EdgeSource):
+    """ Interrupt line wired to a GPIO pin """
+    def __init__(self, pin):
+        """
+        pin     int     Board pin number the interrupt is wired to
+        """
+        super(GPIOEdgeSource, self).__init__()
+        self.pin = pin
+
+        GPIO.setmode(GPIO.BOARD)                                        # Same pin numbering as the buzzer
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        GPIO.add_event_detect(pin, GPIO.RISING, callback=self.edge)     # Callback runs on RPi.GPIO's own thread
+
+    def close(self):
+        GPIO.remove_event_detect(self.pin)
+
+class FakeEdgeSource(EdgeSource):
+    """
+    Simulated interrupt line for running off-device
+    Produces edges at a fixed rate from a background thread, or call edge() directly to drive it by hand
+    """
+    def __init__(self, rate=None, jitter=0):
+        """
+        rate    float   Edges per second, None to only produce edges when edge() is called
+        jitter  float   Random extra delay added to each period, in seconds
+        """
+        super(FakeEdgeSource, self).__init__()
+        self.rate = rate
+        self.jitter = jitter
+        self.stopEvent = threading.Event()
+
+        if rate:
+            self.thread = threading.Thread(target=self.generate, daemon=True)
+            self.thread.start()
+
+    def generate(self):
+        nextEdge = time.perf_counter()
+        while not self.stopEvent.is_set():
+            nextEdge += 1 / self.rate
+            delay = nextEdge - time.perf_counter() + random.uniform(0, self.jitter)
+            if self.stopEvent.wait(max(delay, 0)):
+                break
+            self.edge()
+
+    def setRate(self, rate):
+        self.rate = rate
+
+    def close(self):
+        self.stopEvent.set()
+
+def interruptSource(pin, rate):
+    """
+    Edge source for the data-ready interrupt wired to pin
+    Falls back to a simulated interrupt at rate Hz when RPi.GPIO isn't available
+    """
+    if GPIO is None:
+        print("RPi.GPIO not available, using simulated data-ready interrupt")
+        return FakeEdgeSource(rate)
+    return GPIOEdgeSource(pin)
@@ -0,0 +1,252 @@
+# Streaming sample pipelines
+#
+# A sensor's processing is declared as a chain of stages, e.g. source -> calibrate -> LPF -> median -> fuse -> derive.
+# Samples are dicts (or dict-like objects) of channel values and travel in batches -- one sample
+# when polling, many from a FIFO or a recording -- so live, batched and replayed data all go
+# through the same code. Each stage keeps its own state and timing, and the generic stages
+# here can be used in any sensor's chain
+
+import time
+
+import numpy as np
+
+import rolling
+
+def _resolve(value):
+    """ Stage settings may be given as a function, to be looked up afresh for every batch """
+    return value() if callable(value) else value
+
+def _perChannel(value, count):
+    """ Broadcast a scalar setting to one per channel """
+    if isinstance(value, (int, float)):
+        return [value] * count
+    return list(value)
+
+class Stage:
+    """
+    Base class for pipeline stages
+    Subclasses implement process() for a batch of samples
+    """
+    def __init__(self, name=None):
+        """
+        name    str     Name to report timings under -- defaults to the class name
+        """
+        self.name = name or type(self).__name__
+        self.time = 0.0         # Seconds spent in this stage
+        self.samples = 0        # Number of samples processed
+
+    def process(self, batch):
+        """ Process a list of samples, oldest first, and return the resulting list """
+        raise NotImplementedError
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        batch = self.process(batch)
+        self.time += time.perf_counter() - start
+        self.samples += len(batch)
+        return batch
+
+    def resetTiming(self):
+        self.time = 0.0
+        self.samples = 0
+
+    def stream(self, batches):
+        """ Generator applying the stage to each batch from an iterable of batches """
+        for batch in batches:
+            yield self(batch)
+
+class Derive(Stage):
+    """ Call a function on each sample, to add values calculated from the others """
+    def __init__(self, function, name=None):
+        """
+        function    func    Called with each sample -- sets new keys on it
+        """
+        super(Derive, self).__init__(name or function.__name__)
+        self.function = function
+
+    def process(self, batch):
+        for sample in batch:
+            self.function(sample)
+        return batch
+
+class Calibrate(Stage):
+    """ Linear correction: output = input * gain - offset, per channel """
+    def __init__(self, channels, outputs=None, gain=1, offset=0, name=None):
+        """
+        channels    list            Channels to read
+        outputs     list            Channels to write, one per input -- defaults to overwriting the inputs
+        gain        float/list      Gain for all channels or for each -- or a function returning either
+        offset      float/list      Offset for all channels or for each -- or a function returning either
+        """
+        super(Calibrate, self).__init__(name)
+        self.channels = list(channels)
+        self.outputs = list(outputs or channels)
+        self.gain = gain
+        self.offset = offset
+
+    def process(self, batch):
+        gains = _perChannel(_resolve(self.gain), len(self.channels))
+        offsets = _perChannel(_resolve(self.offset), len(self.channels))
+        for sample in batch:
+            for channel, output, gain, offset in zip(self.channels, self.outputs, gains, offsets):
+                sample[output] = sample[channel] * gain - offset
+        return batch
+
+class LowPass(Stage):
+    """ First order low pass filter on each channel """
+    def __init__(self, channels, factor, name=None):
+        """
+        channels    list    Channels to filter in place
+        factor      float   Weight of each new value -- lower is smoother but slower to respond
+        """
+        super(LowPass, self).__init__(name)
+        self.channels = list(channels)
+        self.factor = factor
+        self.previous = [0.0] * len(self.channels)  # Last output per channel
+
+    def process(self, batch):
+        factor = self.factor
+        previous = self.previous
+        for sample in batch:
+            for i, channel in enumerate(self.channels):
+                previous[i] = sample[channel] * factor + previous[i] * (1 - factor)
+                sample[channel] = previous[i]
+        return batch
+
+class Median(Stage):
+    """ Rolling median on each channel """
+    def __init__(self, channels, size, initial=1, name=None):
+        """
+        channels    list    Channels to filter in place
+        size        int     Number of values in each median window. Higher = smoother but a longer delay
+        initial     float   Value the windows start filled with
+        """
+        super(Median, self).__init__(name)
+        self.channels = list(channels)
+        self.medians = [rolling.RollingMedian(size, initial) for channel in self.channels]
+
+    def process(self, batch):
+        for sample in batch:
+            for channel, median in zip(self.channels, self.medians):
+                sample[channel] = median.update(sample[channel])
+        return batch
+
+class Fuse(Stage):
+    """ Combine accelerometer angles and gyro rates into device rotation with a fusion.FusionFilter """
+    def __init__(self, fusionFilter,
+            accAngles=('AccXangle', 'AccYangle', 'AccZangle'),
+            gyroRates=('gyroXrate', 'gyroYrate', 'gyroZrate'),
+            outputs=('angleX', 'angleY', 'angleZ'),
+            acc=('AccX', 'AccY', 'AccZ'),
+            mag=('MagX', 'MagY', 'MagZ'),
+            dt='loopTime',
+            name=None):
+        """
+        fusionFilter    FusionFilter    Filter to update -- or a function taking a sample and returning the filter for it
+        accAngles       list            Accelerometer angle channels
+        gyroRates       list            Gyro rate channels in deg/s
+        outputs         list            Channels to write the fused angles to
+        acc             list            Accelerometer vector channels
+        mag             list            Magnetometer vector channels -- only read for filters with useMag set
+        dt              str             Channel holding the seconds since the previous sample
+        """
+        super(Fuse, self).__init__(name)
+        self.fusionFilter = fusionFilter
+        self.accAngles = accAngles
+        self.gyroRates = gyroRates
+        self.outputs = outputs
+        self.acc = acc
+        self.mag = mag
+        self.dt = dt
+
+    def filterFor(self, sample):
+        """ The fusion filter for a sample """
+        fusionFilter = self.fusionFilter
+        if callable(fusionFilter):
+            fusionFilter = fusionFilter(sample)
+        return fusionFilter
+
+    def process(self, batch):
+        start = 0
+        while start < len(batch):   # Runs of samples for the same filter go through it together, see FusionFilter.process()
+            fusionFilter = self.filterFor(batch[start])
+            end = start + 1
+            while end < len(batch) and self.filterFor(batch[end]) is fusionFilter:
+                end += 1
+            self.fuse(fusionFilter, batch[start:end])
+            start = end
+        return batch
+
+    def fuse(self, fusionFilter, samples):
+        """ Run samples through fusionFilter and write the angles to them """
+        def columns(channels):
+            return np.array([[sample[channel] for channel in channels] for sample in samples])
+
+        if getattr(fusionFilter, 'useMag', False):  # Only filters that fuse the compass need it up front
+            mags = columns(self.mag)
+        else:
+            mags = None
+
+        angles = fusionFilter.process(
+            columns(self.accAngles),
+            columns(self.gyroRates),
+            [sample[self.dt] for sample in samples],
+            columns(self.acc),
+            mags,
+        ).tolist()
+        for sample, sampleAngles in zip(samples, angles):
+            for channel, angle in zip(self.outputs, sampleAngles):
+                sample[channel] = angle
+
+class Pipeline:
+    """
+    A chain of stages, optionally fed by a source
+    """
+    def __init__(self, stages, source=None):
+        """
+        stages  list        Stages in order
+        source  func        Returns the next batch (list of samples) to push through the chain when the pipeline is called --
+                            or an iterable of batches. A function can be called again after a batch raised, a generator can't
+        """
+        self.stages = list(stages)
+        self.source = source
+        self.batches = None         # Iterator over source, when it's an iterable -- started on first call
+
+    def process(self, batch):
+        """ Run one batch through every stage """
+        for stage in self.stages:
+            batch = stage(batch)
+        return batch
+
+    def run(self, batches):
+        """ Generator running each batch from an iterable through the chain """
+        stream = iter(batches)
+        for stage in self.stages:
+            stream = stage.stream(stream)
+        return stream
+
+    def withSource(self, source):
+        """ The same stages (and state), fed by source """
+        return Pipeline(self.stages, source)
+
+    def __call__(self):
+        """
+        Pull the next batch from the source and return it, oldest first -- usable as a Sensor updateFunction
+        Returns None if the source had nothing new
+        """
+        if callable(self.source):
+            batch = self.source()
+        else:
+            if self.batches is None:
+                self.batches = iter(self.source)
+            batch = next(self.batches)
+        batch = self.process(batch)     # Batch by batch, so a stage that raises doesn't take the pipeline down with it
+        return batch or None
+
+    def timings(self, reset=False):
+        """ Mean seconds per sample spent in each stage -- since the last reset if reset is used """
+        timings = {stage.name: stage.time / stage.samples if stage.samples else 0.0 for stage in self.stages}
+        if reset:
+            for stage in self.stages:
+                stage.resetTiming()
+        return timings
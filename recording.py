@@ -0,0 +1,93 @@
+# Loading recorded IMU data for offline tools
+#
+# Recordings are the motion snapshot CSVs written by Sensor.read() (IMU.csv), or
+# synthetic motion with a known ground truth for measuring filter accuracy
+
+import csv
+
+import numpy as np
+
+import fusion
+
+ACC_LSB_PER_G = 4098    # Accelerometer sensitivity at +/- 8g (0.244 mg/LSB)
+
+def loadRecording(path):
+    """
+    Load a motion snapshot CSV into NumPy arrays
+    Returns a dict of
+        dt      N       Seconds since the previous sample
+        acc     N x 3   Accelerometer readings (after the LPF/median filters)
+        gyro    N x 3   Gyro rates in degrees per second
+        mag     N x 3   Magnetometer readings
+    """
+    with open(path, newline='') as file:
+        rows = list(csv.DictReader(file))
+
+    def columns(*names):
+        return np.array([[float(row[name]) for name in names] for row in rows])
+
+    return {
+        'dt':   columns('loopTime')[:, 0],
+        'acc':  columns('AccX', 'AccY', 'AccZ'),
+        'gyro': columns('gyroXrate', 'gyroYrate', 'gyroZrate'),
+        'mag':  columns('MagX', 'MagY', 'MagZ'),
+    }
+
+def replay(data, batchSize=16):
+    """
+    Pipeline source: a recording as batches of samples with the same channel names as live IMU samples
+    The recorded values have already been through berryimu's filtering, so only later stages
+    (e.g. pipeline.Derive(berryimu.deriveAngles) and pipeline.Fuse) should be run on them
+    """
+    for start in range(0, len(data['dt']), batchSize):
+        end = min(start + batchSize, len(data['dt']))
+        yield [{
+            'loopTime':     data['dt'][i],
+            'AccX':         data['acc'][i, 0],
+            'AccY':         data['acc'][i, 1],
+            'AccZ':         data['acc'][i, 2],
+            'gyroXrate':    data['gyro'][i, 0],
+            'gyroYrate':    data['gyro'][i, 1],
+            'gyroZrate':    data['gyro'][i, 2],
+            'MagX':         data['mag'][i, 0],
+            'MagY':         data['mag'][i, 1],
+            'MagZ':         data['mag'][i, 2],
+        } for i in range(start, end)]
+
+def synthesiseRecording(seconds=60, rate=100, seed=0):
+    """
+    Generate wearer-like motion with noise, like a recording but with ground truth
+    Returns the same dict as loadRecording(), plus
+        truth   N x 3   True gravity angles (see fusion.gravityAngles) for each sample
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(seconds * rate)
+    dt = 1 / rate
+    t = np.arange(samples) * dt
+
+    # Angular velocity: a few slow sinusoids per axis, like leaning and turning, in rad/s
+    omega = np.zeros((samples, 3))
+    for axis in range(3):
+        for frequency, amplitude in zip(rng.uniform(0.05, 0.5, 3), rng.uniform(0.2, 1.5, 3)):
+            omega[:, axis] += amplitude * np.sin(2 * np.pi * frequency * t + rng.uniform(0, 2 * np.pi))
+
+    # Gravity seen from the sensor frame rotates opposite to the sensor
+    gravity = np.empty((samples, 3))
+    g = np.array([0.0, 0.0, 1.0])
+    for i in range(samples):
+        g = g - np.cross(omega[i], g) * dt
+        g /= np.linalg.norm(g)
+        gravity[i] = g
+
+    gyroBias = rng.normal(0, 1.0, 3)                                        # deg/s
+    gyro = np.degrees(omega) + gyroBias + rng.normal(0, 0.5, (samples, 3))  # deg/s
+    acc = (gravity + rng.normal(0, 0.03, (samples, 3))) * ACC_LSB_PER_G     # Noise and jolts from moving around
+    mag = np.zeros((samples, 3))                                            # Uncalibrated compass isn't used
+
+    return {
+        'dt':       np.full(samples, dt),
+        'acc':      acc,
+        'gyro':     gyro,
+        'mag':      mag,
+        'truth':    np.stack(fusion.gravityAngles(*gravity.T), axis=1),
+    }
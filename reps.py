@@ -0,0 +1,176 @@
+# Exercise repetition counting
+#
+# A rep is one swing of a motion channel from the rest position out to the working
+# position and back. The peak at rest and the valley at work are tracked on the fly, with
+# hysteresis so sensor noise doesn't count as movement, and each sample is O(1) work:
+# a rep is counted as soon as the value has come back from the valley by minAmplitude.
+# A swing too small to be a rep that settles where it is becomes the new rest, so a noise
+# spike at rest can't leave the peak stranded above where the wearer really rests.
+# Completed reps are announced to listeners rather than left for someone to poll
+
+EXERCISES = {           # RepDetector settings per exercise -- starting points, tune them against motion captures
+    'situps': {
+        'channel':      'angleY',   # Torso pitch
+        'rest':         'high',     # Lying back is the high end of the swing
+        'hysteresis':   10,         # Degrees the angle has to move from rest to count as starting a rep
+        'minAmplitude': 40,         # Degrees of swing for a rep
+        'minDuration':  0.8,        # Seconds -- quicker swings are bouncing, not reps
+        'maxDuration':  10,
+    },
+    'pushups': {
+        'channel':      'angleY',   # Head dips as the chest goes down
+        'rest':         'high',
+        'hysteresis':   4,
+        'minAmplitude': 12,
+        'minDuration':  0.6,
+        'maxDuration':  8,
+    },
+    'squats': {
+        'channel':      'angleY',   # Torso leans forward going down
+        'rest':         'high',
+        'hysteresis':   6,
+        'minAmplitude': 20,
+        'minDuration':  0.8,
+        'maxDuration':  10,
+    },
+}
+
+class RepDetector:
+    """
+    Streaming peak/valley detector counting reps on one channel
+    """
+    def __init__(self, channel, rest='high', hysteresis=10, minAmplitude=40, minDuration=0.5, maxDuration=None):
+        """
+        channel         str     Sample channel to follow
+        rest            str     'high' or 'low': which end of the swing is the rest position
+        hysteresis      float   How far the value has to move from the peak at rest to count as leaving it
+        minAmplitude    float   Smallest swing, rest to work and back, that counts as a rep
+        minDuration     float   Seconds -- reps quicker than this are ignored
+        maxDuration     float   Seconds -- reps slower than this are ignored, None for no limit
+        """
+        if rest not in ('high', 'low'):
+            raise ValueError(f"rest must be 'high' or 'low', not {rest!r}")
+
+        self.channel = channel
+        self.restSign = 1 if rest == 'high' else -1     # Values are multiplied by this, so rest is always the high end
+        self.hysteresis = hysteresis
+        self.minAmplitude = minAmplitude
+        self.minDuration = minDuration
+        self.maxDuration = maxDuration
+        self.listeners = []     # Functions called with each rep
+
+        self.reset()
+
+    def reset(self):
+        """ Forget the motion so far and start counting from 0 """
+        self.reps = 0
+        self.atRest = True      # Whether the wearer is at rest, rather than partway through a rep
+        self.restValue = None   # Peak at rest: the value the rep is measured out from
+        self.restTime = None    # Time the wearer was last within hysteresis of it -- when the rep started, once they leave
+        self.workValue = None   # Valley at work: the furthest out since leaving rest
+        self.settleValue = None # Where the value has stayed within hysteresis of since settleTime, while out of rest
+        self.settleTime = None
+        self.lastRep = None     # The most recent rep
+
+    def update(self, value, timestamp):
+        """
+        Follow one sample
+            value       float   Value of channel
+            timestamp   float   Time of the sample in seconds, from a monotonic clock
+        Returns the rep if this sample completed one, otherwise None
+        """
+        value *= self.restSign  # Rest is now always the high end
+
+        if self.atRest:
+            if self.restValue is None or value >= self.restValue:
+                self.restValue = value              # New peak
+            if value > self.restValue - self.hysteresis:
+                self.restTime = timestamp           # Still at rest
+            else:
+                self.atRest = False                 # Left rest: the rep started at restTime
+                self.workValue = value
+                self.settleValue = value
+                self.settleTime = timestamp
+            return None
+
+        if self.restValue - self.workValue < self.minAmplitude:    # Not out far enough for a rep yet --
+            if abs(value - self.settleValue) > self.hysteresis:
+                self.settleValue = value
+                self.settleTime = timestamp
+            elif timestamp - self.settleTime >= self.minDuration:  # but holding still: this is rest now,
+                self.backToRest(value, timestamp)                   # e.g. after a spike set the peak too high
+                return None
+
+        if value < self.workValue:
+            self.workValue = value                  # Still heading out
+            return None
+
+        if value > self.restValue - self.hysteresis and self.restValue - self.workValue < self.minAmplitude:
+            self.backToRest(value, timestamp)       # Came back without going far enough for a rep
+            return None
+
+        if value - self.workValue < self.minAmplitude or self.restValue - self.workValue < self.minAmplitude:
+            return None                             # Not back far enough yet, or a wobble while working
+
+        # Swung out and back by at least minAmplitude: a rep
+        rep = None
+        duration = timestamp - self.restTime
+        if duration >= self.minDuration and (self.maxDuration is None or duration <= self.maxDuration):
+            self.reps += 1
+            rep = {
+                'count':        self.reps,
+                'duration':     duration,                           # Seconds, leaving rest to coming back
+                'amplitude':    self.restValue - self.workValue,
+                'time':         timestamp,
+            }
+            self.lastRep = rep
+            for listener in self.listeners:
+                listener(rep)
+
+        self.backToRest(value, timestamp)
+        return rep
+
+    def backToRest(self, value, timestamp):
+        """ Start looking for the next rep from value """
+        self.atRest = True
+        self.restValue = value
+        self.restTime = timestamp
+        self.workValue = None
+
+if __name__ == "__main__":
+    import math
+
+    # python reps.py  -- count simulated situps, with the awkward cases that mustn't be counted or lost
+    def situps(detector, count, start=0.0, rate=50, rest=60, work=0, period=2.0, pause=1.0):
+        """ Feed count sinusoidal reps between rest and work degrees, with pause seconds at rest between. Returns the end time """
+        t = start
+        for rep in range(count):
+            for i in range(int(pause * rate)):
+                t += 1 / rate
+                detector.update(rest, t)
+            for i in range(int(period * rate)):
+                t += 1 / rate
+                detector.update(work + (rest - work) * (1 + math.cos(2 * math.pi * i / (period * rate))) / 2, t)
+        return t
+
+    def check(name, expected, feed):
+        detector = RepDetector(**{key: value for key, value in EXERCISES['situps'].items()})
+        feed(detector)
+        print(f"{name:<32} {detector.reps:3d} reps, expected {expected}  {'ok' if detector.reps == expected else 'FAIL'}")
+
+    def spike(detector):
+        t = situps(detector, 0)
+        for i in range(500):                # 10 s resting with one noise spike above rest
+            t += 0.02
+            detector.update(75 if i == 10 else 60, t)
+        situps(detector, 3, t)
+
+    def halfRep(detector):
+        t = situps(detector, 2)
+        t = situps(detector, 1, t, work=40)     # Only 20 degrees out
+        situps(detector, 2, t)
+
+    check('clean', 10, lambda detector: situps(detector, 10))
+    check('spike at rest', 3, spike)
+    check('half rep', 4, halfRep)
+    check('too quick', 0, lambda detector: situps(detector, 5, period=0.4))
@@ -0,0 +1,251 @@
+# Rolling-window data structures for streaming sensor values
+#
+# Everything here is updated one sample at a time and allocates its storage up front,
+# so it can sit in the sampling loop without creating garbage
+
+import bisect
+import collections
+
+import numpy as np
+
+class RollingMedian:
+    """
+    Median of the last `size` values, updated incrementally
+    Keeps the window both in arrival order (a ring, to know which value to evict)
+    and sorted (bisect insert/evict), so each update is O(log n) searches plus an in-place shift
+    """
+    __slots__ = ('size', 'window', 'sorted', 'index')
+
+    def __init__(self, size, initial=1):
+        """
+        size        int     Number of values in the window
+        initial     float   Value the window starts filled with
+        """
+        self.size = size
+        self.window = [initial] * size  # Values in arrival order
+        self.sorted = [initial] * size  # The same values, sorted
+        self.index = 0                  # Position of the oldest value in window
+
+    def update(self, value):
+        """ Add a value, dropping the oldest one, and return the new median """
+        oldest = self.window[self.index]
+        self.window[self.index] = value
+        self.index = (self.index + 1) % self.size
+
+        del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+        bisect.insort(self.sorted, value)
+
+        return self.sorted[self.size // 2]     # Middle value (upper middle for even sizes)
+
+    @property
+    def median(self):
+        return self.sorted[self.size // 2]
+
+class TimingStats:
+    """
+    Rolling statistics for a stream of time intervals (e.g. the sampling loop period)
+    Tracks mean, max and 99th percentile over the last `size` intervals
+    """
+    __slots__ = ('size', 'window', 'sorted', 'index', 'count', 'total')
+
+    def __init__(self, size=1000):
+        """
+        size    int     Number of intervals to keep statistics over
+        """
+        self.size = size
+        self.window = [0.0] * size  # Intervals in arrival order
+        self.sorted = []            # The same intervals, sorted -- grows until the window is full
+        self.index = 0              # Position of the oldest interval in window
+        self.count = 0              # Number of intervals recorded, up to size
+        self.total = 0.0            # Running sum of the intervals in the window
+
+    def update(self, dt):
+        """ Record an interval """
+        if self.count == self.size:                 # Window full -- evict the oldest interval
+            oldest = self.window[self.index]
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+            self.total -= oldest
+        else:
+            self.count += 1
+
+        self.window[self.index] = dt
+        self.index = (self.index + 1) % self.size
+        bisect.insort(self.sorted, dt)
+        self.total += dt
+
+    def percentile(self, p):
+        """ Interval at percentile p (0-100) of the window """
+        if not self.count:
+            return 0.0
+        return self.sorted[int(p / 100 * (self.count - 1))]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def max(self):
+        return self.sorted[-1] if self.count else 0.0
+
+    def summary(self):
+        """ Dict of the current statistics, in seconds """
+        mean = self.mean
+        p99 = self.percentile(99)
+        return {
+            'dtMean':       mean,
+            'dtMax':        self.max,
+            'dtP99':        p99,
+            'jitterP99':    p99 - mean,     # How far the slowest 1% of intervals run over the average
+            'samples':      self.count,
+        }
+
+class MotionTracker:
+    """
+    Streaming statistics of a motion signal over the last `window` seconds
+    Running sums give the mean and variance, and monotonic queues give the min and max,
+    so each update is amortised O(1) however many samples fit in the window --
+    and the window covers the same time whatever the sample rate
+    """
+    __slots__ = ('window', 'samples', 'total', 'totalSquares', 'minQueue', 'maxQueue', 'latest')
+
+    def __init__(self, window=1.0):
+        """
+        window  float   Length of the window in seconds
+        """
+        self.window = window
+        self.samples = collections.deque()      # (timestamp, value) in the window, oldest first
+        self.total = 0.0                        # Running sum of the values in the window
+        self.totalSquares = 0.0                 # Running sum of their squares
+        self.minQueue = collections.deque()     # Candidates for the minimum, increasing values
+        self.maxQueue = collections.deque()     # Candidates for the maximum, decreasing values
+        self.latest = 0.0                       # Most recent value
+
+    def update(self, value, timestamp):
+        """
+        Add a value, dropping any that have aged out of the window
+            value       float   Motion signal
+            timestamp   float   Time of the sample in seconds, from a monotonic clock
+        """
+        sample = (timestamp, value)
+        self.samples.append(sample)
+        self.total += value
+        self.totalSquares += value * value
+        self.latest = value
+
+        while self.minQueue and self.minQueue[-1][1] >= value:  # Older values that are bigger can never be the minimum again
+            self.minQueue.pop()
+        self.minQueue.append(sample)
+        while self.maxQueue and self.maxQueue[-1][1] <= value:
+            self.maxQueue.pop()
+        self.maxQueue.append(sample)
+
+        cutoff = timestamp - self.window
+        while self.samples[0][0] <= cutoff:
+            oldTimestamp, oldValue = self.samples.popleft()
+            self.total -= oldValue
+            self.totalSquares -= oldValue * oldValue
+            if self.minQueue[0][0] <= cutoff:
+                self.minQueue.popleft()
+            if self.maxQueue[0][0] <= cutoff:
+                self.maxQueue.popleft()
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def mean(self):
+        return self.total / len(self.samples) if self.samples else 0.0
+
+    @property
+    def variance(self):
+        if not self.samples:
+            return 0.0
+        mean = self.total / len(self.samples)
+        return max(self.totalSquares / len(self.samples) - mean * mean, 0.0)   # Rounding can take it just below 0
+
+    @property
+    def delta(self):
+        """ How far the latest value is from the mean of the window """
+        return self.latest - self.mean
+
+    @property
+    def peakToPeak(self):
+        return self.maxQueue[0][1] - self.minQueue[0][1] if self.samples else 0.0
+
+class RingBuffer:
+    """
+    Fixed-capacity history of multi-channel samples, one column per channel, in a preallocated NumPy array
+    Every row is written twice, at i and i + capacity, so the most recent n rows are always one
+    contiguous slice -- windows are views into the buffer, never copies
+    Missing or non-numeric values are stored as NaN, and statistics over a window containing one are NaN
+    """
+    __slots__ = ('capacity', 'channels', 'columns', 'data', 'head', 'count')
+
+    def __init__(self, capacity, channels):
+        """
+        capacity    int     Number of samples to keep
+        channels    list    Channel names, in column order
+        """
+        self.capacity = capacity
+        self.channels = list(channels)
+        self.columns = {channel: i for i, channel in enumerate(self.channels)}   # Column index of each channel
+        self.data = np.full((2 * capacity, len(self.channels)), np.nan)
+        self.head = 0       # Row the next sample goes in
+        self.count = 0      # Number of samples stored, up to capacity
+
+    def __len__(self):
+        return self.count
+
+    def push(self, values, channels=None):
+        """
+        Add a sample, overwriting the oldest once full
+            values      Mapping     Channel values
+            channels    iterable    Channels to take from values -- the rest are NaN. Defaults to all of them
+        """
+        row = self.data[self.head]
+        if channels is None:
+            channels = self.channels
+        else:
+            row.fill(np.nan)
+
+        for channel in channels:
+            try:
+                row[self.columns[channel]] = values[channel]
+            except (TypeError, ValueError):     # None, strings, etc.
+                row[self.columns[channel]] = np.nan
+
+        self.data[self.head + self.capacity] = row     # Mirror copy keeps windows contiguous
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, n=None, channel=None):
+        """
+        View of the most recent n samples (all of them by default), oldest first
+        n x channels, or just n values if channel is given
+        """
+        if n is None or n > self.count:
+            n = self.count
+        end = self.head + self.capacity
+        if channel is None:
+            return self.data[end - n:end]
+        return self.data[end - n:end, self.columns[channel]]
+
+    def latest(self, channel=None):
+        """ The most recent sample, or one channel of it """
+        return self.window(1, channel)[0]
+
+    def mean(self, channel=None, n=None):
+        """ Mean of each channel (or one channel) over the most recent n samples """
+        return self.window(n, channel).mean(axis=0)
+
+    def var(self, channel=None, n=None):
+        """ Variance of each channel (or one channel) over the most recent n samples """
+        return self.window(n, channel).var(axis=0)
+
+    def min(self, channel=None, n=None):
+        """ Minimum of each channel (or one channel) over the most recent n samples """
+        return self.window(n, channel).min(axis=0)
+
+    def max(self, channel=None, n=None):
+        """ Maximum of each channel (or one channel) over the most recent n samples """
+        return self.window(n, channel).max(axis=0)
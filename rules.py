@@ -0,0 +1,468 @@
+# Compliance rules
+#
+# Each mode's test is a Rule registered under the mode's name. Switching modes picks one
+# rule object, so testing a sample is a single call, and every rule keeps its own state
+# and timing. Rules don't touch the app directly: side effects (beeps, debug page updates,
+# punishment timers) go through the actions object they're created with.
+#
+# Modes that are just conditions on the sample -- angle bounds, motion limits -- are defined
+# in MODES_FILE instead of in code, see DeclaredRule.
+#
+# Rules are evaluated at their own rate, over all the samples that arrived since the last
+# evaluation (SampleWindow.new), rather than on every sample. While compliant, a rule looks
+# at the extremes of those samples, so an excursion is caught however briefly it lasted;
+# while noncompliant it looks for the first sample back in bounds, then checks the samples
+# after it stayed in. Decisions are therefore the same as evaluating every sample, except
+# that they're reported up to one evaluation period later, and several changes within one
+# period are reported as their end result
+
+import json
+import random
+import time
+
+import numpy as np
+
+import reps
+
+RULES = {}      # Mode name: Rule class
+
+MODES_FILE = 'modes.json'
+MOTION_STATS = ('delta', 'peakToPeak', 'variance')  # MotionTracker statistics a mode can limit
+
+def register(mode):
+    """ Class decorator registering a Rule as the test for mode """
+    def decorator(cls):
+        cls.mode = mode
+        RULES[mode] = cls
+        return cls
+    return decorator
+
+class SampleWindow:
+    """
+    What rules get to look at: the newest sample, the samples since the last evaluation and the motion statistics
+    """
+    def __init__(self, sensor, motion):
+        """
+        sensor  Sensor          IMU sensor to read latest, batch and history from -- its history must hold
+                                at least a sample period's worth of evaluations, see range()
+        motion  MotionTracker   Recent rotation rates, fed by update()
+        """
+        self.sensor = sensor
+        self.history = sensor.history
+        self.motion = motion
+
+        self.new = 0                # Samples since the last evaluation
+        self.deltaMin = 0.0         # Extremes of motion.delta over those samples
+        self.deltaMax = 0.0
+        self.lastEvaluated = None   # Timestamp in seconds of the newest sample at the last evaluation
+
+    @property
+    def latest(self):
+        return self.sensor.latest
+
+    def update(self):
+        """ Take in every sample from the sensor's last read -- call after each read """
+        motion = self.motion
+        for sample in self.sensor.batch:
+            motion.update(
+                sample['gyroXrate'] + sample['gyroYrate'] + sample['gyroZrate'],    # deg/s, so it doesn't depend on the loop rate
+                sample['timestamp'] / 1000000000,
+            )
+
+            delta = motion.delta
+            if not self.new:
+                self.deltaMin = self.deltaMax = delta
+            elif delta < self.deltaMin:
+                self.deltaMin = delta
+            elif delta > self.deltaMax:
+                self.deltaMax = delta
+            self.new += 1
+
+    @property
+    def elapsed(self):
+        """ Seconds of samples since the last evaluation """
+        if self.lastEvaluated is None:
+            return 0.0
+        return self.sensor.latest['timestamp'] / 1000000000 - self.lastEvaluated
+
+    def evaluated(self):
+        """ The samples so far have been evaluated -- start collecting the next lot """
+        self.lastEvaluated = self.sensor.latest['timestamp'] / 1000000000
+        self.new = 0
+
+    def values(self, channel):
+        """ Array of channel's values over the samples since the last evaluation, oldest first -- at most the history's length """
+        return self.history.window(max(self.new, 1), channel)
+
+    def range(self, channel):
+        """ Lowest and highest value of channel over the samples since the last evaluation """
+        if self.new <= 1:
+            value = self.sensor.latest[channel]
+            return value, value
+        values = self.values(channel)
+        return values.min(), values.max()
+
+    def motionRange(self, stat):
+        """
+        Lowest and highest value of a motion statistic since the last evaluation
+        Only delta is tracked per sample -- peakToPeak and variance already cover the last second, so use their current value
+        """
+        if stat == 'delta':
+            return self.deltaMin, self.deltaMax
+        value = getattr(self.motion, stat)
+        return value, value
+
+class Rule:
+    """
+    Base class for compliance rules
+    Subclasses implement evaluate(), and list the sensor channels it reads in channels
+    """
+    channels = ()   # Channels of SampleWindow.latest that evaluate() reads
+
+    def __init__(self, actions):
+        """
+        actions     object  Provides emit(event, data) to the debug page, beep(sound),
+                            punishAfter(seconds, source) returning a cancellable timer, and the app's config
+        """
+        self.actions = actions
+        self.compliant = True   # Result of the last evaluation
+        self.time = 0.0         # Seconds spent evaluating
+        self.evaluations = 0    # Number of evaluations
+
+    def start(self):
+        """ The mode was just switched to this rule """
+        self.compliant = True
+
+    def stop(self):
+        """ The mode was just switched away from this rule """
+        pass
+
+    def evaluate(self, window):
+        """ Return whether the wearer is complying, given a SampleWindow """
+        raise NotImplementedError
+
+    def __call__(self, window):
+        start = time.perf_counter()
+        self.compliant = self.evaluate(window)
+        self.time += time.perf_counter() - start
+        self.evaluations += 1
+        return self.compliant
+
+    def resetTiming(self):
+        self.time = 0.0
+        self.evaluations = 0
+
+    def motionDelta(self, window):
+        """ Find change in recent movement: how far the current rotation rate is from the recent average, in deg/s """
+        motion = window.motion
+        Mdelta = motion.delta
+
+        # Send to the debug page
+        self.actions.emit('Mdelta', {
+            'Mdelta': Mdelta,
+            'variance': motion.variance,
+            'peakToPeak': motion.peakToPeak,
+        })
+
+        return Mdelta
+
+@register('off')
+class OffRule(Rule):
+    """ Off: always compliant """
+    def evaluate(self, window):
+        return True
+
+@register('random')
+class RandomRule(Rule):
+    """
+    Random mode: randomly shocks the wearer
+    """
+    channels = ('timestamp',)
+    meanInterval = 10       # Average seconds between shocks -- lower value = higher chance of shock
+
+    def evaluate(self, window):
+        return random.random() >= window.elapsed / self.meanInterval    # Same chance per second whatever the evaluation rate
+
+@register('sleepDep')
+class SleepDepRule(Rule):
+    """
+    Sleep deprivation mode: every 10 minutes, user is shocked until they move around -- probably shouldn't actually use this one but it's a cool idea right?
+    """
+    channels = ('gyroXrate', 'gyroYrate', 'gyroZrate')
+    motionThreshold = 80    # deg/s
+
+    def start(self):
+        super(SleepDepRule, self).start()
+        self.stickyPunishment = False   # Punish the wearer until they move
+
+    def evaluate(self, window):
+        # Get the time -- if the minute field ends with a 0, we're in business
+        t = time.localtime()
+        if t[4] % 10 == 0:  # Minutes end with 0
+            if t[5] < 1:    # Seconds less than 1
+                self.stickyPunishment = True
+
+        self.motionDelta(window)
+        deltaMin, deltaMax = window.motionRange('delta')
+        if max(-deltaMin, deltaMax) > self.motionThreshold:     # user moved since the last evaluation
+            self.stickyPunishment = False
+
+        return not self.stickyPunishment
+
+@register('fitness')
+class FitnessRule(Rule):
+    """
+    Testing grounds for exercise detection: eventually I want to
+    spin this out into a whole range of features but for now
+    it's hidden on the main UI
+    Counts reps of actions.config['fitnessExercise'] (see reps.EXERCISES). Compliance comes
+    from the punishment timer rather than the result
+    """
+    channels = tuple({exercise['channel'] for exercise in reps.EXERCISES.values()}) + ('timestamp',)
+    punishmentDelay = 5     # Seconds the wearer has to finish a rep
+
+    def start(self):
+        super(FitnessRule, self).start()
+        self.detector = reps.RepDetector(**reps.EXERCISES[self.actions.config.get('fitnessExercise', 'situps')])
+        self.detector.listeners.append(self.rep)
+        self.punishmentTimer = None         # Countdown to punishment if the wearer stops
+
+    def stop(self):
+        if self.punishmentTimer is not None:
+            self.punishmentTimer.cancel()
+        self.punishmentTimer = None
+
+    def rep(self, rep):
+        """ Rep listener: the wearer finished one, so restart the countdown """
+        self.actions.beep('compliant')
+        self.stop()
+        self.punishmentTimer = self.actions.punishAfter(self.punishmentDelay, 'fitness')
+
+    def evaluate(self, window):
+        detector = self.detector
+        if window.new <= 1:
+            detector.update(window.latest[detector.channel], window.latest['timestamp'] / 1000000000)
+        else:                               # Every sample since the last evaluation, so no turning point is missed
+            for value, timestamp in zip(window.values(detector.channel).tolist(), window.values('timestamp').tolist()):
+                detector.update(value, timestamp / 1000000000)
+
+        # TODO: Use the rep times (in combination with gyroYangle for pushups?) to tell the wearer if they should do the exercise slower or faster
+        self.actions.emit('fitness', {
+            'repTime':              detector.lastRep['duration'] if detector.lastRep else 0,
+            'reps':                 detector.reps,
+            'wearerInRestPosition': detector.atRest,
+        })
+
+        return True
+
+def loadModes(path=MODES_FILE):
+    """ Load the declared mode definitions, see DeclaredRule -- none if the file is missing """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def parseClock(clock):
+    """ 'HH:MM' to minutes after midnight """
+    hours, minutes = clock.split(':')
+    return int(hours) * 60 + int(minutes)
+
+class DeclaredRule(Rule):
+    """
+    A mode defined by data rather than code. A definition is a dict of
+        angles              {channel: [low, high]}  Angles (degrees) the channel must stay strictly between
+        motion              {stat: limit}           Limits on the MotionTracker statistics over the last second, in MOTION_STATS:
+                                                    |delta| and peakToPeak in deg/s, variance in (deg/s)^2
+        hysteresis          float                   Degrees the angle bounds widen by while compliant and narrow by while not,
+                                                    so the wearer doesn't flicker in and out at the edge
+        motionHysteresis    float                   The same for the motion limits, in their own units
+        dwell               float/dict              Seconds a change has to last before it counts -- or {'compliant': s, 'noncompliant': s}
+        schedule            [[start, end], ...]     Local 'HH:MM' times the mode is enforced between -- always compliant outside them.
+                                                    A window may wrap past midnight
+        description         str                     For people reading the file
+    All conditions must hold to be compliant. At mode change they're compiled into flat tuples of
+    bounds for each compliance state, so each sample is a run of chained comparisons with no lookups
+    into the definition, and the hysteresis and dwell bookkeeping is already done
+    """
+    KEYS = ('angles', 'motion', 'hysteresis', 'motionHysteresis', 'dwell', 'schedule', 'description')
+
+    def __init__(self, actions, mode, definition):
+        """
+        mode        str     Name of the mode
+        definition  dict    See above
+        """
+        super(DeclaredRule, self).__init__(actions)
+        unknown = set(definition) - set(self.KEYS)
+        if unknown:
+            raise ValueError(f"Mode '{mode}' has unknown settings: {sorted(unknown)}")
+        unknown = set(definition.get('motion', {})) - set(MOTION_STATS)
+        if unknown:
+            raise ValueError(f"Mode '{mode}' limits unknown motion statistics: {sorted(unknown)}")
+
+        self.mode = mode
+        self.definition = definition
+        self.channels = tuple(definition.get('angles', {})) + (('timestamp',) if 'dwell' in definition else ())
+        self.stats = tuple(definition.get('motion', {}))
+
+    def compile(self):
+        """ Turn the definition into bounds and schedule ready for evaluate() """
+        definition = self.definition
+        angles = definition.get('angles', {})
+        motion = definition.get('motion', {})
+
+        hysteresis = definition.get('hysteresis', 0)
+        motionHysteresis = definition.get('motionHysteresis', 0)
+        self.angleBounds = {    # Compliant: wider bounds, so it's easier to stay within them. Noncompliant: narrower, so it's harder to slip out once back in
+            True:   tuple((channel, low - hysteresis, high + hysteresis) for channel, (low, high) in angles.items()),
+            False:  tuple((channel, low + hysteresis, high - hysteresis) for channel, (low, high) in angles.items()),
+        }
+        self.motionBounds = {   # Limits are -limit..limit: delta is signed, and the others can't go negative anyway
+            True:   tuple((stat, -limit - motionHysteresis, limit + motionHysteresis) for stat, limit in motion.items()),
+            False:  tuple((stat, -limit + motionHysteresis, limit - motionHysteresis) for stat, limit in motion.items()),
+        }
+
+        dwell = definition.get('dwell', 0)
+        if not isinstance(dwell, dict):
+            dwell = {'compliant': dwell, 'noncompliant': dwell}
+        self.dwell = {True: dwell.get('compliant', 0), False: dwell.get('noncompliant', 0)}    # Seconds before a change to each state counts
+
+        self.schedule = [(parseClock(start), parseClock(end)) for start, end in definition.get('schedule', [])]
+
+    def start(self):
+        super(DeclaredRule, self).start()
+        self.compile()
+        self.changeSince = None     # Sample time the conditions started disagreeing with compliant
+        self.scheduleActive = True  # Whether the schedule says the mode is enforced now
+        self.scheduleCheck = 0      # time.time() at which to look at the clock again
+
+    def enforced(self):
+        """ Whether the schedule enforces the mode right now -- the clock is only read once a minute """
+        if not self.schedule:
+            return True
+
+        now = time.time()
+        if now >= self.scheduleCheck:
+            t = time.localtime(now)
+            minute = t.tm_hour * 60 + t.tm_min
+            self.scheduleActive = any(
+                start <= minute < end if start <= end else minute >= start or minute < end  # Windows past midnight wrap
+                for start, end in self.schedule
+            )
+            self.scheduleCheck = now - t.tm_sec + 60    # Start of the next minute
+        return self.scheduleActive
+
+    def anglesHold(self, window):
+        """
+        Test the angle conditions on the samples since the last evaluation
+        While compliant every sample has to pass. While noncompliant, one has to be back within the
+        narrower bounds, and every sample from then on within the wider ones
+        """
+        if self.compliant or window.new <= 1:
+            for channel, low, high in self.angleBounds[self.compliant]:
+                lowest, highest = window.range(channel)
+                if not (low < lowest and highest < high):
+                    return False
+            return True
+
+        inside = None
+        for channel, low, high in self.angleBounds[False]:
+            values = window.values(channel)
+            channelInside = (low < values) & (values < high)
+            inside = channelInside if inside is None else inside & channelInside
+        if inside is None:          # No angle conditions
+            return True
+        back = np.flatnonzero(inside)
+        if not len(back):
+            return False
+
+        for channel, low, high in self.angleBounds[True]:
+            values = window.values(channel)[back[0]:]
+            if not (low < values.min() and values.max() < high):
+                return False
+        return True
+
+    def conditionsHold(self, window):
+        """ Test the angle and motion conditions, stopping at the first that fails """
+        if not self.anglesHold(window):
+            return False
+
+        if self.stats:
+            self.motionDelta(window)                # Keep the debug page's motion readout going
+            if self.compliant:
+                for stat, low, high in self.motionBounds[True]:
+                    lowest, highest = window.motionRange(stat)
+                    if not (low < lowest and highest < high):
+                        return False
+            else:
+                motion = window.motion
+                for stat, low, high in self.motionBounds[False]:
+                    if not low < getattr(motion, stat) < high:
+                        return False
+        return True
+
+    def evaluate(self, window):
+        if not self.enforced():
+            result = True
+        else:
+            result = self.conditionsHold(window)
+
+        if result == self.compliant or not self.dwell[result]:
+            self.changeSince = None
+            return result
+
+        now = window.latest['timestamp'] / 1000000000  # Sample time, so dwell follows the data rather than the loop
+        if self.changeSince is None:
+            self.changeSince = now
+        if now - self.changeSince >= self.dwell[result]:
+            self.changeSince = None
+            return result
+        return self.compliant                       # Not for long enough yet
+
+class Registry:
+    """
+    One instance of every registered rule, and the one for the current mode
+    """
+    def __init__(self, actions, channels=None, fallback='off', definitions=None):
+        """
+        actions     object  Passed to each rule, see Rule
+        channels    list    Channels the sensor provides -- rules needing others are rejected
+        fallback    str     Mode to use for modes with no rule
+        definitions dict    Declared modes, {mode: definition} -- see DeclaredRule. Defaults to loading MODES_FILE.
+                            A declared mode replaces a registered rule of the same name
+        """
+        if definitions is None:
+            definitions = loadModes()
+
+        self.rules = {mode: cls(actions) for mode, cls in RULES.items()}
+        for mode, definition in definitions.items():
+            self.rules[mode] = DeclaredRule(actions, mode, definition)
+
+        for mode, rule in self.rules.items():
+            missing = set(rule.channels) - set(channels) if channels is not None else set()
+            if missing:
+                raise ValueError(f"Rule for mode '{mode}' needs channels the sensor doesn't provide: {sorted(missing)}")
+
+        self.fallback = fallback
+        self.active = None      # Rule for the current mode
+
+    def select(self, mode):
+        """ Switch to the rule for mode, and return it """
+        rule = self.rules.get(mode)
+        if rule is None:
+            print(f"No compliance rule for mode '{mode}', using '{self.fallback}'")
+            rule = self.rules[self.fallback]
+        if rule is not self.active:
+            if self.active is not None:
+                self.active.stop()
+            rule.start()
+            self.active = rule
+        return rule
+
+    def timings(self, reset=False):
+        """ Mean seconds per evaluation for each rule that has run -- since the last reset if reset is used """
+        timings = {mode: rule.time / rule.evaluations for mode, rule in self.rules.items() if rule.evaluations}
+        if reset:
+            for rule in self.rules.values():
+                rule.resetTiming()
+        return timings
@@ -0,0 +1,143 @@
+# Safety core
+#
+# Runs the sensor -> compliance -> radio loop in a process of its own, so its timing
+# doesn't depend on how busy the web server is, and a web server crash can't take the
+# radio down with it. The web process only talks to it through:
+#   commands    a queue of (command, args) for the core: config changes and bus events
+#   state       shared memory the core writes and the web process reads: settings,
+#               safety counters and the latest IMU sample
+#   outbox      a bounded queue of Socket.IO events from the core -- dropped rather than
+#               waited on if the web process falls behind
+
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+STATUS = [                                  # Fields of the shared state besides the sample channels
+    ('sequence',            np.uint64),     # Odd while the core is writing
+    ('heartbeat',           np.float64),    # time.monotonic() of the core's last write -- the clock is system wide
+    ('mode',                'S32'),
+    ('punishmentIntensity', np.float64),
+    ('safetyMode',          np.bool_),
+    ('dockLock',            np.bool_),
+    ('compliance',          np.bool_),
+    ('punishmentCycles',    np.int32),
+]
+
+class SharedState:
+    """
+    The core's state in shared memory
+    Only the core writes, so writes never wait -- readers retry if they overlapped one
+    """
+    def __init__(self, channels):
+        """
+        channels    list    Sample channels to share
+        """
+        self.channels = list(channels)
+        self.dtype = np.dtype(STATUS + [(channel, np.float64) for channel in self.channels])
+        self.memory = shared_memory.SharedMemory(create=True, size=self.dtype.itemsize)   # Zero filled
+        self.record = np.ndarray((), dtype=self.dtype, buffer=self.memory.buf)
+        self.fields = self.dtype.names[1:]
+        self.record['heartbeat'] = time.monotonic()     # Not 0, so age means something before the core's first write
+
+    def write(self, sample=None, **status):
+        """ Update the status fields given, and the sample channels from sample if given """
+        record = self.record
+        record['sequence'] += 1                 # Odd: readers will wait for us to finish
+        for key, value in status.items():
+            record[key] = value
+        if sample is not None:
+            for channel in self.channels:
+                record[channel] = sample[channel]
+        record['heartbeat'] = time.monotonic()
+        record['sequence'] += 1
+
+    def read(self):
+        """ Dict of a consistent copy of the state """
+        while True:
+            sequence = int(self.record['sequence'])
+            if not sequence % 2:                # Not mid-write
+                copy = self.record.copy()
+                if int(self.record['sequence']) == sequence:
+                    break
+            time.sleep(0)                       # Let the writer finish
+
+        state = {field: copy[field].item() for field in self.fields}
+        state['mode'] = state['mode'].decode()
+        return state
+
+    @property
+    def started(self):
+        """ Whether the core has written yet """
+        return int(self.record['sequence']) > 0
+
+    @property
+    def age(self):
+        """ Seconds since the core last wrote """
+        return time.monotonic() - float(self.record['heartbeat'])
+
+    def close(self):
+        """ Release the shared memory -- a running core keeps its mapping """
+        self.memory.close()
+        self.memory.unlink()
+
+class Outbox:
+    """
+    Stands in for socketio in the core: emits are queued for the web process to send
+    """
+    def __init__(self, events, skip=()):
+        """
+        events  Queue   Bounded queue the web process reads
+        skip    tuple   Events not to send -- e.g. ones the web process reads from the shared state instead
+        """
+        self.events = events
+        self.skip = set(skip)
+        self.dropped = 0        # Events dropped because the web process was behind
+
+    def emit(self, event, data, namespace='/control'):
+        if event in self.skip:
+            return
+        if isinstance(data, dict):
+            data = dict(data)   # The queue pickles on its own thread -- don't let the sender change it first
+        try:
+            self.events.put_nowait((event, data, namespace))
+        except queue.Full:      # Never hold up the core for the web server
+            self.dropped += 1
+
+class SafetyCore:
+    """
+    The web process's handle on the core process
+    """
+    def __init__(self, target, channels, outboxLength=256):
+        """
+        target          func    Runs the core: called in the new process with (state, commands, outbox)
+        channels        list    Sample channels to share, see SharedState
+        outboxLength    int     Events the core can have waiting for the web process before they're dropped
+        """
+        context = multiprocessing.get_context('fork')  # The core inherits the shared memory mapping, rather than attaching by name
+        self.state = SharedState(channels)
+        self.commands = context.Queue()
+        self.outbox = context.Queue(outboxLength)
+        self.process = context.Process(target=target, args=(self.state, self.commands, self.outbox), name='safety-core')
+
+    def start(self):
+        self.process.start()
+
+    def send(self, command, *args):
+        """ Queue a command for the core """
+        self.commands.put((command, args))
+
+    def receive(self, timeout=None):
+        """ The core's next (event, data, namespace), or None if there's none within timeout seconds """
+        try:
+            return self.outbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    @property
+    def alive(self):
+        """ Whether the core is running and still writing its state -- it counts as alive while it starts up """
+        return self.process.is_alive() and (not self.state.started or self.state.age < 1)
@@ -0,0 +1,287 @@
+# Multi-rate cooperative scheduler
+#
+# Runs periodic tasks -- IMU at the profile's sample rate, battery a few times a second,
+# and so on -- from a single thread, sleeping until the earliest deadline instead of
+# every sensor spinning in its own polling loop. One task may instead be triggered by an
+# interrupt line (pacer.EdgeSource), e.g. the IMU's data-ready pin.
+# Tasks run to completion, so they must not block for longer than the other tasks can wait.
+# run() owns a thread; runAsync() does the same as a coroutine on an asyncio event loop,
+# handing tasks marked blocking (bus reads and the like) to an executor so the loop keeps going
+
+import asyncio
+import math
+import threading
+import time
+
+import pacer
+
+class Task:
+    """
+    A function to call at a fixed rate, with its deadline statistics
+    """
+    def __init__(self, name, function, rate, trigger=None, blocking=False):
+        """
+        name        str         Name to report statistics under
+        function    func        Called with no arguments each time the task is due
+        rate        float       Calls per second -- for a triggered task, the rate the edges are expected at
+        trigger     EdgeSource  Interrupt to run on instead of a timer -- None to run on a fixed-rate schedule
+        blocking    bool        Whether function blocks on I/O -- runAsync() runs it in the executor rather than on the event loop
+        """
+        self.name = name
+        self.function = function
+        self.trigger = trigger
+        self.blocking = blocking
+        self.setRate(rate)
+
+        self.nextRun = time.perf_counter()  # time.perf_counter() deadline of the next call -- reset when the scheduler starts
+        self.overruns = 0           # Number of deadlines missed because the scheduler was behind
+        self.missedEdges = 0        # Number of times the trigger didn't arrive in time and the task ran anyway
+        self.errors = 0             # Number of calls that raised
+
+        self.resetWindow()
+
+    def setRate(self, rate):
+        """ Change the rate -- takes effect from the next call """
+        self.rate = rate
+        self.period = 1 / rate
+        if self.trigger is not None:
+            self.trigger.setRate(rate)
+
+    def resetWindow(self):
+        """ Start a new reporting window for summary() """
+        self.windowRuns = 0         # Calls this window
+        self.windowTime = 0.0       # Seconds spent in the function this window
+        self.windowMaxTime = 0.0    # Longest call this window
+        self.windowMaxLate = 0.0    # Furthest past its deadline a call started this window
+
+    def schedule(self, now):
+        """ Set the deadline after a call ending at now """
+        if self.trigger is not None:                # Give up waiting for the trigger after a few periods
+            self.nextRun = now + self.period * pacer.EDGE_TIMEOUT_PERIODS
+            return
+
+        self.nextRun += self.period                 # Deadlines advance by whole periods, so sleep overshoot doesn't accumulate
+        if self.nextRun < now:                      # Already missed the next one --
+            missed = math.ceil((now - self.nextRun) / self.period)
+            self.overruns += missed                 # skip the missed deadlines rather than running flat out to catch up
+            self.nextRun += missed * self.period
+
+    def run(self, now):
+        """ Call the function, having woken up at now """
+        if self.trigger is None:
+            self.windowMaxLate = max(self.windowMaxLate, now - self.nextRun)
+
+        try:
+            self.function()
+        except Exception as error:                  # One bad call (e.g. an I2C error) mustn't stop every task for good
+            self.errors += 1
+            print(f"Task '{self.name}' failed: {error!r}")
+
+        end = time.perf_counter()
+        self.windowRuns += 1
+        self.windowTime += end - now
+        self.windowMaxTime = max(self.windowMaxTime, end - now)
+        self.schedule(end)
+
+    def summary(self, elapsed):
+        """ Dict of achieved rate and timing over elapsed seconds, then start a new window """
+        stats = {
+            'targetRate':   self.rate,
+            'rate':         self.windowRuns / elapsed,                                      # Achieved calls per second
+            'time':         self.windowTime / self.windowRuns if self.windowRuns else 0.0,  # Mean seconds per call
+            'maxTime':      self.windowMaxTime,
+            'maxLate':      self.windowMaxLate,                                             # Worst start past the deadline, seconds
+            'load':         self.windowTime / elapsed,                                      # Fraction of a core spent in the task
+            'overruns':     self.overruns,
+            'missedEdges':  self.missedEdges,
+            'errors':       self.errors,
+        }
+        self.resetWindow()
+        return stats
+
+class Scheduler:
+    """
+    Runs registered tasks at their rates from one thread
+    """
+    def __init__(self, stopEvent=None):
+        """
+        stopEvent   Event   Set to make run() return -- defaults to a private one, see stop()
+        """
+        self.tasks = {}
+        self.trigger = None         # The task run on an interrupt, if any
+        self.stopEvent = stopEvent or threading.Event()
+
+        self.resetWindow()
+
+    def add(self, name, function, rate, trigger=None, blocking=False):
+        """ Register a task -- see Task. Only one task may have a trigger. Returns the Task """
+        task = Task(name, function, rate, trigger, blocking)
+        if trigger is not None:
+            if self.trigger is not None:
+                raise ValueError(f"Task '{self.trigger.name}' already has the scheduler's trigger")
+            self.trigger = task
+        self.tasks[name] = task
+        return task
+
+    def setRate(self, name, rate):
+        """ Change a task's rate """
+        self.tasks[name].setRate(rate)
+
+    def resetWindow(self):
+        """ Start a new reporting window for summary() """
+        self.windowStart = time.perf_counter()
+        self.windowCPU = time.process_time()
+        self.windowWait = 0.0       # Seconds spent waiting this window
+
+    def wait(self, deadline):
+        """ Sleep until deadline, or until the trigger fires. Returns whether it fired """
+        start = time.perf_counter()
+        delay = deadline - start
+        fired = False
+        if self.trigger is not None:
+            fired = self.trigger.trigger.wait(max(delay, 0))
+        elif delay > 0:
+            time.sleep(delay)
+        self.windowWait += time.perf_counter() - start
+        return fired
+
+    async def waitAsync(self, deadline, executor=None):
+        """ wait() without blocking the event loop -- the trigger is waited on in executor """
+        start = time.perf_counter()
+        delay = deadline - start
+        fired = False
+        if self.trigger is not None:
+            fired = await asyncio.get_running_loop().run_in_executor(executor, self.trigger.trigger.wait, max(delay, 0))
+        elif delay > 0:
+            await asyncio.sleep(delay)
+        self.windowWait += time.perf_counter() - start
+        return fired
+
+    def next(self):
+        """ The task with the earliest deadline """
+        return min(self.tasks.values(), key=lambda task: task.nextRun)
+
+    def overdue(self, task):
+        """
+        Whether task is a timer task already past its deadline
+        These run before the trigger is looked at -- otherwise a trigger task that takes longer than
+        the time between edges always finds the next edge latched, and the timer tasks never run
+        """
+        return task is not self.trigger and task.nextRun <= time.perf_counter()
+
+    def choose(self, task, fired):
+        """ The task to run: task, or the trigger task if the trigger fired while waiting for task """
+        if fired:                                   # The trigger fired before the earliest deadline
+            return self.trigger
+        if task is self.trigger:                    # Waited too long for it --
+            task.missedEdges += 1                   # don't stall the task on a dead interrupt line
+        return task
+
+    def runNext(self, task, fired):
+        """ Run task, or the trigger task if the trigger fired while waiting for task """
+        self.choose(task, fired).run(time.perf_counter())
+
+    async def runNextAsync(self, task, fired, executor=None):
+        """ runNext() without blocking the event loop -- blocking tasks run in executor """
+        task = self.choose(task, fired)
+        if task.blocking:
+            await asyncio.get_running_loop().run_in_executor(executor, task.run, time.perf_counter())
+        else:
+            task.run(time.perf_counter())
+
+    def step(self):
+        """ Wait for and run the next task that's due """
+        task = self.next()
+        self.runNext(task, not self.overdue(task) and self.wait(task.nextRun))
+
+    def start(self):
+        """ Set the first deadlines """
+        now = time.perf_counter()
+        for task in self.tasks.values():
+            task.nextRun = now
+        if self.trigger is not None:                # Give the interrupt a chance to arrive first
+            self.trigger.nextRun = now + self.trigger.period * pacer.EDGE_TIMEOUT_PERIODS
+        self.resetWindow()
+
+    def run(self):
+        """ Run tasks until the stop event is set """
+        self.start()
+        while not self.stopEvent.is_set():
+            self.step()
+
+    async def runAsync(self, executor=None):
+        """
+        run() as a coroutine, sharing the event loop with other coroutines between tasks
+        executor    Executor    Where to wait for the trigger and run blocking tasks -- None for the loop's default.
+                                Only one of them is in it at a time
+        """
+        self.start()
+        while not self.stopEvent.is_set():
+            task = self.next()
+            await self.runNextAsync(task, not self.overdue(task) and await self.waitAsync(task.nextRun, executor), executor)
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def summary(self):
+        """ Dict of idle time and per-task statistics since the last summary, then start a new window """
+        elapsed = time.perf_counter() - self.windowStart
+        cpu = time.process_time() - self.windowCPU
+        if not elapsed:
+            elapsed = float('inf')
+
+        stats = {
+            'idle':     self.windowWait / elapsed,      # Fraction of the time the scheduler spent waiting
+            'cpu':      cpu / elapsed,                  # Fraction of a core used by the whole process, all threads
+            'tasks':    {name: task.summary(elapsed) for name, task in self.tasks.items()},
+        }
+        self.resetWindow()
+        return stats
+
+if __name__ == "__main__":
+    import sys
+
+    import bus
+    import rolling
+
+    # python scheduler.py [seconds]  -- compare lateness and CPU of the threaded and asyncio runners on a synthetic load:
+    # an IMU-like task at 104 Hz, compliance at 20 Hz and battery at 4 Hz, publishing to a consumer like the radio's
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    def compare(runtime):
+        stopEvent = threading.Event()
+        delivery = rolling.TimingStats(1000)        # Seconds from publishing an event to the consumer getting it
+        events = bus.bus.subscribe('beep')
+        tasks = Scheduler(stopEvent)
+        tasks.add('imu', lambda: sum(range(300)), 104)
+        tasks.add('compliance', lambda: bus.publish('beep', sound='compliant'), 20)
+        tasks.add('battery', lambda: time.sleep(0.0005), 4, blocking=True)     # A short blocking bus read
+
+        def consume(received):
+            for event in received:
+                delivery.update(time.perf_counter() - event.time)
+
+        if runtime == 'threads':
+            def consumer():
+                while not stopEvent.is_set():
+                    consume(events.wait(1))
+            threading.Thread(target=consumer, daemon=True).start()
+            threading.Timer(seconds, stopEvent.set).start()
+            tasks.run()
+        else:
+            async def consumer():
+                while not stopEvent.is_set():
+                    consume(await events.waitAsync(1))
+            async def main():
+                asyncio.get_running_loop().call_later(seconds, stopEvent.set)
+                await asyncio.gather(tasks.runAsync(), consumer())
+            asyncio.run(main())
+
+        events.close()
+        stats = tasks.summary()
+        late = max(task['maxLate'] for task in stats['tasks'].values())
+        print(f"{runtime:<8} {stats['cpu'] * 100:6.1f} {late * 1000:9.2f} {delivery.mean * 1000:9.3f} {delivery.percentile(99) * 1000:9.3f}")
+
+    print(f"{'Runtime':<8} {'CPU %':>6} {'Max late':>9} {'Event ms':>9} {'p99 ms':>9}")
+    for runtime in ('threads', 'asyncio'):
+        compare(runtime)
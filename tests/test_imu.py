@@ -0,0 +1,69 @@
+import pytest
+
+import fakesmbus
+import imu
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = fakesmbus.FakeSMBus()
+    monkeypatch.setattr(imu, 'bus', bus)
+    monkeypatch.setattr(imu, 'accgyr_last', [0] * imu.ACCGYR_BLOCK_LENGTH)
+    monkeypatch.setattr(imu, 'mag_last', [0] * imu.MAG_BLOCK_LENGTH)
+    return bus
+
+def test_read_accgyr_decodes_the_burst(bus):
+    bus.setAccGyr(acc=(1, -2, 32767), gyr=(-4, 5, -32768))     # Gyro registers come first on the chip
+
+    assert imu.readACCGYR() == (1, -2, 32767, -4, 5, -32768)
+    assert bus.transactions == 1                                # One block read for all six axes
+
+def test_read_accgyr_keeps_the_last_block_on_a_failed_read(bus):
+    bus.setAccGyr(acc=(10, 20, 30), gyr=(40, 50, 60))
+    imu.readACCGYR()
+
+    bus.setAccGyr(acc=(0, 0, 0), gyr=(0, 0, 0))
+    bus.failReads = 1
+    assert imu.readACCGYR() == (10, 20, 30, 40, 50, 60)
+
+def test_read_mag_decodes_the_burst(bus):
+    bus.setMag((-1, 2, -3))
+
+    assert imu.readMAG() == (-1, 2, -3)
+    assert bus.transactions == 1
+
+def pushSamples(bus, count):
+    """ Distinct, recognisable samples: acc (i, -i, 1), gyro (i, 2i, 3) """
+    for i in range(count):
+        bus.pushFIFO(acc=(i, -i, 1), gyr=(i, 2 * i, 3))
+
+def test_read_fifo_drains_whole_samples_in_order(bus):
+    imu.initFIFO(104, 16)
+    pushSamples(bus, 3)
+    bus.fifo.extend((pattern, 0) for pattern in range(3))   # Half of a fourth sample, still being written
+
+    samples, overrun = imu.readFIFO()
+
+    assert samples == [(i, -i, 1, i, 2 * i, 3) for i in range(3)]
+    assert not overrun
+    assert len(bus.fifo) == 3       # The partial sample waits for the next read
+
+def test_read_fifo_realigns_after_an_overrun(bus):
+    imu.initFIFO(104, 16)
+    pushSamples(bus, 400)           # 2400 words into a 2048 word FIFO -- the oldest are overwritten partway through a sample
+
+    samples, overrun = imu.readFIFO()
+
+    assert overrun
+    assert len(samples) == imu.FIFO_SIZE_WORDS // imu.FIFO_SAMPLE_WORDS   # A full FIFO, less the partial sample at the front
+    for ACCx, ACCy, ACCz, GYRx, GYRy, GYRz in samples:  # Every sample starts on a gyro X word
+        assert (ACCy, ACCz, GYRx, GYRy, GYRz) == (-ACCx, 1, ACCx, 2 * ACCx, 3)
+    assert samples[-1][0] == 399
+
+    assert imu.readFIFO() == ([], False)
+
+def test_read_fifo_is_empty_in_bypass_mode(bus):
+    imu.initFIFO(104, 16)
+    pushSamples(bus, 3)
+    imu.disableFIFO()
+
+    assert imu.readFIFO() == ([], False)
@@ -0,0 +1,88 @@
+import time
+import wave
+
+import numpy as np
+import pytest
+
+import mic
+
+def writeWAV(path, samples, sampleRate=mic.SAMPLE_RATE):
+    """ Write int16 samples as a mono 16 bit WAV. Returns them as mic floats """
+    samples = np.asarray(samples, dtype='<i2')
+    with wave.open(str(path), 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sampleRate)
+        file.writeframes(samples.tobytes())
+    return samples.astype(np.float32) / 32768
+
+def chunks(source, count):
+    """ The next count chunks, stepping by hand """
+    result = []
+    for i in range(count):
+        source.advance()
+        chunk, number = source.latest()
+        result.append(chunk.copy())
+    return result
+
+def test_wav_chunks_wrap_around_a_short_file(tmp_path):
+    audio = writeWAV(tmp_path / 'short.wav', [100, 200, 300])
+    source = mic.WAVSource(str(tmp_path / 'short.wav'), realtime=False, chunkSize=8)
+
+    first, second = chunks(source, 2)
+    assert np.array_equal(first, audio[[0, 1, 2, 0, 1, 2, 0, 1]])
+    assert np.array_equal(second, audio[[2, 0, 1, 2, 0, 1, 2, 0]])
+
+def test_wav_loops_at_the_end(tmp_path):
+    audio = writeWAV(tmp_path / 'loop.wav', np.arange(12) * 100)
+    source = mic.WAVSource(str(tmp_path / 'loop.wav'), realtime=False, chunkSize=8)
+
+    first, second, third = chunks(source, 3)
+    assert np.array_equal(first, audio[0:8])
+    assert np.array_equal(second, np.concatenate([audio[8:12], audio[0:4]]))
+    assert np.array_equal(third, audio[4:12])
+
+def test_wav_goes_silent_at_the_end_without_looping(tmp_path):
+    audio = writeWAV(tmp_path / 'once.wav', np.arange(1, 13) * 100)
+    source = mic.WAVSource(str(tmp_path / 'once.wav'), realtime=False, loop=False, chunkSize=8)
+
+    first, second, third = chunks(source, 3)
+    assert np.array_equal(first, audio[0:8])
+    assert np.array_equal(second, np.concatenate([audio[8:12], np.zeros(4)]))
+    assert not third.any()
+
+def test_wav_realtime_skips_unread_chunks(tmp_path):
+    audio = writeWAV(tmp_path / 'long.wav', np.arange(80) * 100, sampleRate=100)
+    source = mic.WAVSource(str(tmp_path / 'long.wav'), chunkSize=8)
+    source.start = time.perf_counter() - 0.44      # 5.5 chunks of 80 ms have played
+
+    chunk, number = source.latest()
+    assert number == 5
+    assert np.array_equal(chunk, audio[32:40])      # The fifth chunk -- the first four were never read
+
+    again, number = source.latest()
+    assert number == 5                              # No new chunk until the next one has played
+
+def test_microphone_levels_of_a_sine():
+    source = mic.ChunkSource()
+    t = np.arange(source.chunkSize) / source.sampleRate
+    source.buffers[source.filling] = 0.5 * np.sin(2 * np.pi * 1000 * t)    # 1 kHz, half of full scale
+    source.finish()
+
+    reading = mic.Microphone(source)()
+
+    assert reading['audio'] == pytest.approx(0.5 / np.sqrt(2), rel=1e-4)
+    assert reading['level'] == pytest.approx(-9.03, abs=0.01)      # 20 log10(0.5 / sqrt 2)
+    assert reading['peak'] == pytest.approx(-6.02, abs=0.01)
+    assert reading['voiceBand'] == pytest.approx(reading['level'], abs=0.1)
+    assert reading['lowBand'] < -60
+    assert reading['highBand'] < -60
+
+def test_microphone_silence():
+    source = mic.ChunkSource()
+    source.finish()
+
+    reading = mic.Microphone(source)()
+
+    assert reading['level'] == mic.SILENCE_DB
+    assert reading['voiceBand'] == mic.SILENCE_DB
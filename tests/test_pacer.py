@@ -0,0 +1,101 @@
+import importlib
+import sys
+import threading
+import types
+
+import pytest
+
+import pacer
+import scheduler
+
+class FakeGPIO(types.ModuleType):
+    """ Just enough of RPi.GPIO to follow which pins are set up and which have edge callbacks """
+    BOARD = 'BOARD'
+    IN = 'IN'
+    OUT = 'OUT'
+    LOW = 0
+    HIGH = 1
+    PUD_DOWN = 'PUD_DOWN'
+    RISING = 'RISING'
+
+    def __init__(self):
+        super(FakeGPIO, self).__init__('RPi.GPIO')
+        self.mode = None
+        self.pins = {}          # Pin: direction
+        self.callbacks = {}     # Pin: edge callback
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.pins[pin] = direction
+
+    def output(self, pin, value):
+        if self.pins.get(pin) != self.OUT:
+            raise RuntimeError(f"Pin {pin} isn't set up as an output")
+
+    def add_event_detect(self, pin, edge, callback):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, channels=None):
+        if channels is None:
+            channels = list(self.pins)
+            self.mode = None
+        for pin in channels:
+            self.pins.pop(pin, None)
+            self.callbacks.pop(pin, None)
+
+    def rise(self, pin):
+        """ Simulate a rising edge on pin """
+        if pin in self.callbacks:
+            self.callbacks[pin](pin)
+
+@pytest.fixture
+def gpio(monkeypatch):
+    gpio = FakeGPIO()
+    package = types.ModuleType('RPi')
+    package.GPIO = gpio
+    monkeypatch.setitem(sys.modules, 'RPi', package)
+    monkeypatch.setitem(sys.modules, 'RPi.GPIO', gpio)
+    monkeypatch.delitem(sys.modules, 'buzzer', raising=False)
+    monkeypatch.setattr(pacer, 'GPIO', gpio)
+    return gpio
+
+def test_beep_keeps_interrupt_armed(gpio):
+    buzzer = importlib.import_module('buzzer')
+    buzzer.setup()
+    edges = pacer.GPIOEdgeSource(7)
+
+    buzzer.playSound(buzzer.sounds['compliant'])
+    buzzer.playSound(buzzer.sounds['compliant'])    # The buzzer's own pins still work after a sound
+
+    gpio.rise(7)
+    assert edges.wait(0)
+    assert edges.edges == 1
+
+def pace(edges, rate, seconds):
+    """ Run a trivial task on edges for seconds. Returns its scheduler statistics """
+    tasks = scheduler.Scheduler()
+    tasks.add('imu', lambda: None, rate, trigger=edges)
+    threading.Timer(seconds, tasks.stop).start()
+    try:
+        tasks.run()
+    finally:
+        edges.close()
+    return tasks.summary()['tasks']['imu']
+
+def test_fake_edges_pace_the_scheduler():
+    stats = pace(pacer.FakeEdgeSource(200), 200, 0.5)
+
+    assert stats['rate'] == pytest.approx(200, rel=0.15)
+    assert stats['missedEdges'] == 0
+
+def test_missing_edges_fall_back_to_the_timeout():
+    stats = pace(pacer.FakeEdgeSource(), 200, 0.5)     # No edges ever arrive
+
+    timeoutRate = 200 / pacer.EDGE_TIMEOUT_PERIODS
+    assert stats['rate'] == pytest.approx(timeoutRate, rel=0.25)
+    assert stats['missedEdges'] == pytest.approx(timeoutRate * 0.5, rel=0.25)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import fusion
+import pipeline
+import recording
+
+class FailOnce(pipeline.Stage):
+    """ Raises on the first batch, like an I2C error, then passes batches through """
+    def __init__(self):
+        super(FailOnce, self).__init__()
+        self.failed = False
+
+    def process(self, batch):
+        if not self.failed:
+            self.failed = True
+            raise OSError("Remote I/O error")
+        return batch
+
+def double(sample):
+    sample['y'] = sample['x'] * 2
+
+def test_call_returns_every_sample_of_the_batch():
+    batches = iter([[{'x': 1}, {'x': 2}, {'x': 3}], []])
+    chain = pipeline.Pipeline([pipeline.Derive(double)], lambda: next(batches))
+
+    assert [sample['y'] for sample in chain()] == [2, 4, 6]
+    assert chain() is None      # Nothing new
+
+def test_call_recovers_after_a_stage_raises():
+    chain = pipeline.Pipeline([FailOnce(), pipeline.Derive(double)], lambda: [{'x': 1}])
+
+    with pytest.raises(OSError):
+        chain()
+    assert chain()[0]['y'] == 2
+
+def test_call_recovers_after_an_iterable_stage_raises():
+    chain = pipeline.Pipeline([FailOnce(), pipeline.Derive(double)], [[{'x': 1}], [{'x': 2}]])
+
+    with pytest.raises(OSError):
+        chain()
+    assert chain()[0]['y'] == 4
+
+def test_fuse_batch_matches_sample_by_sample():
+    data = recording.synthesiseRecording(seconds=2)
+    accAngles = np.stack(fusion.gravityAngles(*data['acc'].T), axis=1)
+
+    def run(fusionFilter, batchSize):
+        samples = []
+        for batch in recording.replay(data, batchSize):
+            for sample, angles in zip(batch, accAngles[len(samples):]):
+                sample.update(zip(('AccXangle', 'AccYangle', 'AccZangle'), angles))
+            samples += pipeline.Fuse(fusionFilter)(batch)
+        return np.array([[sample['angleX'], sample['angleY'], sample['angleZ']] for sample in samples])
+
+    for make in (fusion.ComplementaryFilter, fusion.KalmanFilter, fusion.MadgwickFilter):
+        assert np.allclose(run(make(), 16), run(make(), 1))
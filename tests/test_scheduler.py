@@ -0,0 +1,64 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pacer
+import scheduler
+
+def runFor(tasks, seconds):
+    threading.Timer(seconds, tasks.stop).start()
+    tasks.run()
+    return tasks.summary()
+
+def test_slow_trigger_task_does_not_starve_timer_tasks():
+    # Edges at 1 kHz, but the task they trigger takes 3 ms -- there's always an edge waiting
+    edges = pacer.FakeEdgeSource(1000)
+    battery = []
+    tasks = scheduler.Scheduler()
+    tasks.add('imu', lambda: time.sleep(0.003), 1000, trigger=edges)
+    tasks.add('battery', lambda: battery.append(time.perf_counter()), 50)
+    try:
+        stats = runFor(tasks, 0.5)
+    finally:
+        edges.close()
+
+    assert len(battery) >= 20                   # 25 due
+    assert stats['tasks']['battery']['overruns'] <= 2
+    assert stats['tasks']['imu']['rate'] > 100  # The trigger task still gets the rest of the time
+
+def test_task_that_raises_keeps_running():
+    calls = []
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("Remote I/O error")
+
+    tasks = scheduler.Scheduler()
+    tasks.add('imu', flaky, 100)
+    stats = runFor(tasks, 0.2)
+
+    assert stats['tasks']['imu']['errors'] == 1
+    assert len(calls) > 10
+
+def test_run_async_keeps_blocking_tasks_off_the_event_loop():
+    tasks = scheduler.Scheduler()
+    tasks.add('battery', lambda: time.sleep(0.05), 10, blocking=True)   # A slow bus read
+    gaps = []
+
+    async def ticker():
+        last = time.perf_counter()
+        while not tasks.stopEvent.is_set():
+            await asyncio.sleep(0.005)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.5, tasks.stop)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            await asyncio.gather(tasks.runAsync(executor), ticker())
+
+    asyncio.run(main())
+    assert tasks.tasks['battery'].windowRuns >= 4
+    assert max(gaps) < 0.03     # The loop never waited out a 50 ms read
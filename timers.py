@@ -0,0 +1,118 @@
+# Delayed and repeating actions
+#
+# One thread and a heap of deadlines stand in for a threading.Timer (a whole OS thread)
+# per countdown. Timers can be started and cancelled from any thread; callbacks run on
+# the timer thread, so they should be quick -- set a flag or hand the work on
+
+import heapq
+import itertools
+import threading
+import time
+
+import rolling
+
+class Handle:
+    """
+    A pending call -- cancel() it to stop it happening
+    """
+    __slots__ = ('when', 'function', 'args', 'period', 'cancelled')
+
+    def __init__(self, when, function, args, period=None):
+        self.when = when            # time.monotonic() deadline of the next call
+        self.function = function
+        self.args = args
+        self.period = period        # Seconds between calls for repeating timers, None for one-shot
+        self.cancelled = False
+
+    def cancel(self):
+        """ Stop the call from happening, or happening again """
+        self.cancelled = True
+
+    @property
+    def remaining(self):
+        """ Seconds until the next call """
+        return max(self.when - time.monotonic(), 0.0)
+
+class Timers:
+    """
+    Runs timers from a single thread, started on first use
+    """
+    def __init__(self):
+        self.heap = []                      # (when, sequence, Handle)
+        self.sequence = itertools.count()   # Tie-breaker, so equal deadlines fire in the order they were set
+        self.condition = threading.Condition()
+        self.thread = None
+
+        self.fired = 0                      # Number of calls made
+        self.lateness = rolling.TimingStats(200)    # Seconds past the deadline the recent calls were made
+        self.errors = 0                     # Number of callbacks that raised
+
+    def schedule(self, delay, function, *args):
+        """ Call function(*args) in delay seconds. Returns a Handle """
+        return self.add(Handle(time.monotonic() + delay, function, args))
+
+    def every(self, period, function, *args, delay=None):
+        """ Call function(*args) every period seconds, the first time after delay (default period). Returns a Handle """
+        return self.add(Handle(time.monotonic() + (period if delay is None else delay), function, args, period))
+
+    def add(self, handle):
+        with self.condition:
+            heapq.heappush(self.heap, (handle.when, next(self.sequence), handle))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='timers', daemon=True)
+                self.thread.start()
+            elif self.heap[0][2] is handle:     # New earliest deadline -- wake the thread to wait for it instead
+                self.condition.notify()
+        return handle
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.heap and self.heap[0][2].cancelled:  # Drop cancelled timers as they reach the front
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                when, sequence, handle = heapq.heappop(self.heap)
+                if handle.period is not None:   # Repeating: schedule the next call on the original grid, so it doesn't drift
+                    handle.when = when + handle.period * max(int((time.monotonic() - when) // handle.period) + 1, 1)
+                    heapq.heappush(self.heap, (handle.when, next(self.sequence), handle))
+
+            self.lateness.update(time.monotonic() - when)
+            self.fired += 1
+            try:
+                handle.function(*handle.args)
+            except Exception as error:          # One bad callback mustn't take every other timer down with it
+                self.errors += 1
+                print(f"Timer callback {handle.function!r} failed: {error!r}")
+
+    @property
+    def pending(self):
+        """ Number of timers waiting to fire """
+        with self.condition:
+            return sum(1 for when, sequence, handle in self.heap if not handle.cancelled)
+
+    def summary(self):
+        """ Dict of pending timers and how late they've been firing """
+        return {
+            'pending':      self.pending,
+            'fired':        self.fired,
+            'errors':       self.errors,
+            'lateMean':     self.lateness.mean,
+            'lateMax':      self.lateness.max,
+            'lateP99':      self.lateness.percentile(99),
+        }
+
+timers = Timers()           # Shared by the whole app
+
+def schedule(delay, function, *args):
+    """ Call function(*args) in delay seconds on the shared timer thread. Returns a Handle """
+    return timers.schedule(delay, function, *args)
+
+def every(period, function, *args, delay=None):
+    """ Call function(*args) every period seconds on the shared timer thread. Returns a Handle """
+    return timers.every(period, function, *args, delay=delay)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+#   Offline filter tuning: sweep the fusion filter parameters over recorded motion data
+#   and report, for each mode, which settings give the steadiest angles that still follow the motion
+#
+#   Usage:
+#       python tune.py              Synthetic motion with ground truth
+#       python tune.py IMU.csv      A motion snapshot recorded from the debug page
+#
+#   Every parameter combination runs at once: the filters take P x 1 parameter arrays and
+#   step all P combinations together through the recording, one sample at a time
+#
+#   ACC_LPF_FACTOR and MAG_LPF_FACTOR aren't swept -- recordings already store the
+#   accelerometer after the LPF/median stage, and the magnetometer doesn't feed the angles
+#
+#   Candidates are scored against the recording's true angles (or, for recordings, the smoothed
+#   accelerometer angles), never against a filter run with default settings -- that would just
+#   pick the defaults. Each mode is scored on the angles its rule reads, from rules.MODES_FILE
+
+import itertools
+import sys
+import time
+
+import numpy as np
+
+import fusion
+import recording
+import rules
+from benchmark import reference, wrapDegrees
+
+REFERENCE_WINDOW = 0.5  # Seconds -- centred moving average of the accelerometer angles used as truth for recordings
+AXES = ('angleX', 'angleY', 'angleZ')  # Output angle channels, in filter output order
+
+# Values to try for each parameter
+GRIDS = {
+    'fast': {
+        'AA':       np.linspace(0, 0.95, 96),
+    },
+    'accurate': {
+        'Q_angle':  np.logspace(-4, 0, 12),
+        'Q_gyro':   np.logspace(-5, -1, 12),
+        'R_angle':  np.logspace(-4, 0, 12),
+    },
+}
+
+FILTERS = {
+    'fast':     fusion.ComplementaryFilter,
+    'accurate': fusion.KalmanFilter,
+}
+
+def smoothedReference(accAngles, dt):
+    """ Stand-in for ground truth on recordings: accelerometer angles smoothed without lag """
+    window = max(1, int(REFERENCE_WINDOW / np.mean(dt[1:])))
+    kernel = np.ones(window) / window
+    return np.stack([np.convolve(accAngles[:, axis], kernel, mode='same') for axis in range(3)], axis=1)
+
+def sweep(algorithm, accAngles, gyro, dt, truth):
+    """
+    Run every combination of GRIDS[algorithm] through the recording
+    truth is in degrees, see benchmark.reference()
+    Returns (list of parameter dicts, P x 3 mean squared errors, P x 3 mean jitters) -- one column per output angle
+    """
+    names = list(GRIDS[algorithm])
+    combinations = list(itertools.product(*GRIDS[algorithm].values()))
+    grid = np.array(combinations)
+
+    fusionFilter = FILTERS[algorithm](**{name: grid[:, [i]] for i, name in enumerate(names)})    # P x 1 parameter columns
+    truth = reference(algorithm, truth)
+
+    # Accumulate scores as we go rather than keeping N x P x 3 angles around
+    squaredError = np.zeros((len(grid), 3))
+    jitter = np.zeros((len(grid), 3))
+    previous = None
+    for i in range(len(dt)):
+        angles = fusionFilter.update(accAngles[i], gyro[i], dt[i])
+        squaredError += wrapDegrees(angles - truth[i]) ** 2
+        if previous is not None:
+            jitter += np.abs(wrapDegrees(angles - previous))
+        previous = angles
+
+    parameters = [dict(zip(names, combination)) for combination in combinations]
+    return parameters, squaredError / len(dt), jitter / (len(dt) - 1)
+
+def modeAxes(modes):
+    """
+    Output angle columns each mode's rule reads, {mode: [column, ...]}
+    Modes that only limit motion read the gyro rates, which the filters don't touch -- they're scored
+    on every angle, so switching to the mode doesn't leave the angles for the debug page worse off
+    """
+    return {
+        mode: [AXES.index(channel) for channel in definition.get('angles', {})] or list(range(3))
+        for mode, definition in modes.items()
+    }
+
+def run(data, top=5):
+    accAngles = np.stack(fusion.gravityAngles(*data['acc'].T), axis=1)
+    if 'truth' in data:
+        truth = data['truth']
+    else:
+        truth = smoothedReference(accAngles, data['dt'])
+
+    axes = modeAxes(rules.loadModes())
+    for algorithm in GRIDS:
+        start = time.perf_counter()
+        parameters, squaredError, jitter = sweep(algorithm, accAngles, data['gyro'], data['dt'], truth)
+        elapsed = time.perf_counter() - start
+        print(f"\n{algorithm}: {len(parameters)} combinations in {elapsed:.1f}s")
+
+        for mode, columns in axes.items():
+            rmsError = np.sqrt(np.mean(squaredError[:, columns], axis=1))
+            modeJitter = np.mean(jitter[:, columns], axis=1)
+
+            print(f"\n  {mode} ({', '.join(AXES[column] for column in columns)})")
+            print(f"  {'RMS error':>10} {'Jitter':>8}  Parameters")
+            for i in np.argsort(rmsError)[:top]:    # Lowest error against truth is both steady and responsive
+                settings = ', '.join(f"{name} = {value:.4g}" for name, value in parameters[i].items())
+                print(f"  {rmsError[i]:10.2f} {modeJitter[i]:8.3f}  {settings}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(recording.loadRecording(sys.argv[1]))
+    else:
+        run(recording.synthesiseRecording())